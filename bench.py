@@ -0,0 +1,439 @@
+import json
+import time
+
+import numpy as np
+
+import golden
+from harness import Harness
+from pipeline import BinningPipeline, MultiCorePipeline, RasterPipeline
+from precision import Precision
+
+# benchmarks RasterPipeline variants over corpora of triangles, checking every
+# fragment against the golden model as it goes.
+#
+# for each variant and corpus, the triangles are streamed into the pipeline
+# back to back, and the run ends when the pipeline is idle again. reported are:
+#
+# - cycles_per_triangle: total cycles over triangles.
+# - fragments_per_cycle: covered pixels produced, over total cycles.
+# - bbox_efficiency:     cycles with o_valid, over cycles TriangleRender spent
+#                        walking; the rest went on samples (or blocks, or
+#                        tiles) with nothing covered.
+# - raster_bound:        fraction of cycles TriangleRender was walking.
+# - setup_bound:         fraction of cycles TriangleRender sat idle with
+#                        triangles still in setup or the FIFOs.
+# - input_stalls:        cycles a triangle was offered but not taken.
+# - mismatches:          fragments that differ from golden.rasterise, counted
+#                        both ways. for multisampled variants, a fragment is a
+#                        pixel and its coverage mask, against
+#                        golden.multisample.
+# - culled:              triangles dropped by the cull stage, by reason, for
+#                        variants with cull or scissor set.
+# - cull_mismatches:     triangles culled that golden.cull would not have, or
+#                        for a different reason, and the other way around.
+#
+# variants with scissor set are scissored to SCISSOR, and checked against
+# golden.rasterise with it. the culled corpus has back-facing, zero-area and
+# out of scissor triangles among ordinary ones, wound as they come.
+#
+# variants with `precision` set take it as the arguments of a
+# precision.Precision, for a pipeline narrowed to a SIZE x SIZE screen, which
+# is where the corpora keep their triangles (but for the culled corpus's ones
+# past the last sample, which never reach setup, and the mesh corpus's past
+# about a hundred triangles, which outgrow it).
+#
+# the edge corpus is drawn against the edges of each variant's own screen: the
+# whole 16 bit coordinate range without precision set. unlike the others, its
+# triangles differ from variant to variant.
+#
+# variants with `cores` set are MultiCorePipelines, for which raster_bound and
+# bbox_efficiency count the cycles in which any core was walking. variants
+# with `binning` set are BinningPipelines, flushed as soon as they drain, and
+# checked against golden.rasterise within their screen; their small triangle
+# and bin memories fill up, so that passes start before the end of a corpus.
+#
+# results are written as JSON, so that variants and revisions can be compared.
+
+VARIANTS = {
+    "base":         dict(),
+    "parallel":     dict(parallel=True),
+    "quad":         dict(parallel=True, lanes_x=2, lanes_y=2),
+    "quad_tile8":   dict(parallel=True, lanes_x=2, lanes_y=2, tile=8),
+    "span":         dict(parallel=True, span=True),
+    "msaa2":        dict(parallel=True, samples=2),
+    "msaa4":        dict(parallel=True, lanes_x=2, lanes_y=2, samples=4),
+    "cull":         dict(parallel=True, cull=True),
+    "scissor":      dict(parallel=True, cull=True, scissor=True),
+    "quad_scissor": dict(parallel=True, lanes_x=2, lanes_y=2, scissor=True),
+    "cores2":       dict(cores=2),
+    "cores4":       dict(cores=4),
+    "binning":      dict(binning=True, width=512, height=512, tile=64, triangles=8, entries=32),
+    "q94":          dict(parallel=True, precision=dict(width=512, height=512, int_bits=9, edge_bits=25)),
+    "quad_q94":     dict(parallel=True, lanes_x=2, lanes_y=2, tile=8,
+                         precision=dict(width=512, height=512, int_bits=9, edge_bits=25)),
+    "planes6":      dict(parallel=True, planes=6),
+}
+
+# frame size, in pixels.
+SIZE = 512
+
+# the scissor of variants with scissor set, as (min_x, min_y, max_x, max_y) in
+# Q12.4, inclusive, as golden.rasterise takes it. the corners are off the
+# sample lattice, so that the first and last samples are rounded inward.
+SCISSOR = ((64 << 4) + 5, (48 << 4) + 11, (440 << 4) + 9, (400 << 4) + 2)
+
+# the reasons the cull stage drops a triangle for, as golden.cull gives them.
+CULLS = ["outside", "back_facing", "zero_area"]
+
+
+# triangles are (ax, ay, bx, by, cx, cy) in Q12.4, wound so that their inside is
+# negative, as TriangleRender expects.
+def wind(triangle):
+    ax, ay, bx, by, cx, cy = (int(v) for v in triangle)
+    if golden.edge(ax, ay, bx, by, cx, cy) > 0:
+        return (ax, ay, cx, cy, bx, by)
+    return (ax, ay, bx, by, cx, cy)
+
+
+def around(rng, count, radius):
+    centre = rng.integers(radius, (SIZE << 4) - radius, size=(count, 1, 2))
+    return centre + rng.integers(-radius, radius + 1, size=(count, 3, 2))
+
+
+def tiny(rng, count):
+    return around(rng, count, 1 << 4)
+
+
+def sliver(rng, count):
+    start = rng.integers(16 << 4, (SIZE - 16) << 4, size=(count, 2))
+    angle = rng.uniform(0, 2 * np.pi, size=count)
+    length = rng.integers(32 << 4, 128 << 4, size=count)
+    end = start + np.stack([np.cos(angle), np.sin(angle)], axis=1) * length[:, None]
+    end = np.clip(end, 0, (SIZE << 4) - 1).astype(np.int64)
+    width = rng.integers(1, 1 << 4, size=(count, 2))
+    return np.stack([start, end, np.clip(start + width, 0, (SIZE << 4) - 1)], axis=1)
+
+
+def large(rng, count):
+    return around(rng, count, 64 << 4)
+
+
+def degenerate(rng, count):
+    a = rng.integers(64 << 4, (SIZE - 64) << 4, size=(count, 2))
+    b = a + rng.integers(-(48 << 4), 48 << 4, size=(count, 2))
+    c = np.where(rng.integers(0, 2, size=(count, 1)), a, (a + b) // 2)
+    return np.stack([a, b, c], axis=1)
+
+
+# a jittered grid, each cell split into two triangles that share an edge.
+def mesh(rng, count):
+    cells = int(np.ceil(np.sqrt(count / 2)))
+    step  = (48 << 4)
+    grid  = np.mgrid[0:cells + 1, 0:cells + 1].transpose(1, 2, 0)[..., ::-1] * step + (16 << 4)
+    grid  = grid + rng.integers(-(8 << 4), 8 << 4, size=grid.shape)
+    triangles = []
+    for j in range(cells):
+        for i in range(cells):
+            triangles.append([grid[j, i], grid[j, i + 1], grid[j + 1, i]])
+            triangles.append([grid[j, i + 1], grid[j + 1, i + 1], grid[j + 1, i]])
+    return np.array(triangles[:count])
+
+
+# a mix of triangles for the cull stage to drop or keep, in turn: back-facing,
+# zero-area, wholly outside the scissor (or past the last sample), across its
+# edge, and ordinary ones. all but the back-facing ones are wound.
+def culled(rng, count):
+    low_x, low_y, high_x, high_y = SCISSOR
+    triangles = []
+    for n in range(count):
+        kind = n % 5
+        if kind == 0:
+            ax, ay, bx, by, cx, cy = wind(around(rng, 1, 24 << 4).ravel())
+            triangles.append((ax, ay, cx, cy, bx, by))
+        elif kind == 1:
+            triangles.append(wind(degenerate(rng, 1).ravel()))
+        elif kind == 2:
+            side = int(rng.integers(3))
+            centre = [(low_x // 2, rng.integers(0, SIZE << 4)),
+                      (rng.integers(0, SIZE << 4), (high_y + (SIZE << 4)) // 2),
+                      (0xFFFC, 0xFFFC)][side]
+            radius = [12 << 4, 12 << 4, 3][side]
+            points = np.array(centre) + rng.integers(-radius, radius + 1, size=(3, 2))
+            triangles.append(wind(np.clip(points, 0, 0xFFFF).ravel()))
+        elif kind == 3:
+            centre = [(low_x, rng.integers(low_y, high_y)), (rng.integers(low_x, high_x), high_y)][rng.integers(2)]
+            triangles.append(wind((np.array(centre) + rng.integers(-(16 << 4), 16 << 4, size=(3, 2))).ravel()))
+        else:
+            triangles.append(wind(around(rng, 1, 32 << 4).ravel()))
+    return triangles
+
+
+# triangles around points on the edges and corners of a screen whose last
+# column and row are at `last`, clipped to it, so that they run up to x or y 0
+# and to the last column or row, where the walk turns at the ends of its range.
+def edge(rng, count, last=(SIZE << 4) - 1):
+    centre = rng.integers(0, last + 1, size=(count, 1, 2))
+    place  = rng.integers(0, 8, size=count)
+    for n, where in enumerate(place):
+        # left, top, right and bottom edges, then the corners.
+        if where < 4:
+            centre[n, 0, where % 2] = (where // 2) * last
+        else:
+            centre[n, 0] = [(where % 2) * last, ((where // 2) % 2) * last]
+    radius = rng.integers(2 << 4, 48 << 4, size=(count, 1, 1))
+    return np.clip(centre + rng.integers(-radius, radius + 1, size=(count, 3, 2)), 0, last)
+
+
+CORPORA = {
+    "tiny":       tiny,
+    "sliver":     sliver,
+    "large":      large,
+    "degenerate": degenerate,
+    "mesh":       mesh,
+    "culled":     culled,
+    "edge":       edge,
+}
+
+
+# the corpus `name`; the edge corpus is drawn against the screen of `variant`.
+def corpus(name, count, seed=0, variant=None):
+    rng = np.random.default_rng(seed)
+    if name == "edge" and variant is not None:
+        triangles = edge(rng, count, screen(variant))
+    else:
+        triangles = CORPORA[name](rng, count)
+    if name == "culled":
+        return [tuple(int(v) for v in triangle) for triangle in triangles]
+    return [wind(triangle.ravel()) for triangle in triangles]
+
+
+# a fragment as a single value: its packed xy, and with multisampling, its
+# coverage mask below that.
+def key(xy, coverage=None, samples=1):
+    if samples == 1:
+        return xy
+    return (np.asarray(xy, dtype=np.int64) << 4) | coverage
+
+
+# the (x, y) of fragments from key(), or the (x, y, coverage) with multisampling.
+def unkey(keys, samples=1):
+    keys = np.asarray(keys, dtype=np.int64)
+    if samples == 1:
+        return list(zip(*map(list, golden.split_xy(keys))))
+    return list(zip(*map(list, golden.split_xy(keys >> 4)), list(keys & 0xF)))
+
+
+# covered pixels from the sampled pipeline outputs, as key() values. with
+# multisampling, rows has o_coverage after o_full.
+def fragments(rows, lanes_x, lanes_y, tile, samples=1):
+    valid, xy, mask, full = rows.T[:4]
+    x, y = golden.split_xy(xy)
+    pixels = []
+    for j in range(lanes_y):
+        for i in range(lanes_x):
+            n = j * lanes_x + i
+            lane = (valid == 1) & (full == 0) & ((mask >> n) & 1 == 1)
+            coverage = (rows[lane, 4] >> (n * samples)) & ((1 << samples) - 1) if samples > 1 else None
+            pixels.append(key(golden.join_xy(x[lane] + (i << 4), y[lane] + (j << 4)), coverage, samples))
+    if tile is not None:
+        full = (valid == 1) & (full == 1)
+        for j in range(tile):
+            for i in range(tile):
+                pixels.append(golden.join_xy(x[full] + (i << 4), y[full] + (j << 4)))
+    return np.concatenate(pixels)
+
+
+# the largest coordinate of triangles for a variant, in either direction: the
+# edge of its screen, with precision set. binning variants drop triangles off
+# their screen, so they get twice that, so that some land on it and some do not.
+def top(variant):
+    config = VARIANTS[variant]
+    if "binning" in config:
+        return (min(config["width"], config["height"]) << 5) - 1
+    if "precision" not in config:
+        return 0xFFFF
+    precision = Precision(**config["precision"])
+    return min(precision.max_x, precision.max_y)
+
+
+# the last column and row of a variant's screen.
+def screen(variant):
+    config = VARIANTS[variant]
+    if "binning" in config:
+        return (min(config["width"], config["height"]) << 4) - 1
+    return top(variant)
+
+
+# the pipeline for a variant, and the outputs that covered() and culled() need
+# from it. the cull events come last.
+def build(variant):
+    config = VARIANTS[variant]
+    if "cores" in config:
+        dut = MultiCorePipeline(**config)
+        lanes = [dut.o_valid] + dut.o_xy + [render.i_run for render in dut.renders]
+    elif "binning" in config:
+        dut = BinningPipeline(**{k: v for k, v in config.items() if k != "binning"})
+        lanes = [dut.o_valid, dut.o_xy, dut.render.i_run]
+    else:
+        if "precision" in config:
+            config = dict(config, precision=Precision(**config["precision"]))
+        dut = RasterPipeline(**config)
+        lanes = [dut.o_valid, dut.o_xy, dut.o_mask, dut.o_full, dut.render.i_run]
+        if dut.samples > 1:
+            lanes.append(dut.o_coverage)
+    if dut.cull:
+        lanes += [getattr(dut, "culled_" + reason) for reason in CULLS]
+    return dut, lanes
+
+
+# streams triangles into dut on harness, back to back, until it is idle again.
+# the rows are the lanes, then o_idle, i_valid and o_ready.
+def stream(harness, dut, lanes, triangles):
+    def column(index):
+        return [golden.join_xy(triangle[index], triangle[index + 1]) for triangle in triangles]
+
+    inputs = [
+        (dut.i_tri_xy_a, column(0)),
+        (dut.i_tri_xy_b, column(2)),
+        (dut.i_tri_xy_c, column(4)),
+    ]
+    if dut.scissor:
+        low_x, low_y, high_x, high_y = SCISSOR
+        inputs += [
+            (dut.i_scissor_min, [golden.join_xy(low_x, low_y)] * len(triangles)),
+            (dut.i_scissor_max, [golden.join_xy(high_x, high_y)] * len(triangles)),
+        ]
+    if isinstance(dut, BinningPipeline):
+        inputs.append((dut.i_flush, [1] * len(triangles)))
+    outputs = lanes + [dut.o_idle, dut.i_valid, dut.o_ready]
+
+    limit = sum(((max(t[0::2]) - min(t[0::2]) >> 4) + 2) * ((max(t[1::2]) - min(t[1::2]) >> 4) + 2)
+                for t in triangles) + 64 * len(triangles) + 64
+    return harness.run(inputs, outputs, cycles=limit, valid=dut.i_valid, ready=dut.o_ready, until=dut.o_idle)
+
+
+# the sorted covered pixels in rows from stream(), and whether each row had a
+# triangle being walked.
+def covered(dut, rows):
+    if isinstance(dut, MultiCorePipeline):
+        cores   = dut.cores
+        running = rows[:, 1 + cores:1 + 2 * cores].any(axis=1)
+        got = np.concatenate([rows[(rows[:, 0] >> n) & 1 == 1, 1 + n] for n in range(cores)])
+    elif isinstance(dut, BinningPipeline):
+        running = rows[:, 2]
+        got = rows[rows[:, 0] == 1, 1]
+    else:
+        render  = dut.render
+        running = rows[:, 4]
+        got = fragments(rows[:, [0, 1, 2, 3, 5]] if dut.samples > 1 else rows[:, :4],
+                        render.lanes_x, render.lanes_y, render.tile, dut.samples)
+    return np.sort(got), running
+
+
+# the sorted key() values of the fragments dut should produce for triangles.
+def expected(dut, triangles):
+    samples = getattr(dut, "samples", 1)
+    scissor = SCISSOR if dut.scissor else None
+    if samples > 1:
+        pixels = []
+        for t in triangles:
+            x, y, mask = golden.multisample(*t, samples)
+            if scissor is not None:
+                inside = (x >= scissor[0]) & (y >= scissor[1]) & (x <= scissor[2]) & (y <= scissor[3])
+                x, y, mask = x[inside], y[inside], mask[inside]
+            pixels.append(key(golden.join_xy(x, y), mask, samples))
+        return np.sort(np.concatenate(pixels))
+    if isinstance(dut, BinningPipeline):
+        scissor = (0, 0, (dut.width << 4) - 1, (dut.height << 4) - 1)
+    return np.sort(np.concatenate([golden.join_xy(*golden.rasterise(*t, scissor=scissor)) for t in triangles]))
+
+
+# the triangles culled in rows from stream(), by reason, or nothing without
+# cull set.
+def culled(dut, rows):
+    if not dut.cull:
+        return {}
+    counts = rows[:, -3 - len(CULLS):-3].sum(axis=0)
+    return {reason: int(count) for reason, count in zip(CULLS, counts)}
+
+
+# the triangles golden.cull drops, by reason, as culled() gives them.
+def expected_culled(dut, triangles):
+    if not dut.cull:
+        return {}
+    reasons = [golden.cull(*t, scissor=SCISSOR if dut.scissor else None) for t in triangles]
+    return {reason: reasons.count(reason) for reason in CULLS}
+
+
+# fragments in one of got and expected but not the other, counted both ways.
+def mismatches(got, expected):
+    return (len(np.setdiff1d(got, expected)) + len(np.setdiff1d(expected, got)) +
+            abs(len(got) - len(expected)))
+
+
+def benchmark(variant, triangles):
+    dut, lanes = build(variant)
+    harness = Harness(dut)
+
+    start = time.perf_counter()
+    rows = stream(harness, dut, lanes, triangles)
+    wall = time.perf_counter() - start
+
+    idle, offered, ready = rows[:, -3], rows[:, -2], rows[:, -1]
+    valid = rows[:, 0] != 0
+    got, running = covered(dut, rows)
+    drops = culled(dut, rows)
+    expected_drops = expected_culled(dut, triangles)
+
+    cycles = len(rows)
+    raster = int(running.sum())
+    return {
+        "triangles":           len(triangles),
+        "cycles":              cycles,
+        "cycles_per_triangle": cycles / len(triangles),
+        "fragments":           len(got),
+        "fragments_per_cycle": len(got) / cycles,
+        "raster_cycles":       raster,
+        "valid_cycles":        int(valid.sum()),
+        "bbox_efficiency":     int(valid.sum()) / raster if raster else 0.0,
+        "raster_bound":        raster / cycles,
+        "setup_bound":         int(((running == 0) & (idle == 0)).sum()) / cycles,
+        "input_stalls":        int(((offered == 1) & (ready == 0)).sum()),
+        "mismatches":          mismatches(got, expected(dut, triangles)),
+        "culled":              drops,
+        "cull_mismatches":     sum(abs(drops[reason] - expected_drops[reason]) for reason in drops),
+        "wall_seconds":        wall,
+        "cycles_per_second":   cycles / wall,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Benchmark RasterPipeline variants over triangle corpora.")
+    parser.add_argument("--variants", nargs="+", choices=VARIANTS, default=list(VARIANTS))
+    parser.add_argument("--corpora", nargs="+", choices=CORPORA, default=list(CORPORA))
+    parser.add_argument("--count", type=int, default=8, help="triangles per corpus")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="-", help="JSON output file, or - for stdout")
+    args = parser.parse_args()
+
+    results = {"count": args.count, "seed": args.seed, "variants": {}}
+    for variant in args.variants:
+        results["variants"][variant] = {"config": VARIANTS[variant], "corpora": {}}
+        for name in args.corpora:
+            result = benchmark(variant, corpus(name, args.count, args.seed, variant))
+            results["variants"][variant]["corpora"][name] = result
+            print("{:>12} {:>10}: {:8.1f} cycles/triangle, {:.3f} fragments/cycle, {:.0%} bbox efficiency, "
+                  "{:.0%} setup bound, {} mismatches, {} cull mismatches".format(
+                  variant, name, result["cycles_per_triangle"], result["fragments_per_cycle"],
+                  result["bbox_efficiency"], result["setup_bound"], result["mismatches"],
+                  result["cull_mismatches"]), file=sys.stderr)
+
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,201 @@
+import numpy as np
+
+import golden
+
+# FrameCapture collects the fragments coming out of a simulation run into a
+# width x height frame, a whole batch at a time, for saving as an image or
+# comparing against a golden one.
+#
+# a frame is three arrays, indexed [y, x]:
+#
+# - colour:   32-bit pixels, as on WriteCombiner's i_rgba, with red in the low
+#             byte, then green, blue and alpha.
+# - depth:    32-bit depths, as on FragmentZTransform's o_pnt_z.
+# - coverage: 8-bit sample masks, as on TriangleRender's o_coverage, or 1 for
+#             pixels covered without multisampling.
+#
+# write() takes fragments at Q12.4 points, packed as on the hardware's xy
+# ports, and drops any outside the frame. colours and depths are replaced,
+# with the last of a batch winning where several land on the same pixel, as
+# they would in a framebuffer; coverage masks are ORed together.
+#
+# with ppm given, the colour is also kept in a binary (P6) PPM at that path,
+# memory-mapped, so that a frame too large to hold twice, or one that should be
+# watched as it is drawn, goes straight to disk as fragments are written.
+class FrameCapture:
+    def __init__(self, width=512, height=512, ppm=None):
+        if width < 1 or height < 1:
+            raise ValueError("Frame must be at least 1x1, not {}x{}".format(width, height))
+
+        self.width  = width
+        self.height = height
+
+        self.colour   = np.zeros((height, width), dtype=np.uint32)
+        self.depth    = np.zeros((height, width), dtype=np.uint32)
+        self.coverage = np.zeros((height, width), dtype=np.uint8)
+
+        self.image = None
+        if ppm is not None:
+            header = "P6\n{} {}\n255\n".format(width, height).encode()
+            self.image = np.memmap(ppm, dtype=np.uint8, mode="w+", offset=len(header), shape=(height, width, 3))
+            with open(ppm, "r+b") as f:
+                f.write(header)
+
+    def clear(self):
+        self.colour[:]   = 0
+        self.depth[:]    = 0
+        self.coverage[:] = 0
+        if self.image is not None:
+            self.image[:] = 0
+
+    # write a batch of fragments at packed Q12.4 points xy. rgba, z and
+    # coverage are broadcast against xy, and left alone where not given.
+    def write(self, xy, rgba=None, z=None, coverage=1):
+        x, y = golden.split_xy(np.ravel(xy))
+        x, y = x >> 4, y >> 4
+        in_frame = (x < self.width) & (y < self.height)
+        pixel = (y * self.width + x)[in_frame]
+
+        def values(value, dtype):
+            return np.broadcast_to(np.asarray(value, dtype=np.int64), in_frame.shape)[in_frame].astype(dtype)
+
+        if coverage is not None:
+            np.bitwise_or.at(self.coverage.reshape(-1), pixel, values(coverage, np.uint8))
+
+        # only the last fragment at each pixel is written, found by looking for
+        # the first of each pixel with the batch reversed.
+        _, first = np.unique(pixel[::-1], return_index=True)
+        last = len(pixel) - 1 - first
+        pixel = pixel[last]
+
+        if rgba is not None:
+            rgba = values(rgba, np.uint32)[last]
+            self.colour.reshape(-1)[pixel] = rgba
+            if self.image is not None:
+                self.image.reshape(-1, 3)[pixel] = rgba.view(np.uint8).reshape(-1, 4)[:, :3]
+        if z is not None:
+            self.depth.reshape(-1)[pixel] = values(z, np.uint32)[last]
+
+    # the colour, as a (height, width, 3) array of red, green and blue bytes.
+    def rgb(self):
+        return self.colour.view(np.uint8).reshape(self.height, self.width, 4)[:, :, :3]
+
+    # write the covered pixels out as a binary (P4) PBM, with covered pixels
+    # black.
+    def save_pbm(self, path):
+        with open(path, "wb") as f:
+            f.write("P4\n{} {}\n".format(self.width, self.height).encode())
+            f.write(np.packbits(self.coverage != 0, axis=1).tobytes())
+
+    # write the colour out as a binary (P6) PPM. with the frame already mapped
+    # to path, this just makes sure all of it has reached the file.
+    def save_ppm(self, path):
+        if self.image is not None and path == self.image.filename:
+            self.image.flush()
+            return
+        with open(path, "wb") as f:
+            f.write("P6\n{} {}\n255\n".format(self.width, self.height).encode())
+            f.write(np.ascontiguousarray(self.rgb()).tobytes())
+
+    def close(self):
+        if self.image is not None:
+            self.image.flush()
+            self.image = None
+
+
+# an image from a PBM or PPM file, ASCII or binary: a (height, width) array of
+# bools, True where black, for a bitmap, or a (height, width, 3) array of bytes
+# for a pixmap with a maxval below 256.
+def load(path):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    # the header is the magic number and two or three numbers, separated by
+    # whitespace and comments, and then a single whitespace character.
+    fields, position = [], 0
+    count = 3 if data[:2] in (b"P1", b"P4") else 4
+    while len(fields) < count:
+        while data[position:position + 1].isspace():
+            position += 1
+        if data[position:position + 1] == b"#":
+            position = data.index(b"\n", position)
+            continue
+        start = position
+        while position < len(data) and not data[position:position + 1].isspace():
+            position += 1
+        fields.append(data[start:position])
+    magic, (width, height) = fields[0], map(int, fields[1:3])
+    body = data[position + 1:]
+
+    if magic == b"P1":
+        bits = np.frombuffer(bytes(c for c in body if c in b"01"), dtype=np.uint8) - ord("0")
+        return bits[:width * height].reshape(height, width) != 0
+    if magic == b"P4":
+        rows = np.frombuffer(body, dtype=np.uint8)[:height * ((width + 7) // 8)].reshape(height, -1)
+        return np.unpackbits(rows, axis=1)[:, :width] != 0
+    if int(fields[3]) > 255:
+        raise ValueError("Only 8-bit pixmaps are supported, not a maxval of {}".format(int(fields[3])))
+    if magic == b"P3":
+        return np.array(body.split()[:width * height * 3], dtype=np.uint8).reshape(height, width, 3)
+    if magic == b"P6":
+        return np.frombuffer(body, dtype=np.uint8)[:width * height * 3].reshape(height, width, 3)
+    raise ValueError("Not a PBM or PPM file: {!r}".format(magic))
+
+
+# the (y, x) of every pixel at which two images differ, as an (n, 2) array, for
+# regression checks against golden images. pixels with several channels
+# differ if any channel does.
+def diff(got, expected):
+    got, expected = np.asarray(got), np.asarray(expected)
+    if got.shape != expected.shape:
+        raise ValueError("Cannot compare a {} image against a {} one".format(got.shape, expected.shape))
+    different = got != expected
+    if different.ndim > 2:
+        different = different.any(axis=tuple(range(2, different.ndim)))
+    return np.argwhere(different)
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import time
+
+    # a frame of a few hundred triangles, each in its own colour, captured
+    # through FrameCapture and written out both ways, against the ASCII
+    # output the testbenches used to write pixel by pixel.
+    rng = np.random.default_rng(0)
+    triangles = rng.integers(0, 512 << 4, size=(200, 6))
+    index = golden.frame(triangles)
+    px, py = golden.pixel_grid()
+    covered = index >= 0
+    colours = rng.integers(1 << 32, size=len(triangles), dtype=np.uint32)
+
+    with tempfile.TemporaryDirectory() as directory:
+        def path(name):
+            return os.path.join(directory, name)
+
+        start = time.perf_counter()
+        with open(path("ascii.ppm"), "w") as f:
+            f.write("P1\n")
+            f.write("512 512\n")
+            for y in range(0, 512):
+                for x in range(0, 512):
+                    f.write("{} ".format(int(covered[y][x])))
+                f.write("\n")
+        ascii_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        capture = FrameCapture(ppm=path("frame.ppm"))
+        for n in range(len(triangles)):
+            mask = index == n
+            capture.write(golden.join_xy(px[mask], py[mask]), rgba=colours[n], z=n)
+        capture.save_pbm(path("frame.pbm"))
+        capture.close()
+        capture_time = time.perf_counter() - start
+
+        mismatches = (len(diff(load(path("frame.pbm")), load(path("ascii.ppm")))) +
+                      len(diff(load(path("frame.ppm")), np.where(covered[..., None], capture.rgb(), 0))))
+        print("ASCII P1: {:.1f} ms, {} bytes; FrameCapture, P4 and mapped P6: {:.1f} ms, {} and {} bytes; "
+              "{} mismatched pixels".format(
+              ascii_time * 1e3, os.path.getsize(path("ascii.ppm")), capture_time * 1e3,
+              os.path.getsize(path("frame.pbm")), os.path.getsize(path("frame.ppm")), mismatches))
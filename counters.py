@@ -0,0 +1,51 @@
+from amaranth import *
+
+# PerformanceCounters counts events, one counter per (name, event) pair. an
+# event is either a single bit, counted once per cycle it is set, or a wider
+# value, added to its counter every cycle (for things like a number of
+# fragments).
+#
+# counters are read directly, as counters[name], or over a narrow bus by
+# setting i_select to a counter's index and reading o_value. setting i_clear
+# zeroes every counter on the next cycle; counting resumes the cycle after.
+# counters wrap around after 2**width - 1.
+#
+# modules that take `counters=True` build one of these over their own events
+# and expose it as their `counters` attribute; with counters=False, nothing is
+# built, and the design is exactly as it was without them.
+class PerformanceCounters(Elaboratable):
+    def __init__(self, events, width=32):
+        self.events   = list(events)
+        self.width    = width
+        self.names    = [name for name, _ in self.events]
+
+        self.counters = {name: Signal(width, name="count_" + name) for name in self.names}
+
+        self.i_clear  = Signal()
+        self.i_select = Signal(range(max(len(self.events), 2)))
+        self.o_value  = Signal(width)
+
+    def __getitem__(self, name):
+        return self.counters[name]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        for name, event in self.events:
+            counter = self.counters[name]
+            with m.If(self.i_clear):
+                m.d.sync += counter.eq(0)
+            with m.Else():
+                m.d.sync += counter.eq(counter + event)
+
+        with m.Switch(self.i_select):
+            for index, name in enumerate(self.names):
+                with m.Case(index):
+                    m.d.comb += self.o_value.eq(self.counters[name])
+
+        return m
+
+
+# the number of set bits in value.
+def popcount(value):
+    return sum(value[i] for i in range(len(value)))
@@ -0,0 +1,278 @@
+import numpy as np
+from amaranth import *
+
+from counters import PerformanceCounters
+
+# WriteCombiner sits between the fragment pipeline and the framebuffer memory,
+# and turns a stream of single pixel writes into aligned burst writes.
+#
+# the framebuffer is width x height 32-bit pixels, stored row by row, and a
+# burst covers `burst` consecutive pixels of a scanline, starting at a multiple
+# of `burst`. the combiner holds up to `lines` such bursts at once, each with
+# a byte mask of what has been written to it so far; a fragment that falls in
+# a held burst is merged into it, byte by byte, with later writes replacing
+# earlier ones.
+#
+# fragments are offered on i_xy (a Q12.4 point, as on TriangleRender's o_xy),
+# i_rgba and i_byte_mask (bit n enabling byte n of i_rgba) with i_valid, and
+# are taken when o_ready is high. fragments outside the frame are taken and
+# dropped. a fragment that falls in no held burst takes a free line, or, with
+# none free, the next line round in turn, which is written out first.
+#
+# bursts are written out on a simple memory bus: o_bus_addr is the pixel
+# address of the first pixel in the burst, o_bus_data its pixels, with pixel i
+# in bits 32*i up, and o_bus_mask its byte enables, with pixel i's in bits 4*i
+# up. a burst is transferred when o_bus_valid and i_bus_ready are both high.
+#
+# holding i_flush high writes every held line out, one per transfer, and stops
+# fragments being taken meanwhile. o_idle is set once nothing is held.
+#
+# with counters set, `counters` is a PerformanceCounters over:
+#
+# - fragments_in: fragments taken.
+# - merged:       fragments merged into a held burst.
+# - allocated:    fragments that started a new burst.
+# - bursts:       bursts written out.
+# - stalls:       cycles a fragment was offered but not taken.
+class WriteCombiner(Elaboratable):
+    def __init__(self, width=512, height=512, burst=8, lines=4, counters=False):
+        for name, value in [("Width", width), ("Height", height), ("Burst length", burst)]:
+            if value < 1 or value & (value - 1):
+                raise ValueError("{} must be a power of two, not {}".format(name, value))
+        if burst > width:
+            raise ValueError("Burst length {} is longer than a {} pixel scanline".format(burst, width))
+        if lines < 1:
+            raise ValueError("Need at least one line, not {}".format(lines))
+
+        self.width  = width
+        self.height = height
+        self.burst  = burst
+        self.lines  = lines
+
+        self.i_xy        = Signal(32)
+        self.i_rgba      = Signal(32)
+        self.i_byte_mask = Signal(4, reset=0b1111)
+        self.i_valid     = Signal()
+        self.o_ready     = Signal()
+
+        self.o_bus_addr  = Signal(range(width * height))
+        self.o_bus_data  = Signal(32 * burst)
+        self.o_bus_mask  = Signal(4 * burst)
+        self.o_bus_valid = Signal()
+        self.i_bus_ready = Signal(reset=1)
+
+        self.i_flush = Signal()
+        self.o_idle  = Signal()
+
+        self.taken     = Signal()
+        self.merged    = Signal()
+        self.allocated = Signal()
+
+        self.counters = None
+        if counters:
+            self.counters = PerformanceCounters([
+                ("fragments_in", self.taken),
+                ("merged",       self.merged),
+                ("allocated",    self.allocated),
+                ("bursts",       self.o_bus_valid & self.i_bus_ready),
+                ("stalls",       self.i_valid & ~self.o_ready),
+            ])
+
+    def elaborate(self, platform):
+        m = Module()
+
+        if self.counters is not None:
+            m.submodules.counters = self.counters
+
+        x_bits = self.width.bit_length() - 1
+        y_bits = self.height.bit_length() - 1
+        b_bits = self.burst.bit_length() - 1
+
+        x, y     = self.i_xy[4:16], self.i_xy[20:32]
+        in_frame = (x[x_bits:] == 0) & (y[y_bits:] == 0)
+        offset   = x[:b_bits]
+        tag      = Cat(x[b_bits:x_bits], y[:y_bits])
+
+        valid = [Signal(name="line{}_valid".format(i)) for i in range(self.lines)]
+        tags  = [Signal(len(tag), name="line{}_tag".format(i)) for i in range(self.lines)]
+        datas = [Signal(32 * self.burst, name="line{}_data".format(i)) for i in range(self.lines)]
+        masks = [Signal(4 * self.burst, name="line{}_mask".format(i)) for i in range(self.lines)]
+
+        # the bit and byte enables for this fragment's pixel within a burst.
+        byte_mask = Cat(*(self.i_byte_mask & (offset == i).replicate(4) for i in range(self.burst)))
+        bit_mask  = Cat(*(byte.replicate(8) for byte in byte_mask))
+        pixels    = self.i_rgba.replicate(self.burst)
+
+        hits = Cat(*(v & (t == tag) for v, t in zip(valid, tags)))
+        free = Cat(*(~v for v in valid))
+        hit  = hits.any()
+
+        # the line to allocate: the first free one, or failing that the one the
+        # victim pointer is at, which moves round on every eviction.
+        victim     = Signal(range(self.lines))
+        allocation = Signal(range(self.lines))
+        m.d.comb += allocation.eq(victim)
+        for i in reversed(range(self.lines)):
+            with m.If(free[i]):
+                m.d.comb += allocation.eq(i)
+
+        # the first held line, for flushing.
+        flushing = Signal(range(self.lines))
+        for i in reversed(range(self.lines)):
+            with m.If(valid[i]):
+                m.d.comb += flushing.eq(i)
+
+        # a line can be written out when the bus register is empty, or is being
+        # emptied in this cycle.
+        can_evict = ~self.o_bus_valid | self.i_bus_ready
+        evict     = Signal()
+        evicting  = Signal(range(self.lines))
+
+        with m.If(evict):
+            m.d.sync += [
+                self.o_bus_addr.eq(Cat(C(0, b_bits), Array(tags)[evicting])),
+                self.o_bus_data.eq(Array(datas)[evicting]),
+                self.o_bus_mask.eq(Array(masks)[evicting]),
+                self.o_bus_valid.eq(1),
+            ]
+        with m.Else():
+            m.d.sync += self.o_bus_valid.eq(self.o_bus_valid & ~self.i_bus_ready)
+
+        m.d.comb += [
+            self.o_ready.eq(~self.i_flush & (hit | free.any() | can_evict | ~in_frame)),
+            self.taken.eq(self.i_valid & self.o_ready),
+            self.o_idle.eq(free.all() & ~self.o_bus_valid),
+        ]
+
+        with m.If(self.taken & in_frame):
+            with m.If(hit):
+                m.d.comb += self.merged.eq(1)
+                for i in range(self.lines):
+                    with m.If(hits[i]):
+                        m.d.sync += [
+                            datas[i].eq((datas[i] & ~bit_mask) | (pixels & bit_mask)),
+                            masks[i].eq(masks[i] | byte_mask),
+                        ]
+            with m.Else():
+                m.d.comb += self.allocated.eq(1)
+                with m.If(~free.any()):
+                    m.d.comb += [
+                        evict.eq(1),
+                        evicting.eq(allocation),
+                    ]
+                    m.d.sync += victim.eq(Mux(victim == self.lines - 1, 0, victim + 1))
+                for i in range(self.lines):
+                    with m.If(allocation == i):
+                        m.d.sync += [
+                            valid[i].eq(1),
+                            tags[i].eq(tag),
+                            datas[i].eq(pixels & bit_mask),
+                            masks[i].eq(byte_mask),
+                        ]
+        with m.Elif(self.i_flush & ~free.all() & can_evict):
+            m.d.comb += [
+                evict.eq(1),
+                evicting.eq(flushing),
+            ]
+            for i in range(self.lines):
+                with m.If(flushing == i):
+                    m.d.sync += valid[i].eq(0)
+
+        return m
+
+
+# a model of the framebuffer memory behind a WriteCombiner's bus, or behind a
+# bus taking one pixel per transaction, counting the transactions and bytes
+# that reach it.
+class FramebufferMemory:
+    def __init__(self, width=512, height=512):
+        self.width  = width
+        self.height = height
+        self.pixels = np.zeros(width * height, dtype=np.uint32)
+
+        self.transactions = 0
+        self.bytes        = 0
+
+    # a burst write of len(data) pixels, with four byte enables each.
+    def write(self, address, data, mask):
+        for i, (pixel, enables) in enumerate(zip(data, mask)):
+            bits = sum(0xFF << (8 * n) for n in range(4) if enables >> n & 1)
+            self.pixels[address + i] = (int(self.pixels[address + i]) & ~bits) | (int(pixel) & bits)
+            self.bytes += bin(enables).count("1")
+        self.transactions += 1
+
+    # the bursts in a WriteCombiner's sampled (o_bus_valid, i_bus_ready,
+    # o_bus_addr, o_bus_data, o_bus_mask) rows.
+    def bus(self, rows, burst):
+        for valid, ready, address, data, mask in rows:
+            if valid and ready:
+                self.write(int(address),
+                           [int(data) >> (32 * i) & 0xFFFFFFFF for i in range(burst)],
+                           [int(mask) >> (4 * i) & 0xF for i in range(burst)])
+
+    # the per-pixel baseline: one transaction per fragment, at Q12.4 (x, y).
+    def fragments(self, x, y, rgba, byte_mask):
+        for x, y, rgba, byte_mask in zip(x, y, rgba, byte_mask):
+            x, y = int(x) >> 4, int(y) >> 4
+            if 0 <= x < self.width and 0 <= y < self.height:
+                self.write(y * self.width + x, [rgba], [byte_mask])
+
+    def frame(self):
+        return self.pixels.reshape(self.height, self.width)
+
+
+if __name__ == "__main__":
+    import bench
+    import golden
+    from harness import Harness
+
+    # the fragments of a mesh of triangles, each in its own colour, in the
+    # order TriangleRender walks them: serpentine, from the top-left corner.
+    rng = np.random.default_rng(0)
+    triangles = bench.corpus("mesh", 16)
+    x, y, rgba = [], [], []
+    for triangle in triangles:
+        tx, ty = golden.rasterise(*triangle)
+        rows = (ty - ty.min()) >> 4
+        order = np.lexsort((np.where(rows % 2, -tx, tx), ty))
+        x.append(tx[order])
+        y.append(ty[order])
+        rgba.append(np.full(len(tx), rng.integers(1 << 32)))
+    x, y, rgba = np.concatenate(x), np.concatenate(y), np.concatenate(rgba)
+    byte_mask = np.where(rng.random(len(x)) < 0.1, rng.integers(16, size=len(x)), 0b1111)
+
+    baseline = FramebufferMemory()
+    baseline.fragments(x, y, rgba, byte_mask)
+
+    for burst, lines in [(4, 2), (8, 2), (8, 4)]:
+        dut = WriteCombiner(burst=burst, lines=lines, counters=True)
+
+        # the memory takes a burst two cycles in three.
+        m = Module()
+        m.submodules.dut = dut
+        phase = Signal(2)
+        m.d.sync += phase.eq(Mux(phase == 2, 0, phase + 1))
+        m.d.comb += dut.i_bus_ready.eq(phase != 0)
+        harness = Harness(m)
+
+        rows = harness.run([
+            (dut.i_xy,        golden.join_xy(x, y)),
+            (dut.i_rgba,      rgba),
+            (dut.i_byte_mask, byte_mask),
+        ], [dut.o_bus_valid, dut.i_bus_ready, dut.o_bus_addr, dut.o_bus_data, dut.o_bus_mask],
+           cycles=2 * len(x), valid=dut.i_valid, ready=dut.o_ready, until=dut.o_ready)
+        rows = np.concatenate([rows, harness.run([(dut.i_flush, [1])], [
+            dut.o_bus_valid, dut.i_bus_ready, dut.o_bus_addr, dut.o_bus_data, dut.o_bus_mask],
+            cycles=4 * lines + 4, until=dut.o_idle)])
+
+        memory = FramebufferMemory()
+        memory.bus(rows, burst)
+
+        counts = dict(zip(dut.counters.names, harness.run(
+            outputs=[dut.counters[name] for name in dut.counters.names], cycles=1)[0]))
+
+        print("burst {:2}, {} lines: {} bus transactions for {} fragments ({:.2f}x fewer), {} stall cycles, "
+              "{} mismatched pixels; {}".format(
+              burst, lines, memory.transactions, baseline.transactions,
+              baseline.transactions / memory.transactions, counts["stalls"],
+              (memory.pixels != baseline.pixels).sum(), harness.report()))
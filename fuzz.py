@@ -0,0 +1,496 @@
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import bench
+import golden
+from gpu2 import FragmentZTransform, NewtonReciprocal, NonRestoringReciprocal, TriangleSetup
+from harness import Harness
+from precision import Precision
+
+# differential fuzzing of the hardware against the golden model, with random
+# and deliberately awkward inputs, bit for bit.
+#
+# there are three targets:
+#
+# - render:     every pipeline variant from bench.py, tiled, multisampled,
+#               culled, scissored, binned and narrowed ones included, so
+#               TriangleRender and everything in front of it, against
+#               golden.rasterise (or golden.multisample, for the multisampled
+#               ones). a case is one triangle, or a pair sharing an edge, and
+#               fails if the covered pixels differ in any way, if the cull
+#               stage drops different triangles than golden.cull, or if the
+#               pipeline does not go idle again in time.
+# - setup:      TriangleSetup, serial and parallel, with various EdgeFunction
+#               pipeline depths, and narrowed to a 512x512 screen with the
+#               fewest edge bits it allows, against golden.setup: every edge
+#               function, fractional part, delta and the area.
+# - ztransform: FragmentZTransform over each reciprocal engine, and with its
+#               edge functions narrowed to a 512x512 screen, against
+#               golden.reciprocal, with the fragment's sideband checked to come
+#               out in the same cycle as its z.
+#
+# cases come from the generators below, and are split into shards, each run in
+# its own process with its own harness; within a shard, cases go through one
+# harness one after the other, and each is checked on its own. a failing case
+# is shrunk, greedily, to the smallest input that still fails, which is
+# reported along with the case as found.
+#
+# results are written as JSON, like bench.py's.
+
+TOP = 0xFFFF
+
+
+# render cases are lists of (ax, ay, bx, by, cx, cy) triangles, in Q12.4, wound
+# as TriangleRender expects, but for back_facing ones. the triangles are kept
+# small, so that their walks stay short wherever they land, and within `top`,
+# the largest coordinate on the variant's screen.
+def clip(values, top=TOP):
+    return [int(v) for v in np.clip(values, 0, top)]
+
+
+def triangle(rng, centre, radius, top=TOP):
+    return clip(np.tile(centre, 3) + rng.integers(-radius, radius + 1, size=6), top)
+
+
+# a triangle anywhere in range.
+def uniform(rng, top=TOP):
+    return [triangle(rng, rng.integers(0, top + 1, size=2), int(rng.integers(1, 12 << 4)), top)]
+
+
+# two triangles either side of an edge AB, which between them must cover every
+# sample on or near it exactly once.
+def shared_edge(rng, top=TOP):
+    centre = rng.integers(0, top + 1, size=2)
+    a, b, c, d = (clip(centre + rng.integers(-(8 << 4), (8 << 4) + 1, size=2), top) for _ in range(4))
+    return [a + b + c, b + a + d]
+
+
+# vertices on the sample lattice of the triangle's bounding box, so that edges
+# run through samples, and often along rows or columns of them, where the top
+# left rule alone decides coverage.
+def top_left(rng, top=TOP):
+    x0, y0 = (int(v) for v in rng.integers(0, top - (8 << 4), size=2))
+    i, j = (int(v) for v in rng.integers(0, 6, size=2))
+    points = [(x0, y0 + 8 + 16 * j), (x0 + 8 + 16 * i, y0)]
+    if rng.integers(2):
+        # a right angle, with both legs on sample rows and columns.
+        points = [(x0 + 8, y0 + 8), (x0 + 8 + 16 * (i + 1), y0 + 8), (x0 + 8, y0 + 8 + 16 * (j + 1))]
+    else:
+        points.append(tuple(int(v) for v in (np.array([x0, y0]) + 8 + 16 * rng.integers(0, 6, size=2))))
+    return [clip(np.ravel(points), top)]
+
+
+def degenerate(rng, top=TOP):
+    a = rng.integers(0, top + 1, size=2)
+    b = np.clip(a + rng.integers(-(16 << 4), (16 << 4) + 1, size=2), 0, top)
+    c = [a, b, (a + b) // 2, 2 * b - a][int(rng.integers(4))]
+    return [clip(np.concatenate([a, b, c]), top)]
+
+
+def sliver(rng, top=TOP):
+    a = rng.integers(0, top + 1, size=2)
+    b = a + rng.integers(-(24 << 4), (24 << 4) + 1, size=2)
+    return [clip(np.concatenate([a, b, b + rng.integers(-8, 9, size=2)]), top)]
+
+
+# triangles wound the wrong way, which cover nothing, and are culled as such.
+def back_facing(rng, top=TOP):
+    ax, ay, bx, by, cx, cy = bench.wind(uniform(rng, top)[0])
+    return [[ax, ay, cx, cy, bx, by]]
+
+
+# triangles across an edge of bench.SCISSOR.
+def scissor_edge(rng, top=TOP):
+    low_x, low_y, high_x, high_y = bench.SCISSOR
+    x, y = rng.integers(low_x, high_x + 1), rng.integers(low_y, high_y + 1)
+    if rng.integers(2):
+        x = [low_x, high_x][int(rng.integers(2))]
+    else:
+        y = [low_y, high_y][int(rng.integers(2))]
+    return [triangle(rng, (x, y), int(rng.integers(1, 12 << 4)), top)]
+
+
+# small triangles at the very ends of the coordinate range.
+def extreme(rng, top=TOP):
+    corner = np.array([[0, 0], [top, 0], [0, top], [top, top]])[int(rng.integers(4))]
+    return [triangle(rng, corner, int(rng.integers(1, 4 << 4)), top)]
+
+
+GENERATORS = {
+    "uniform":     uniform,
+    "shared_edge": shared_edge,
+    "top_left":    top_left,
+    "degenerate":  degenerate,
+    "sliver":      sliver,
+    "extreme":     extreme,
+    "back_facing": back_facing,
+    "scissor":     scissor_edge,
+}
+
+
+# coordinates up to top that are likely to be trouble for TriangleSetup, for
+# setup cases: (ax, ay, bx, by, cx, cy, px, py), unwound.
+def awkward(top):
+    half = (top + 1) // 2
+    return [0, 1, 8, half - 8, half - 1, half, half + 1, top - 8, top]
+
+
+def setup_case(rng, generator, variant):
+    top = SetupTarget.top(variant)
+    if generator == "extreme":
+        return [int(v) for v in rng.choice(awkward(top), size=8)]
+    triangles = GENERATORS[generator](rng, top)
+    point = rng.integers(0, top + 1, size=2)
+    if rng.integers(2):
+        # on one of the triangle's own vertices, or the sample next to it.
+        point = np.array(triangles[0][:2]) + 8 * rng.integers(2)
+    return triangles[0] + clip(point, top)
+
+
+# denominators for ztransform cases: the ends of the range, powers of two and
+# their neighbours, and random values of random length.
+def ztransform_case(rng, generator, variant):
+    if generator in ("extreme", "top_left", "degenerate"):
+        k = int(rng.integers(32))
+        return [int(v) & 0xFFFFFFFF for v in [0, 1, 0xFFFFFFFF, (1 << k) - 1, 1 << k, (1 << k) + 1]][int(rng.integers(6))]
+    return int(rng.integers(1 << int(rng.integers(1, 33))))
+
+
+def render_case(rng, generator, variant):
+    top = bench.top(variant)
+    if generator == "back_facing":
+        return back_facing(rng, top)
+    return [bench.wind(t) for t in GENERATORS[generator](rng, top)]
+
+
+# t wound the same way as like, so that shrinking keeps a back-facing case so.
+def wind_as(t, like):
+    ax, ay, bx, by, cx, cy = bench.wind(t)
+    if golden.edge(*like) > 0:
+        return (ax, ay, cx, cy, bx, by)
+    return (ax, ay, bx, by, cx, cy)
+
+
+SETUP_VARIANTS = {
+    "serial":       dict(),
+    "serial1":      dict(stages=1),
+    "serial6":      dict(stages=6),
+    "parallel":     dict(parallel=True),
+    "parallel1":    dict(parallel=True, stages=1),
+    "parallel2":    dict(parallel=True, stages=2),
+    "parallel6":    dict(parallel=True, stages=6),
+    "q94":          dict(precision=dict(width=512, height=512, int_bits=9, edge_bits=25)),
+    "parallel_q94": dict(parallel=True, stages=2, precision=dict(width=512, height=512, int_bits=9, edge_bits=25)),
+    "strip":        dict(parallel=True, mode="strip"),
+    "strip_q94":    dict(parallel=True, stages=2, mode="strip",
+                         precision=dict(width=512, height=512, int_bits=9, edge_bits=25)),
+}
+
+ZTRANSFORM_VARIANTS = {
+    "nonrestoring": (NonRestoringReciprocal, dict()),
+    "radix4":       (NonRestoringReciprocal, dict(stage_bits=2)),
+    "stages12":     (NonRestoringReciprocal, dict(stages=12)),
+    "newton":       (NewtonReciprocal, dict()),
+    "newton3":      (NewtonReciprocal, dict(iterations=3)),
+    "newton_q94":   (NewtonReciprocal, dict(precision=dict(width=512, height=512, int_bits=9, edge_bits=25))),
+}
+
+SETUP_OUTPUTS = ["edge_ab", "edge_bc", "edge_ca", "tri_area",
+                 "edge_ab_dx", "edge_ab_dy", "edge_bc_dx", "edge_bc_dy", "edge_ca_dx", "edge_ca_dy",
+                 "edge_ab_frac", "edge_bc_frac", "edge_ca_frac"]
+
+
+# each target knows how to build its design, run a batch of cases through it,
+# and say which of them failed, and why. check() returns a list with a
+# description for each failing case, or None for each passing one.
+class RenderTarget:
+    variants = bench.VARIANTS
+    make     = staticmethod(render_case)
+
+    def __init__(self, variant):
+        self.variant = variant
+        self.reset()
+
+    def reset(self):
+        self.dut, self.lanes = bench.build(self.variant)
+        self.harness = Harness(self.dut)
+
+    def check(self, cases):
+        results = []
+        for case in cases:
+            try:
+                rows = bench.stream(self.harness, self.dut, self.lanes, case)
+            except RuntimeError as error:
+                # the pipeline is stuck; start the next case on a fresh one.
+                self.reset()
+                results.append(str(error))
+                continue
+            got, _ = bench.covered(self.dut, rows)
+            expected = bench.expected(self.dut, case)
+            culled   = bench.culled(self.dut, rows)
+            expected_culled = bench.expected_culled(self.dut, case)
+            if bench.mismatches(got, expected):
+                samples = getattr(self.dut, "samples", 1)
+                extra   = bench.unkey(np.setdiff1d(got, expected)[:4], samples)
+                missing = bench.unkey(np.setdiff1d(expected, got)[:4], samples)
+                results.append("{} fragments, expected {}; extra {}, missing {}".format(
+                    len(got), len(expected), extra, missing))
+            elif culled != expected_culled:
+                results.append("culled {}, expected {}".format(culled, expected_culled))
+            else:
+                results.append(None)
+        return results
+
+    # smaller cases: one triangle fewer, the same triangles moved toward the
+    # origin, or with a vertex pulled toward another, re-wound the way they
+    # were. smaller is by
+    # (bounding box area, coordinate sum).
+    @staticmethod
+    def candidates(case):
+        if len(case) > 1:
+            for n in range(len(case)):
+                yield case[:n] + case[n + 1:]
+        for axis in (0, 1):
+            low = min(t[i] for t in case for i in range(axis, 6, 2))
+            for step in (low, low // 2, 16, 1):
+                if 0 < step <= low:
+                    yield [wind_as([v - step if i % 2 == axis else v for i, v in enumerate(t)], t) for t in case]
+        for n, t in enumerate(case):
+            for i in range(6):
+                for j in range(i % 2, 6, 2):
+                    if t[i] != t[j]:
+                        moved = list(t)
+                        moved[i] = t[i] + (t[j] - t[i]) // 2 if abs(t[j] - t[i]) > 1 else t[j]
+                        yield case[:n] + [wind_as(moved, t)] + case[n + 1:]
+
+    @staticmethod
+    def metric(case):
+        area = sum((max(t[0::2]) - min(t[0::2])) * (max(t[1::2]) - min(t[1::2])) for t in case)
+        return (area, sum(map(sum, case)))
+
+
+class SetupTarget:
+    variants = SETUP_VARIANTS
+    make     = staticmethod(setup_case)
+
+    def __init__(self, variant):
+        config = SETUP_VARIANTS[variant]
+        if "precision" in config:
+            config = dict(config, precision=Precision(**config["precision"]))
+        self.dut     = TriangleSetup(**config)
+        self.harness = Harness(self.dut)
+
+    # the largest coordinate on a variant's screen.
+    @staticmethod
+    def top(variant):
+        config = SETUP_VARIANTS[variant]
+        if "precision" not in config:
+            return TOP
+        precision = Precision(**config["precision"])
+        return min(precision.max_x, precision.max_y)
+
+    def check(self, cases):
+        dut = self.dut
+        v   = np.array(cases, dtype=np.int64).reshape(-1, 8)
+        rows = self.harness.run([
+            (dut.i_tri_xy_a, golden.join_xy(v[:, 0], v[:, 1])),
+            (dut.i_tri_xy_b, golden.join_xy(v[:, 2], v[:, 3])),
+            (dut.i_tri_xy_c, golden.join_xy(v[:, 4], v[:, 5])),
+            (dut.i_point,    golden.join_xy(v[:, 6], v[:, 7])),
+        ], [dut.o_valid] + [getattr(dut, "o_" + name) for name in SETUP_OUTPUTS],
+           cycles=len(cases) * (dut.latency + 2) + 8, valid=dut.i_start, ready=dut.o_ready)
+        got = rows[rows[:, 0] == 1, 1:]
+
+        expected = golden.setup(*v.T)
+        results = []
+        for n in range(len(cases)):
+            if n >= len(got):
+                results.append("no result")
+                continue
+            wrong = ["{} {:#x}, expected {:#x}".format(name, int(got[n, k]), int(golden.wrap(
+                     expected[name][n], len(getattr(dut, "o_" + name)), signed=False)))
+                     for k, name in enumerate(SETUP_OUTPUTS)
+                     if got[n, k] != golden.wrap(expected[name][n], len(getattr(dut, "o_" + name)), signed=False)]
+            results.append("; ".join(wrong) or None)
+        return results
+
+    # each coordinate less a power of two, by (coordinate sum, coordinates).
+    @staticmethod
+    def candidates(case):
+        for i, value in enumerate(case):
+            for k in range(16):
+                if value >= 1 << k:
+                    yield case[:i] + [value - (1 << k)] + case[i + 1:]
+
+    @staticmethod
+    def metric(case):
+        return (sum(case), case)
+
+
+class ZTransformTarget:
+    variants = ZTRANSFORM_VARIANTS
+    make     = staticmethod(ztransform_case)
+
+    def __init__(self, variant):
+        reciprocal, config = ZTRANSFORM_VARIANTS[variant]
+        precision = config.get("precision")
+        if precision is not None:
+            precision = Precision(**precision)
+        engine = reciprocal(**{name: value for name, value in config.items() if name != "precision"})
+        self.dut     = FragmentZTransform(engine, precision=precision)
+        self.harness = Harness(self.dut)
+
+    # fragments go in with a gap after every third, and carry their index as
+    # their position and edge functions, which have to come out alongside z.
+    def check(self, cases):
+        dut = self.dut
+        slots = []
+        for n in range(len(cases)):
+            slots.append(n)
+            if n % 3 == 2:
+                slots.append(-1)
+        slots = np.array(slots + [-1] * dut.latency)
+        valid = slots >= 0
+        wz    = np.where(valid, np.array(cases, dtype=np.int64)[np.maximum(slots, 0)], 0)
+        rows = self.harness.run([
+            (dut.i_valid,   valid),
+            (dut.i_pnt_xy,  np.maximum(slots, 0)),
+            (dut.i_pnt_wz,  wz),
+            (dut.i_edge_ab, np.maximum(slots, 0)),
+        ], [dut.o_valid, dut.o_pnt_xy, dut.o_pnt_z, dut.o_edge_ab])[dut.latency:]
+
+        results = [None] * len(cases)
+        for n, (slot, row) in enumerate(zip(slots, rows)):
+            got = [int(v) for v in row]
+            if slot < 0:
+                if got[0]:
+                    # a bubble came out valid; blame the fragment before it.
+                    results[int(slots[:n].max(initial=0))] = "valid set for the bubble after it"
+                continue
+            want = [1, int(slot), int(golden.reciprocal(wz[n])), int(slot)]
+            if got != want:
+                results[slot] = "valid, xy, z, edge {}, expected {}".format(got, want)
+        return results
+
+    # the denominator less a power of two, or shifted down.
+    @staticmethod
+    def candidates(case):
+        yield case >> 1
+        for k in range(32):
+            if case >= 1 << k:
+                yield case - (1 << k)
+
+    @staticmethod
+    def metric(case):
+        return case
+
+
+TARGETS = {
+    "render":     RenderTarget,
+    "setup":      SetupTarget,
+    "ztransform": ZTransformTarget,
+}
+
+
+# the smallest case reachable from case by taking smaller candidates that still
+# fail, one at a time, or case itself. each attempt goes through the shard's
+# own target, and is therefore isolated from the others as check() allows.
+def shrink(target, case, attempts=256):
+    best = case
+    while attempts > 0:
+        for candidate in sorted(target.candidates(best), key=target.metric):
+            if target.metric(candidate) >= target.metric(best):
+                continue
+            attempts -= 1
+            if target.check([candidate])[0] is not None:
+                best = candidate
+                break
+            if attempts <= 0:
+                break
+        else:
+            break
+    return best
+
+
+# one shard: `count` cases from each generator, seeded by (seed, shard).
+def run_shard(target_name, variant, generators, count, seed, shard):
+    cls = TARGETS[target_name]
+    rng = np.random.default_rng([seed, shard])
+    cases = [(generator, cls.make(rng, generator, variant)) for generator in generators for _ in range(count)]
+
+    start = time.perf_counter()
+    target = cls(variant)
+    results = target.check([case for _, case in cases])
+
+    failures = []
+    for (generator, case), result in zip(cases, results):
+        if result is None:
+            continue
+        # confirm it on its own, on a fresh design, before shrinking it.
+        target = cls(variant)
+        alone = target.check([case])[0]
+        reproducer = shrink(target, case) if alone is not None else case
+        failures.append({
+            "generator":  generator,
+            "case":       case,
+            "error":      result,
+            "alone":      alone is not None,
+            "reproducer": reproducer,
+            "reproduced": target.check([reproducer])[0],
+        })
+    return {"cases": len(cases), "failures": failures, "wall_seconds": time.perf_counter() - start}
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Fuzz the rasteriser against the golden model.")
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=list(TARGETS))
+    parser.add_argument("--variants", nargs="+", help="variants to fuzz, of any target (default: all)")
+    parser.add_argument("--generators", nargs="+", choices=GENERATORS, default=list(GENERATORS))
+    parser.add_argument("--count", type=int, default=4, help="cases per generator per shard")
+    parser.add_argument("--shards", type=int, default=4, help="shards per variant")
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="-", help="JSON output file, or - for stdout")
+    args = parser.parse_args()
+
+    jobs = []
+    for target in args.targets:
+        for variant in TARGETS[target].variants:
+            if args.variants is None or variant in args.variants:
+                jobs += [(target, variant, args.generators, args.count, args.seed, shard)
+                         for shard in range(args.shards)]
+
+    results = {"count": args.count, "shards": args.shards, "seed": args.seed, "targets": {}}
+    with ProcessPoolExecutor(args.jobs) as pool:
+        for job, shard in zip(jobs, pool.map(run_shard, *zip(*jobs))):
+            target, variant = job[:2]
+            merged = results["targets"].setdefault(target, {}).setdefault(
+                variant, {"cases": 0, "failures": [], "wall_seconds": 0.0})
+            merged["cases"] += shard["cases"]
+            merged["failures"] += shard["failures"]
+            merged["wall_seconds"] += shard["wall_seconds"]
+
+    failed = 0
+    for target, variants in results["targets"].items():
+        for variant, merged in variants.items():
+            failed += len(merged["failures"])
+            print("{:>10} {:>12}: {} cases, {} failures".format(
+                  target, variant, merged["cases"], len(merged["failures"])), file=sys.stderr)
+            for failure in merged["failures"]:
+                print("{:>24} {}: {} -> {}: {}".format("", failure["generator"], failure["case"],
+                      failure["reproducer"], failure["reproduced"] or failure["error"]), file=sys.stderr)
+
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,231 @@
+import numpy as np
+
+# a bit-exact model of the rasteriser hardware, in NumPy, for checking the
+# hardware against whole frames and batches of triangles rather than pixel by
+# pixel in Python.
+#
+# every function takes scalars or arrays, and broadcasts them against each
+# other the way NumPy does; a batch of triangles against a pixel grid is just a
+# (n, 1, 1) shaped set of vertices against (height, width) shaped points.
+# coordinates are raw Q12.4 values, as on the hardware's 16-bit ports, and edge
+# functions are raw Q24.4 values, as on its signed 32-bit ports.
+
+
+def wrap(value, bits, signed=True):
+    value = np.asarray(value, dtype=np.int64)
+    if signed:
+        half = 1 << (bits - 1)
+        return ((value + half) & ((1 << bits) - 1)) - half
+    return value & ((1 << bits) - 1)
+
+
+def split_xy(xy):
+    xy = np.asarray(xy, dtype=np.int64)
+    return xy & 0xFFFF, (xy >> 16) & 0xFFFF
+
+
+def join_xy(x, y):
+    return (wrap(x, 16, signed=False) | (wrap(y, 16, signed=False) << 16))
+
+
+# EdgeFunction: edge(A, B, P), less one unit if AB is a top or left edge. with
+# 16-bit inputs the result always fits in 31 bits, so nothing needs wrapping.
+def edge(ax, ay, bx, by, px, py):
+    ax, ay, bx, by, px, py = (wrap(v, 16, signed=False) for v in (ax, ay, bx, by, px, py))
+    adjustment = (ax < bx) | ((ax == bx) & (by < ay))
+    return (((px - ax) * (by - ay) - (py - ay) * (bx - ax)) >> 4) - adjustment
+
+
+# EdgeFunction's o_frac: the four bits of edge(A, B, P) below its Q24.4 result.
+def edge_frac(ax, ay, bx, by, px, py):
+    ax, ay, bx, by, px, py = (wrap(v, 16, signed=False) for v in (ax, ay, bx, by, px, py))
+    return ((px - ax) * (by - ay) - (py - ay) * (bx - ax)) & 0xF
+
+
+# TriangleSetup, for triangle ABC and point P. the deltas are 17 bits, which
+# hold the difference of any two coordinates.
+def setup(ax, ay, bx, by, cx, cy, px, py):
+    return {
+        "edge_ab":    edge(ax, ay, bx, by, px, py),
+        "edge_bc":    edge(bx, by, cx, cy, px, py),
+        "edge_ca":    edge(cx, cy, ax, ay, px, py),
+        "tri_area":   edge(ax, ay, bx, by, cx, cy),
+        "edge_ab_dx": wrap(np.asarray(by) - ay, 17),
+        "edge_ab_dy": wrap(np.asarray(ax) - bx, 17),
+        "edge_bc_dx": wrap(np.asarray(cy) - by, 17),
+        "edge_bc_dy": wrap(np.asarray(bx) - cx, 17),
+        "edge_ca_dx": wrap(np.asarray(ay) - cy, 17),
+        "edge_ca_dy": wrap(np.asarray(cx) - ax, 17),
+        "edge_ab_frac": edge_frac(ax, ay, bx, by, px, py),
+        "edge_bc_frac": edge_frac(bx, by, cx, cy, px, py),
+        "edge_ca_frac": edge_frac(cx, cy, ax, ay, px, py),
+    }
+
+
+# FragmentInTriangleTest: P is covered if all three edge functions are negative.
+def coverage(ax, ay, bx, by, cx, cy, px, py):
+    px, py = wrap(px, 16, signed=False), wrap(py, 16, signed=False)
+    return ((edge(ax, ay, bx, by, px, py) < 0) &
+            (edge(bx, by, cx, cy, px, py) < 0) &
+            (edge(cx, cy, ax, ay, px, py) < 0))
+
+
+# sample points of a width x height frame, offset from each pixel's top-left
+# corner by `offset` (8 being the pixel centre).
+def pixel_grid(width=512, height=512, offset=0):
+    y, x = np.mgrid[0:height, 0:width].astype(np.int64)
+    return (x << 4) + offset, (y << 4) + offset
+
+
+# the samples TriangleRender visits when started at the bounding box corner,
+# as RasterPipeline does: every (min + 0.5 + i, min + 0.5 + j) up to the
+# maximum, and within scissor = (min_x, min_y, max_x, max_y), inclusive, if
+# given. returns the covered sample points, in raster order.
+def rasterise(ax, ay, bx, by, cx, cy, scissor=None):
+    min_x, max_x = min(ax, bx, cx), max(ax, bx, cx)
+    min_y, max_y = min(ay, by, cy), max(ay, by, cy)
+    y, x = np.mgrid[min_y + 8:max_y + 1:16, min_x + 8:max_x + 1:16].astype(np.int64)
+    covered = coverage(ax, ay, bx, by, cx, cy, x, y)
+    if scissor is not None:
+        covered &= (x >= scissor[0]) & (y >= scissor[1]) & (x <= scissor[2]) & (y <= scissor[3])
+    return x[covered], y[covered]
+
+
+# the sample patterns of TriangleRender's multisampling, as in gpu.py.
+SAMPLE_PATTERNS = {
+    1: [(0, 0)],
+    2: [(4, 4), (-4, -4)],
+    4: [(-2, -6), (6, -2), (-6, 2), (2, 6)],
+}
+
+
+# rasterise() with `samples` samples per pixel, at the offsets in
+# SAMPLE_PATTERNS from the sample rasterise() would test. the pixels run on past
+# the bounding box by as far as the samples reach, so that every sample in it
+# is tested, though not past the end of the coordinate range. returns the
+# pixels with any sample covered, in raster order, and their coverage masks,
+# with bit k set if sample k is covered.
+def multisample(ax, ay, bx, by, cx, cy, samples):
+    pattern = SAMPLE_PATTERNS[samples]
+    reach   = max(max(ox, oy) for ox, oy in pattern)
+    min_x, max_x = min(ax, bx, cx), min(max(ax, bx, cx) + reach, 0xFFFF)
+    min_y, max_y = min(ay, by, cy), min(max(ay, by, cy) + reach, 0xFFFF)
+    y, x = np.mgrid[min_y + 8:max_y + 1:16, min_x + 8:max_x + 1:16].astype(np.int64)
+    mask = sum(coverage(ax, ay, bx, by, cx, cy, x + ox, y + oy).astype(np.int64) << k
+               for k, (ox, oy) in enumerate(pattern))
+    covered = mask != 0
+    return x[covered], y[covered], mask[covered]
+
+
+# the reason RasterPipeline's cull stage drops a triangle, if it does, or None.
+def cull(ax, ay, bx, by, cx, cy, scissor=None):
+    low_x, low_y, high_x, high_y = scissor if scissor is not None else (0, 0, 0xFFFF, 0xFFFF)
+    first_x = min(ax, bx, cx) + 8
+    first_y = min(ay, by, cy) + 8
+    first_x += max(0, low_x - first_x + 15) & ~15
+    first_y += max(0, low_y - first_y + 15) & ~15
+    if first_x > min(max(ax, bx, cx), high_x) or first_y > min(max(ay, by, cy), high_y):
+        return "outside"
+    area = int(edge(ax, ay, bx, by, cx, cy)) + int((ax < bx) or (ax == bx and by < ay))
+    if area > 0:
+        return "back_facing"
+    if area == 0:
+        return "zero_area"
+    return None
+
+
+# coverage of a list of (ax, ay, bx, by, cx, cy) triangles over a frame, as the
+# index of the last triangle covering each sample, or -1. each triangle is only
+# tested over its bounding box.
+def frame(triangles, width=512, height=512, offset=0):
+    px, py = pixel_grid(width, height, offset)
+    result = np.full((height, width), -1, dtype=np.int64)
+    for index, (ax, ay, bx, by, cx, cy) in enumerate(triangles):
+        x0 = max(0, (min(ax, bx, cx) - offset) >> 4)
+        y0 = max(0, (min(ay, by, cy) - offset) >> 4)
+        x1 = min(width, ((max(ax, bx, cx) - offset) >> 4) + 1)
+        y1 = min(height, ((max(ay, by, cy) - offset) >> 4) + 1)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        covered = coverage(ax, ay, bx, by, cx, cy, px[y0:y1, x0:x1], py[y0:y1, x0:x1])
+        result[y0:y1, x0:x1][covered] = index
+    return result
+
+
+# the reciprocal engines, and so FragmentZTransform's o_pnt_z: floor(2**31 / d),
+# or 0xFFFFFFFF for d == 0.
+def reciprocal(d):
+    d = wrap(d, 32, signed=False)
+    return np.where(d == 0, 0xFFFFFFFF, (1 << 31) // np.maximum(d, 1))
+
+
+# PlaneSetup, for one triangle: the (value, dx, dy) planes in Q8.24 for each
+# channel of the Q8.8 vertex attributes a, b and c, given TriangleSetup's
+# results as returned by setup(). the products here outgrow 64 bits, so this
+# is done per triangle in Python integers.
+def plane_setup(tri_setup, a, b, c):
+    area = int(tri_setup["tri_area"])
+    magnitude = abs(area) & 0xFFFFFFFF
+    lz = 32 - magnitude.bit_length() if magnitude else 0
+    recip = ((1 << 63) - 1) // (magnitude << lz) if magnitude else 0xFFFFFFFF
+
+    planes = []
+    for a_k, b_k, c_k in zip(a, b, c):
+        for suffix in ("", "_dx", "_dy"):
+            dot = (a_k * int(tri_setup["edge_bc" + suffix]) + b_k * int(tri_setup["edge_ca" + suffix]) +
+                   c_k * int(tri_setup["edge_ab" + suffix]))
+            if area < 0:
+                dot = -dot
+            planes.append(int(wrap((dot * recip) >> (47 - lz), 32)))
+    return [tuple(planes[k:k + 3]) for k in range(0, len(planes), 3)]
+
+
+# DepthTest, for a stream of fragments at Q12.4 points (x, y) with depths z,
+# against a cleared width x height depth buffer: whether each one passes, that
+# is, is in frame and nearer (greater) than every earlier fragment at its pixel.
+def depth_test(x, y, z, width=512, height=512):
+    px = np.asarray(x, dtype=np.int64) >> 4
+    py = np.asarray(y, dtype=np.int64) >> 4
+    z  = wrap(z, 32, signed=False)
+    in_frame = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+
+    # a running maximum of each pixel's depths, done for every pixel at once
+    # by sorting the fragments by pixel and lifting each pixel clear of the
+    # last, so that the maximum never carries over between pixels.
+    pixel  = np.where(in_frame, py * width + px, -1)
+    order  = np.argsort(pixel, kind="stable")
+    _, group = np.unique(pixel[order], return_inverse=True)
+    lifted = (group << 33) + z[order]
+    before = np.maximum(np.concatenate([[-1], np.maximum.accumulate(lifted)[:-1]]), group << 33)
+
+    passed = np.empty(len(order), dtype=bool)
+    passed[order] = lifted > before
+    return passed & in_frame
+
+
+# TriangleRender's o_plane: a plane stepped from (x0, y0) to the sample (x, y).
+def plane_value(value, dx, dy, x0, y0, x, y):
+    i = (np.asarray(x, dtype=np.int64) - x0) >> 4
+    j = (np.asarray(y, dtype=np.int64) - y0) >> 4
+    return wrap(value + i * dx + j * dy, 32)
+
+
+if __name__ == "__main__":
+    import time
+
+    a_x, a_y = 0x0949, 0x0449
+    b_x, b_y = 0x1EB6, 0x19B6
+    c_x, c_y = 0x0949, 0x19B6
+
+    start = time.perf_counter()
+    px, py = pixel_grid()
+    covered = coverage(a_x, a_y, b_x, b_y, c_x, c_y, px, py)
+    print("512x512 coverage: {} pixels in {:.1f} ms".format(
+          covered.sum(), (time.perf_counter() - start) * 1e3))
+
+    start = time.perf_counter()
+    rng = np.random.default_rng(0)
+    triangles = rng.integers(0, 512 << 4, size=(100, 6))
+    covered = frame(triangles)
+    print("512x512 frame of {} triangles: {} pixels in {:.1f} ms".format(
+          len(triangles), (covered >= 0).sum(), (time.perf_counter() - start) * 1e3))
@@ -1,5 +1,7 @@
 from amaranth import *
 
+from precision import Precision
+
 # a rough guide to triangle setup:
 #
 # take a triangle ABC formed of lines AB, BC, and CA:
@@ -85,10 +87,188 @@ from amaranth import *
 #
 # o_xy: ((min(A.y, B.y, C.y) + 0.5) << 16) | (min(A.x, B.x, C.x) + 0.5)
 # i_run: 1
+#
+# TriangleRender can also test a block of lanes_x by lanes_y pixels per clock
+# (a 2x2 "quad" being the usual choice). setup is exactly the same as above;
+# o_xy is then the origin (top-left pixel) of the block, and bit
+# (j * lanes_x + i) of o_mask is set if pixel (x + i, y + j) is covered:
+#
+#   +---+---+
+#   | 0 | 1 |   o_xy points at lane 0; the edge values for the other lanes
+#   +---+---+   are found by adding multiples of dx and dy to the origin's.
+#   | 2 | 3 |
+#   +---+---+
+#
+# the serpentine walk then moves lanes_x pixels per step along a row, and
+# lanes_y rows per row change. o_valid is set if any lane is covered. lanes
+# past the right or bottom of the bounding box, where the last block overhangs
+# it, are never covered.
+#
+# with tile set, the walk instead moves over tile x tile pixel squares, which
+# are classified in one cycle from the edge values at their corners:
+#
+# - tiles entirely outside the triangle produce a single cycle of o_valid == 0.
+# - tiles entirely inside the triangle produce a single cycle with o_full set;
+#   o_xy is then the tile origin and every pixel of the tile is covered.
+# - tiles on the boundary of the triangle are scanned one lane block at a time
+#   as above, in a serpentine of their own from the tile origin, skipping the
+#   blocks past the bounding box that the untiled walk would never reach.
+#
+# o_cycles_saved counts the cycles the tiled walk has saved against the untiled
+# walk of the same lane block over the same bounding boxes. a scanned tile
+# costs what the untiled walk spends on it, so the count only ever goes up. it
+# accumulates over every triangle walked and is only cleared by reset; the
+# saving for a single triangle is the difference across its walk.
+#
+# with full_tiles cleared, tiles entirely inside the triangle are scanned like
+# those on its boundary, for consumers that take a pixel at a time.
+#
+# with occlusion set, the tiled walk also skips tiles hidden behind what has
+# already been drawn, as told by the coarse buffer of a DepthTest (gpu2.py)
+# with its query size set to the tile. each triangle then comes with
+# i_z_near, the nearest depth any of its fragments can have, as DepthTest has
+# depths. the walk asks about a tile a cycle before it gets there, with the
+# tile's origin on o_query_xy and the triangle's i_z_near on o_query_z, for
+# DepthTest's i_query_xy and i_query_z; its o_query_occluded comes back on
+# i_occluded. a tile found occluded takes a single cycle with o_occluded set
+# and o_valid clear, like one outside the triangle, and counts towards
+# o_cycles_saved likewise. the tile asked about is the one the walk moves to
+# if it leaves the current one in a cycle, which is where it goes after a
+# scan too, so the tile after a scanned one is asked about in the scan's last
+# cycle; a triangle's first tile is asked about in the cycle it is loaded.
+#
+# rather than being written directly, the setup values can also be offered on
+# the i_next_* inputs, with i_next_valid/o_next_ready as a valid/ready
+# handshake. TriangleRender keeps a shadow copy of one such triangle, and moves
+# it into the walk in the same cycle the current walk ends, so back-to-back
+# triangles follow each other without an idle cycle in between:
+#
+# i_next_xy:                 initial o_xy
+# i_next_start_x..stop_y:    i_start_x..i_stop_y
+# i_next_edge_ab..ca:        i_edge_ab..ca
+# i_next_edge_ab_dx..ca_dx:  i_edge_ab_pdx..ca_pdx (mdx is the negation)
+# i_next_edge_ab_dy..ca_dy:  i_edge_ab_dy..ca_dy
+# i_next_z_near:             i_z_near, with occlusion set
+#
+# o_busy is set while a triangle is being walked or held in the shadow copy.
+#
+# TriangleRender can also interpolate `planes` attributes, each of which is a
+# linear function of the pixel position just like the edge functions are, and
+# is stepped along the walk by the same adders. their setup, typically from
+# PlaneSetup in gpu2.py, is:
+#
+# i_plane[k]:      value at P
+# i_plane_pdx[k]:  change in value per pixel in x
+# i_plane_mdx[k]:  -i_plane_pdx[k]
+# i_plane_dy[k]:   change in value per pixel in y
+#
+# or the same through i_next_plane[k], i_next_plane_dx[k] and i_next_plane_dy[k].
+# o_plane[k][j * lanes_x + i] is then the value at pixel (x + i, y + j). the
+# values wrap around on overflow, which is harmless as long as they fit at the
+# covered pixels, since only additions and subtractions are involved.
+#
+# with span set (for a single lane, untiled walk only), each row is walked as
+# a span rather than across the whole bounding box. the covered samples of a
+# row are contiguous, and an edge function that is non-negative, and does not
+# decrease in the direction of the walk, stays non-negative for the rest of
+# the row; so the walk leaves a row as soon as one of its edges says so,
+# rather than at the bounding box:
+#
+# - a row is entered at the sample below the last one walked on the row
+#   above, and walked in the opposite direction to that row.
+# - it is walked from there until an edge says the span has been left, or the
+#   bounding box is reached.
+# - it is then walked the other way, from the sample beside the entry point,
+#   unless an edge already says there is nothing covered that way.
+# - the walk then moves on to the next row.
+#
+# this finds the row's span by walking into it rather than by working out the
+# x intercepts of the edges, which would need a divider per edge. each covered
+# sample is still visited exactly once, and a row costs its span plus up to
+# three samples, so a long thin triangle costs roughly its pixel count in
+# cycles rather than its bounding box area. the walk also never leaves the
+# bounding box, unlike the diagonal turn of the serpentine walk.
+#
+# with samples set to 2 or 4 (for untiled, non-span walks), every pixel is
+# tested at that many sample points in the same cycle, at fixed offsets from
+# the point the walk is at, in sixteenths of a pixel:
+#
+#   2x: (4, 4), (-4, -4)
+#   4x: (-2, -6), (6, -2), (-6, 2), (2, 6)
+#
+# moving the point of an edge function by (ox, oy) adds ox * dx + oy * dy to
+# it before the shift down to Q24.4 that the edge function inputs have had, so
+# to get the same result as evaluating the edge at the sample exactly, the
+# four bits that shift dropped are needed too. those are the same at every
+# point of the walk, since it moves in whole pixels:
+#
+# i_edge_ab_frac..ca_frac:  the four bits of the edge functions at P below
+#                           their Q24.4 values (TriangleSetup's o_edge_*_frac)
+#
+# or the same through i_next_edge_ab_frac..ca_frac. bit (lane * samples + k)
+# of o_coverage is then set if sample k of that lane's pixel is covered, and
+# a lane's o_mask bit if any of its samples are. since samples reach past the
+# pixel's own point, the bounding box should be extended right and down by 6
+# sixteenths (4 for 2x), so that the walk visits every pixel with a covered
+# sample.
+#
+# the fixed-point formats above are those of the default `precision`. with a
+# precision.Precision given, positions are in its format (still in the 16-bit
+# halves of the xy ports, and the 16-bit bounding box inputs), the walk steps
+# one pixel at a time in it, and the edge functions and their accumulators are
+# its edge_bits wide, the deltas its delta_bits. a precision whose edge
+# functions could overflow somewhere along the walk is refused with a
+# ValueError; multisampling needs the default 4 fractional bits, since the
+# sample patterns are in sixteenths.
+
+SAMPLE_PATTERNS = {
+    1: [(0, 0)],
+    2: [(4, 4), (-4, -4)],
+    4: [(-2, -6), (6, -2), (-6, 2), (2, 6)],
+}
 
 
 class TriangleRender(Elaboratable):
-    def __init__(self):
+    def __init__(self, lanes_x=1, lanes_y=1, tile=None, planes=0, span=False, samples=1, precision=None,
+                 full_tiles=True, occlusion=False):
+        if precision is None:
+            precision = Precision()
+        if lanes_x < 1 or lanes_y < 1:
+            raise ValueError("TriangleRender needs at least one lane in each direction, not {}x{}"
+                             .format(lanes_x, lanes_y))
+        if tile is not None and (tile % lanes_x or tile % lanes_y or tile * tile == lanes_x * lanes_y):
+            raise ValueError("Tile size {} must be a multiple of, and larger than, the {}x{} lane block"
+                             .format(tile, lanes_x, lanes_y))
+        if span and (lanes_x != 1 or lanes_y != 1 or tile is not None):
+            raise ValueError("Span traversal needs a single lane, untiled walk, not {}x{} lanes with tile {}"
+                             .format(lanes_x, lanes_y, tile))
+        if samples not in SAMPLE_PATTERNS:
+            raise ValueError("Sample count must be one of {}, not {}".format(sorted(SAMPLE_PATTERNS), samples))
+        if samples > 1 and (tile is not None or span):
+            raise ValueError("Multisampling is not supported with tiled or span traversal")
+        if occlusion and tile is None:
+            raise ValueError("Occlusion queries need a tiled walk")
+        if samples > 1 and precision.frac_bits != 4:
+            raise ValueError("Multisampling needs coordinates with 4 fractional bits, not {}"
+                             .format(precision.frac_bits))
+        # the walk steps the edge functions up to two tiles or lane blocks past
+        # the bounding box before it stops.
+        precision.check(2 * max(tile or 1, lanes_x, lanes_y) + 1, "TriangleRender")
+
+        self.lanes_x = lanes_x
+        self.lanes_y = lanes_y
+        self.tile    = tile
+        self.planes  = planes
+        self.span    = span
+        self.samples = samples
+        self.precision = precision
+        self.full_tiles = full_tiles
+        self.occlusion  = occlusion
+
+        edge_bits  = precision.edge_bits
+        delta_bits = precision.delta_bits
+        frac_bits  = precision.frac_bits
+
         self.i_xy_a  = Signal(32)
         self.i_xy_b  = Signal(32)
         self.i_xy_c  = Signal(32)
@@ -98,58 +278,480 @@ class TriangleRender(Elaboratable):
         self.i_stop_x  = Signal(16)
         self.i_stop_y  = Signal(16)
 
-        self.i_edge_ab = Signal(signed(32))
-        self.i_edge_bc = Signal(signed(32))
-        self.i_edge_ca = Signal(signed(32))
+        self.i_edge_ab = Signal(signed(edge_bits))
+        self.i_edge_bc = Signal(signed(edge_bits))
+        self.i_edge_ca = Signal(signed(edge_bits))
 
-        self.i_edge_ab_pdx = Signal(signed(16))
-        self.i_edge_ab_mdx = Signal(signed(16))
-        self.i_edge_ab_dy = Signal(signed(16))
-        self.i_edge_bc_pdx = Signal(signed(16))
-        self.i_edge_bc_mdx = Signal(signed(16))
-        self.i_edge_bc_dy = Signal(signed(16))
-        self.i_edge_ca_pdx = Signal(signed(16))
-        self.i_edge_ca_mdx = Signal(signed(16))
-        self.i_edge_ca_dy = Signal(signed(16))
+        self.i_edge_ab_pdx = Signal(signed(delta_bits))
+        self.i_edge_ab_mdx = Signal(signed(delta_bits))
+        self.i_edge_ab_dy = Signal(signed(delta_bits))
+        self.i_edge_bc_pdx = Signal(signed(delta_bits))
+        self.i_edge_bc_mdx = Signal(signed(delta_bits))
+        self.i_edge_bc_dy = Signal(signed(delta_bits))
+        self.i_edge_ca_pdx = Signal(signed(delta_bits))
+        self.i_edge_ca_mdx = Signal(signed(delta_bits))
+        self.i_edge_ca_dy = Signal(signed(delta_bits))
+
+        self.i_edge_ab_frac = Signal(frac_bits)
+        self.i_edge_bc_frac = Signal(frac_bits)
+        self.i_edge_ca_frac = Signal(frac_bits)
+
+        self.i_plane     = [Signal(signed(32), name="i_plane{}".format(k)) for k in range(planes)]
+        self.i_plane_pdx = [Signal(signed(32), name="i_plane{}_pdx".format(k)) for k in range(planes)]
+        self.i_plane_mdx = [Signal(signed(32), name="i_plane{}_mdx".format(k)) for k in range(planes)]
+        self.i_plane_dy  = [Signal(signed(32), name="i_plane{}_dy".format(k)) for k in range(planes)]
+
+        self.i_z_near = Signal(32)
 
         self.i_run   = Signal()
 
+        self.i_next_xy      = Signal(32)
+        self.i_next_start_x = Signal(16)
+        self.i_next_start_y = Signal(16)
+        self.i_next_stop_x  = Signal(16)
+        self.i_next_stop_y  = Signal(16)
+
+        self.i_next_edge_ab = Signal(signed(edge_bits))
+        self.i_next_edge_bc = Signal(signed(edge_bits))
+        self.i_next_edge_ca = Signal(signed(edge_bits))
+
+        self.i_next_edge_ab_dx = Signal(signed(delta_bits))
+        self.i_next_edge_ab_dy = Signal(signed(delta_bits))
+        self.i_next_edge_bc_dx = Signal(signed(delta_bits))
+        self.i_next_edge_bc_dy = Signal(signed(delta_bits))
+        self.i_next_edge_ca_dx = Signal(signed(delta_bits))
+        self.i_next_edge_ca_dy = Signal(signed(delta_bits))
+
+        self.i_next_edge_ab_frac = Signal(frac_bits)
+        self.i_next_edge_bc_frac = Signal(frac_bits)
+        self.i_next_edge_ca_frac = Signal(frac_bits)
+
+        self.i_next_plane    = [Signal(signed(32), name="i_next_plane{}".format(k)) for k in range(planes)]
+        self.i_next_plane_dx = [Signal(signed(32), name="i_next_plane{}_dx".format(k)) for k in range(planes)]
+        self.i_next_plane_dy = [Signal(signed(32), name="i_next_plane{}_dy".format(k)) for k in range(planes)]
+
+        self.i_next_z_near = Signal(32)
+
+        self.i_next_valid = Signal()
+        self.o_next_ready = Signal()
+        self.o_busy       = Signal()
+
         self.o_xy    = Signal(32)
+        self.o_mask  = Signal(lanes_x * lanes_y)
         self.o_valid = Signal()
+        self.o_full  = Signal()
+        self.o_coverage = Signal(lanes_x * lanes_y * samples)
+        self.o_plane = [[Signal(signed(32), name="o_plane{}_{}".format(k, lane)) for lane in range(lanes_x * lanes_y)]
+                        for k in range(planes)]
+
+        self.o_cycles_saved = Signal(32)
+
+        self.o_query_xy = Signal(32)
+        self.o_query_z  = Signal(32)
+        self.i_occluded = Signal()
+        self.o_occluded = Signal()
 
     def elaborate(self, platform):
         m = Module()
 
-        # 12.4 fixed-point
+        frac_bits = self.precision.frac_bits
+
+        # fixed-point, 12.4 by default
         a_x, a_y = self.i_xy_a[:16], self.i_xy_a[16:]
         b_x, b_y = self.i_xy_b[:16], self.i_xy_b[16:]
         c_x, c_y = self.i_xy_c[:16], self.i_xy_c[16:]
         x, y     = self.o_xy[:16], self.o_xy[16:]
-        x_pinc   = Signal(signed(16), reset=(1 << 4))
-        x_minc   = Signal(signed(16), reset=-(1 << 4))
+        x_pinc   = Signal(signed(16), reset=(1 << frac_bits))
+        x_minc   = Signal(signed(16), reset=-(1 << frac_bits))
 
-        m.d.comb += self.o_valid.eq((self.i_edge_ab < 0) & (self.i_edge_bc < 0) & (self.i_edge_ca < 0))
+        # everything the walk steps, as (value, pdx, mdx, dy): the three edge
+        # functions, then the attribute planes.
+        linear = [
+            (self.i_edge_ab, self.i_edge_ab_pdx, self.i_edge_ab_mdx, self.i_edge_ab_dy),
+            (self.i_edge_bc, self.i_edge_bc_pdx, self.i_edge_bc_mdx, self.i_edge_bc_dy),
+            (self.i_edge_ca, self.i_edge_ca_pdx, self.i_edge_ca_mdx, self.i_edge_ca_dy),
+        ]
+        linear += zip(self.i_plane, self.i_plane_pdx, self.i_plane_mdx, self.i_plane_dy)
 
-        with m.If(self.i_run):
-            m.d.sync += [
-                self.i_edge_ab.eq(self.i_edge_ab + self.i_edge_ab_pdx),
-                self.i_edge_bc.eq(self.i_edge_bc + self.i_edge_bc_pdx),
-                self.i_edge_ca.eq(self.i_edge_ca + self.i_edge_ca_pdx),
-                x.eq(x + x_pinc),
-            ]
-            with m.If(((x_pinc > 0) & (x > self.i_stop_x)) | ((x_pinc < 0) & (x <= self.i_start_x))):
+        # the origin of the block is always its leftmost lane, so when walking
+        # right-to-left the positive x increment lives in the mdx registers.
+        walking_right = x_pinc > 0
+        dxs = [Mux(walking_right, pdx, mdx) for _, pdx, mdx, _ in linear]
+        edge_ab_dx, edge_bc_dx, edge_ca_dx = dxs[:3]
+
+        def lane_edge(edge, dx, dy, i, j):
+            if i:
+                edge = edge + i * dx
+            if j:
+                edge = edge + j * dy
+            return edge
+
+        # an edge function at offset (ox, oy) from a lane's point.
+        def sample_edge(edge, frac, dx, dy, ox, oy):
+            if not ox and not oy:
+                return edge
+            return edge + ((frac + dx * ox + dy * oy) >> frac_bits)
+
+        edges = [
+            (self.i_edge_ab, self.i_edge_ab_frac, edge_ab_dx, self.i_edge_ab_dy),
+            (self.i_edge_bc, self.i_edge_bc_frac, edge_bc_dx, self.i_edge_bc_dy),
+            (self.i_edge_ca, self.i_edge_ca_frac, edge_ca_dx, self.i_edge_ca_dy),
+        ]
+
+        # the bit x would carry out: a single pixel walk turning diagonally at
+        # the screen edges steps to the column just outside them, which wraps
+        # around the 16 bits of x, and must not then take itself to be at the
+        # far edge and turn again, nor cover anything there, as multisampling
+        # otherwise can with samples reaching back over the edge.
+        x_beyond = Signal()
+
+        # whether a lane is within the bounding box; the edge values are
+        # rounded, and can pass for covered a little way outside it.
+        def in_box(i, j):
+            within = C(1)
+            if i:
+                within &= x + ((i - 1) << frac_bits) <= self.i_stop_x
+            if j:
+                within &= y + (j << frac_bits) <= self.i_stop_y
+            return within
+
+        for j in range(self.lanes_y):
+            for i in range(self.lanes_x):
+                lane = j * self.lanes_x + i
+                shown = in_box(i, j) & ~self.o_occluded & ~x_beyond
+                for k, (ox, oy) in enumerate(SAMPLE_PATTERNS[self.samples]):
+                    m.d.comb += self.o_coverage[lane * self.samples + k].eq(shown & Cat(*(
+                        sample_edge(lane_edge(edge, dx, dy, i, j), frac, dx, dy, ox, oy) < 0
+                        for edge, frac, dx, dy in edges)).all())
+                m.d.comb += self.o_mask[lane].eq(self.o_coverage[lane * self.samples:(lane + 1) * self.samples].any())
+                for (plane, _, _, dy), dx, o_plane in zip(linear[3:], dxs[3:], self.o_plane):
+                    m.d.comb += o_plane[j * self.lanes_x + i].eq(lane_edge(plane, dx, dy, i, j))
+
+        m.d.comb += self.o_valid.eq(self.o_mask.any())
+
+        def step(edge, dx, n):
+            return edge + dx * n if n > 1 else edge + dx
+
+        # set during the final step of a walk.
+        last = Signal()
+
+        # with occlusion, the tile the walk will be at next, and the one it
+        # asked about in the last cycle, if that was for the triangle it walks.
+        query_ahead = Signal(32)
+        asked_xy    = Signal(32)
+        asked       = Signal()
+
+        # serpentine step of n_x by n_y pixels, from the block whose origin has
+        # the values `origins` (by default the current ones) at (from_x, from_y).
+        def walk(n_x, n_y, origins=None, from_x=x, from_y=y):
+            if origins is None:
+                origins = [value for value, _, _, _ in linear]
+            x_step  = x_pinc * n_x if n_x > 1 else x_pinc
+            y_step  = (1 << frac_bits) * n_y
+            x_right = from_x + ((n_x - 1) << frac_bits) if n_x > 1 else from_x
+
+            m.d.sync += [value.eq(step(origin, pdx, n_x)) for (value, pdx, _, _), origin in zip(linear, origins)]
+            m.d.sync += x.eq(from_x + x_step)
+            if from_y is not y:
+                m.d.sync += y.eq(from_y)
+            # a single pixel walk turns diagonally onto the next row. wider
+            # blocks turn in place, which keeps them on the grid anchored at
+            # the start position rather than stepping out past the bounding box.
+            turn = ((x_pinc > 0) & (x_right > self.i_stop_x)) | ((x_pinc < 0) & (from_x <= self.i_start_x))
+            if n_x == 1:
+                turn &= ~x_beyond
+                m.d.sync += x_beyond.eq(0)
+            with m.If(turn):
+                if n_x == 1:
+                    m.d.sync += [value.eq(step(step(origin, dy, n_y), pdx, n_x))
+                                 for (value, pdx, _, dy), origin in zip(linear, origins)]
+                    m.d.sync += x_beyond.eq(((from_x + x_step) < 0) | ((from_x + x_step) > 0xFFFF))
+                else:
+                    m.d.sync += [value.eq(step(origin, dy, n_y))
+                                 for (value, _, _, dy), origin in zip(linear, origins)]
+                    m.d.sync += x.eq(from_x)
+                m.d.sync += [Cat(pdx, mdx).eq(Cat(mdx, pdx)) for _, pdx, mdx, _ in linear]
                 m.d.sync += [
-                    self.i_edge_ab.eq(self.i_edge_ab + self.i_edge_ab_dy + self.i_edge_ab_pdx),
-                    self.i_edge_bc.eq(self.i_edge_bc + self.i_edge_bc_dy + self.i_edge_bc_pdx),
-                    self.i_edge_ca.eq(self.i_edge_ca + self.i_edge_ca_dy + self.i_edge_ca_pdx),
-                    Cat(self.i_edge_ab_pdx, self.i_edge_ab_mdx).eq(Cat(self.i_edge_ab_mdx, self.i_edge_ab_pdx)),
-                    Cat(self.i_edge_bc_pdx, self.i_edge_bc_mdx).eq(Cat(self.i_edge_bc_mdx, self.i_edge_bc_pdx)),
-                    Cat(self.i_edge_ca_pdx, self.i_edge_ca_mdx).eq(Cat(self.i_edge_ca_mdx, self.i_edge_ca_pdx)),
                     Cat(x_pinc, x_minc).eq(Cat(x_minc, x_pinc)),
-                    y.eq(y + (1 << 4)),
-                    self.i_run.eq((y + (1 << 4)) <= self.i_stop_y),
+                    y.eq(from_y + y_step),
+                    self.i_run.eq((from_y + y_step) <= self.i_stop_y),
                 ]
+                m.d.comb += last.eq((from_y + y_step) > self.i_stop_y)
 
+        # this has to come after the walk, so that a load in the final cycle of
+        # a walk takes priority over the walk's own updates.
+        def load():
+            params = [
+                (self.o_xy,          self.i_next_xy),
+                (self.i_start_x,     self.i_next_start_x),
+                (self.i_start_y,     self.i_next_start_y),
+                (self.i_stop_x,      self.i_next_stop_x),
+                (self.i_stop_y,      self.i_next_stop_y),
+                (self.i_edge_ab,     self.i_next_edge_ab),
+                (self.i_edge_bc,     self.i_next_edge_bc),
+                (self.i_edge_ca,     self.i_next_edge_ca),
+                (self.i_edge_ab_pdx, self.i_next_edge_ab_dx),
+                (self.i_edge_ab_mdx, -self.i_next_edge_ab_dx),
+                (self.i_edge_ab_dy,  self.i_next_edge_ab_dy),
+                (self.i_edge_bc_pdx, self.i_next_edge_bc_dx),
+                (self.i_edge_bc_mdx, -self.i_next_edge_bc_dx),
+                (self.i_edge_bc_dy,  self.i_next_edge_bc_dy),
+                (self.i_edge_ca_pdx, self.i_next_edge_ca_dx),
+                (self.i_edge_ca_mdx, -self.i_next_edge_ca_dx),
+                (self.i_edge_ca_dy,  self.i_next_edge_ca_dy),
+            ]
+            if self.samples > 1:
+                params += [
+                    (self.i_edge_ab_frac, self.i_next_edge_ab_frac),
+                    (self.i_edge_bc_frac, self.i_next_edge_bc_frac),
+                    (self.i_edge_ca_frac, self.i_next_edge_ca_frac),
+                ]
+            for k in range(self.planes):
+                params += [
+                    (self.i_plane[k],     self.i_next_plane[k]),
+                    (self.i_plane_pdx[k], self.i_next_plane_dx[k]),
+                    (self.i_plane_mdx[k], -self.i_next_plane_dx[k]),
+                    (self.i_plane_dy[k],  self.i_next_plane_dy[k]),
+                ]
+            if self.occlusion:
+                params.append((self.i_z_near, self.i_next_z_near))
+            shadow       = [Signal.like(reg, name="next_" + reg.name) for reg, _ in params]
+            shadow_valid = Signal()
+            loading      = Signal()
+
+            m.d.comb += [
+                loading.eq(shadow_valid & (~self.i_run | last)),
+                self.o_next_ready.eq(~shadow_valid | loading),
+                self.o_busy.eq(self.i_run | shadow_valid),
+            ]
+
+            with m.If(loading):
+                m.d.sync += [reg.eq(value) for (reg, _), value in zip(params, shadow)]
+                m.d.sync += [
+                    x_pinc.eq(1 << frac_bits),
+                    x_minc.eq(-(1 << frac_bits)),
+                    x_beyond.eq(0),
+                    self.i_run.eq(1),
+                    shadow_valid.eq(0),
+                ]
+
+            with m.If(self.i_next_valid & self.o_next_ready):
+                m.d.sync += [value.eq(next_input) for value, (_, next_input) in zip(shadow, params)]
+                m.d.sync += shadow_valid.eq(1)
+
+            if self.occlusion:
+                # the shadow copy starts with o_xy and ends with i_z_near.
+                m.d.comb += [
+                    self.o_query_xy.eq(Mux(loading, shadow[0], query_ahead)),
+                    self.o_query_z.eq(Mux(loading, shadow[-1], self.i_z_near)),
+                ]
+                m.d.sync += [
+                    asked_xy.eq(self.o_query_xy),
+                    asked.eq(self.i_run | loading),
+                ]
+
+            return loading
+
+        if self.span:
+            return self.span_walk(m, linear, x, y, x_pinc, x_minc, last, load)
+
+        if self.tile is None:
+            with m.If(self.i_run):
+                walk(self.lanes_x, self.lanes_y)
+
+            load()
+            return m
+
+        # tiled traversal: the serpentine walk moves a whole tile at a time, and
+        # the edge functions are evaluated at the tile's corner pixels. since
+        # each edge function is linear, a tile with an edge that is
+        # non-negative at all four corners cannot contain a covered pixel, and
+        # a tile with all three edges negative at all four corners is entirely
+        # covered. either way the tile takes a single cycle; only tiles that
+        # the triangle partially covers get scanned block by block.
+        tile     = self.tile
+        blocks_x = tile // self.lanes_x
+        blocks_y = tile // self.lanes_y
+        block_x  = Signal(range(blocks_x))
+        block_y  = Signal(range(blocks_y))
+
+        def corners(edge, dx, dy):
+            return [lane_edge(edge, dx, dy, i, j) for j in (0, tile - 1) for i in (0, tile - 1)]
+
+        def outside(edge, dx, dy):
+            return Cat(*(corner >= 0 for corner in corners(edge, dx, dy))).all()
+
+        def inside(edge, dx, dy):
+            return Cat(*(corner < 0 for corner in corners(edge, dx, dy))).all()
+
+        tile_outside = (outside(self.i_edge_ab, edge_ab_dx, self.i_edge_ab_dy) |
+                        outside(self.i_edge_bc, edge_bc_dx, self.i_edge_bc_dy) |
+                        outside(self.i_edge_ca, edge_ca_dx, self.i_edge_ca_dy))
+        tile_inside  = (inside(self.i_edge_ab, edge_ab_dx, self.i_edge_ab_dy) &
+                        inside(self.i_edge_bc, edge_bc_dx, self.i_edge_bc_dy) &
+                        inside(self.i_edge_ca, edge_ca_dx, self.i_edge_ca_dy))
+
+        # the tile is on the same grid of lane blocks as the untiled walk, and
+        # its block columns and rows that walk would visit are those up to the
+        # first one past the bounding box, as it turns there.
+        def column_in_box(i):
+            return C(1) if not i else x + ((i * self.lanes_x - 1) << frac_bits) <= self.i_stop_x
+
+        def row_in_box(j):
+            return C(1) if not j else y + ((j * self.lanes_y) << frac_bits) <= self.i_stop_y
+
+        # a tile taken in a single cycle: one outside the triangle, one hidden
+        # with occlusion, or one inside it, unless full_tiles is cleared.
+        whole = tile_outside | self.o_occluded
+        if self.full_tiles:
+            whole |= tile_inside
+
+        columns = sum(column_in_box(i) for i in range(blocks_x))
+        rows    = sum(row_in_box(j) for j in range(blocks_y))
+
+        # partially covered tiles are scanned in a serpentine of their own,
+        # over only the blocks the untiled walk would visit, starting
+        # left-to-right along the tile's top row. the tile's origin is kept in
+        # `tile_origin`, tile_x and tile_y, to return to and step on from.
+        tile_origin = [Signal.like(value, name="tile_" + value.name) for value, _, _, _ in linear]
+        tile_x      = Signal(16)
+        tile_y      = Signal(16)
+        scan_left   = Signal()
+        mdxs        = [Mux(walking_right, mdx, pdx) for _, pdx, mdx, _ in linear]
+
+        def scan(origins, from_x, from_y):
+            with m.If(~scan_left & (block_x != blocks_x - 1) & column_in_box(1)):
+                m.d.sync += [value.eq(step(value, dx, self.lanes_x)) for (value, _, _, _), dx in zip(linear, dxs)]
+                m.d.sync += [
+                    x.eq(x + (self.lanes_x << frac_bits)),
+                    block_x.eq(block_x + 1),
+                ]
+            with m.Elif(scan_left & (block_x != 0)):
+                m.d.sync += [value.eq(step(value, mdx, self.lanes_x)) for (value, _, _, _), mdx in zip(linear, mdxs)]
+                m.d.sync += [
+                    x.eq(x - (self.lanes_x << frac_bits)),
+                    block_x.eq(block_x - 1),
+                ]
+            with m.Elif((block_y != blocks_y - 1) & row_in_box(1)):
+                m.d.sync += [value.eq(step(value, dy, self.lanes_y)) for value, _, _, dy in linear]
+                m.d.sync += [
+                    y.eq(y + (self.lanes_y << frac_bits)),
+                    block_y.eq(block_y + 1),
+                    scan_left.eq(~scan_left),
+                ]
+            with m.Else():
+                m.d.sync += [
+                    block_x.eq(0),
+                    block_y.eq(0),
+                    scan_left.eq(0),
+                ]
+                walk(tile, tile, origins, from_x, from_y)
+                m.next = "TILE"
+
+        with m.If(self.i_run):
+            with m.FSM() as fsm:
+                with m.State("TILE"):
+                    with m.If(whole):
+                        if self.full_tiles:
+                            m.d.comb += self.o_full.eq(tile_inside & ~self.o_occluded)
+                        walk(tile, tile)
+                    with m.Else():
+                        m.d.sync += [origin.eq(value) for origin, (value, _, _, _) in zip(tile_origin, linear)]
+                        m.d.sync += [
+                            tile_x.eq(x),
+                            tile_y.eq(y),
+                        ]
+                        # a tile with a single block to scan is done with in
+                        # this cycle, and scan() goes back to TILE.
+                        m.next = "SCAN"
+                        scan([value for value, _, _, _ in linear], x, y)
+                with m.State("SCAN"):
+                    scan(tile_origin, tile_x, tile_y)
+
+            # a tile taken in a single cycle saves the cycles the untiled walk
+            # spends on its blocks, less that one. a single lane untiled walk
+            # also turns onto each row after the first diagonally, through a
+            # pixel outside the box, which is one more cycle per row.
+            at_tile = fsm.ongoing("TILE")
+            saved   = Mux(at_tile & whole, columns * rows - 1, 0)
+            if self.lanes_x == 1:
+                saved = saved + Mux(at_tile & (x <= self.i_start_x), rows, 0) - last
+            m.d.sync += self.o_cycles_saved.eq(self.o_cycles_saved + saved)
+
+            if self.occlusion:
+                # the next tile, from this one or the one being scanned, as
+                # walk() would step to it.
+                from_x = Mux(at_tile, x, tile_x)
+                from_y = Mux(at_tile, y, tile_y)
+                turn   = (((x_pinc > 0) & (from_x + ((tile - 1) << frac_bits) > self.i_stop_x)) |
+                          ((x_pinc < 0) & (from_x <= self.i_start_x)))
+                m.d.comb += [
+                    query_ahead.eq(Cat(Mux(turn, from_x, from_x + x_pinc * tile)[:16],
+                                       Mux(turn, from_y + (tile << frac_bits), from_y)[:16])),
+                    self.o_occluded.eq(at_tile & asked & (asked_xy == self.o_xy) & self.i_occluded),
+                ]
+
+        load()
+        return m
+
+    # the span walk described above. `entry` holds the values at the sample
+    # the current row was entered at, which are taken from the current values
+    # in a row's first cycle, flagged by row_start; `second` is set while the
+    # row is being walked back from beside its entry point.
+    def span_walk(self, m, linear, x, y, x_pinc, x_minc, last, load):
+        frac_bits = self.precision.frac_bits
+        entry     = [Signal.like(value, name="entry_" + value.name) for value, _, _, _ in linear]
+        entry_x   = Signal(16)
+        row_start = Signal(reset=1)
+        second    = Signal()
+
+        origins  = [Mux(row_start, value, saved) for (value, _, _, _), saved in zip(linear, entry)]
+        origin_x = Mux(row_start, x, entry_x)
+
+        # whether the walk can go on past the sample at from_x with the edge
+        # values `edges`, stepping them by `steps`.
+        def onward(edges, steps, from_x, right):
+            inside = Cat(*((edge < 0) | (step < 0) for edge, step in zip(edges, steps))).all()
+            return inside & Mux(right, from_x <= self.i_stop_x, from_x > self.i_start_x)
+
+        walking_right = x_pinc > 0
+        ahead  = onward([value for value, _, _, _ in linear[:3]], [pdx for _, pdx, _, _ in linear[:3]],
+                        x, walking_right)
+        behind = onward(origins[:3], [mdx for _, _, mdx, _ in linear[:3]], origin_x, ~walking_right)
+
+        turn = [Cat(pdx, mdx).eq(Cat(mdx, pdx)) for _, pdx, mdx, _ in linear]
+        turn.append(Cat(x_pinc, x_minc).eq(Cat(x_minc, x_pinc)))
+
+        with m.If(self.i_run):
+            m.d.sync += row_start.eq(0)
+            with m.If(row_start):
+                m.d.sync += [saved.eq(value) for (value, _, _, _), saved in zip(linear, entry)]
+                m.d.sync += entry_x.eq(x)
+
+            with m.If(ahead):
+                m.d.sync += [value.eq(value + pdx) for value, pdx, _, _ in linear]
+                m.d.sync += x.eq(x + x_pinc)
+            with m.Elif(~second & behind):
+                m.d.sync += [value.eq(origin + mdx) for (value, _, mdx, _), origin in zip(linear, origins)]
+                m.d.sync += x.eq(origin_x + x_minc)
+                m.d.sync += turn
+                m.d.sync += second.eq(1)
+            with m.Else():
+                m.d.sync += [value.eq(value + dy) for value, _, _, dy in linear]
+                m.d.sync += turn
+                m.d.sync += [
+                    y.eq(y + (1 << frac_bits)),
+                    second.eq(0),
+                    row_start.eq(1),
+                    self.i_run.eq(y + (1 << frac_bits) <= self.i_stop_y),
+                ]
+                m.d.comb += last.eq(y + (1 << frac_bits) > self.i_stop_y)
+
+        with m.If(load()):
+            m.d.sync += [
+                row_start.eq(1),
+                second.eq(0),
+            ]
         return m
 
 
@@ -162,7 +764,7 @@ if __name__ == "__main__":
         tr.i_edge_ab_pdx, tr.i_edge_ab_mdx, tr.i_edge_ab_dy,
         tr.i_edge_bc_pdx, tr.i_edge_ab_mdx, tr.i_edge_bc_dy,
         tr.i_edge_ca_pdx, tr.i_edge_ca_mdx, tr.i_edge_ca_dy,
-        tr.o_xy, tr.o_valid, tr.i_run
+        tr.o_xy, tr.o_mask, tr.o_valid, tr.o_full, tr.o_cycles_saved, tr.i_run
     ]
 
     from amaranth.back import rtlil
@@ -172,6 +774,9 @@ if __name__ == "__main__":
 
     from amaranth.sim import *
 
+    import golden
+    from capture import FrameCapture
+
     def test():
         def edge(ax, ay, bx, by, cx, cy): # ax, ay, bx, by, cx, cy all Q12.4
             x = (((cx - ax) * (by - ay)) - ((cy - ay) * (bx - ax))) >> 4 # Q24.4
@@ -216,29 +821,104 @@ if __name__ == "__main__":
         yield
         cycles = 1
 
-        canvas = [[0 for _ in range(512)] for _ in range(512)]
+        # covered pixels, as Q12.4 points, captured all at once at the end.
+        xs, ys = [], []
 
         while (yield tr.i_run):
             yield
             cycles += 1
-            if (yield tr.o_valid):
+            if (yield tr.o_full):
+                xy = (yield tr.o_xy)
+                my_x = (xy & 0xFFFF) >> 4
+                my_y = (xy >> 16) >> 4
+                for j in range(tr.tile):
+                    for i in range(tr.tile):
+                        xs.append((my_x + i) << 4)
+                        ys.append((my_y + j) << 4)
+            elif (yield tr.o_valid):
                 xy = (yield tr.o_xy)
+                mask = (yield tr.o_mask)
                 my_x = (xy & 0xFFFF) >> 4
                 my_y = (xy >> 16) >> 4
-                canvas[my_y][my_x] = 1
+                for j in range(tr.lanes_y):
+                    for i in range(tr.lanes_x):
+                        if mask & (1 << (j * tr.lanes_x + i)):
+                            xs.append((my_x + i) << 4)
+                            ys.append((my_y + j) << 4)
         
         print("Took {} cycles".format(cycles))
+        if tr.tile is not None:
+            print("Saved {} cycles by tiling".format((yield tr.o_cycles_saved)))
 
-        with open("triangle.ppm", "w") as f:
-            f.write("P1\n")
-            f.write("512 512\n")
-            for y in range(0, 512):
-                for x in range(0, 512):
-                    f.write("{} ".format(canvas[y][x]))
-                f.write("\n")
+        capture = FrameCapture()
+        capture.write(golden.join_xy(xs, ys))
+        capture.save_pbm("triangle.pbm")
 
     sim = Simulator(tr)
     sim.add_clock(1e-9)
     sim.add_sync_process(test)
     with sim.write_vcd("test.vcd", "test.gtkw"):
         sim.run()
+
+    import numpy as np
+
+    from bench import fragments, wind
+    from harness import Harness
+
+    # tiled walks against untiled ones with the same lane blocks, triangle by
+    # triangle: both must cover what golden.rasterise does, and o_cycles_saved
+    # must go up by exactly the difference in their cycles.
+    def walk_cycles(render, triangles):
+        idle = Signal()
+        m = Module()
+        m.submodules.render = render
+        m.d.comb += idle.eq(~render.o_busy)
+        harness = Harness(m)
+        names = ["edge_ab", "edge_bc", "edge_ca", "edge_ab_dx", "edge_ab_dy",
+                 "edge_bc_dx", "edge_bc_dy", "edge_ca_dx", "edge_ca_dy"]
+
+        results = []
+        for triangle in triangles:
+            min_x, min_y = min(triangle[0::2]), min(triangle[1::2])
+            max_x, max_y = max(triangle[0::2]), max(triangle[1::2])
+            tri_setup = golden.setup(*triangle, min_x + 8, min_y + 8)
+            inputs = [(getattr(render, "i_next_" + name), [tri_setup[name]]) for name in names] + [
+                (render.i_next_xy,      [golden.join_xy(min_x + 8, min_y + 8)]),
+                (render.i_next_start_x, [min_x + 16]),
+                (render.i_next_start_y, [min_y]),
+                (render.i_next_stop_x,  [max(max_x - 16, 0)]),
+                (render.i_next_stop_y,  [max_y]),
+            ]
+            limit = ((max_x - min_x >> 4) + 4) * ((max_y - min_y >> 4) + 4) + 16
+            rows = harness.run(inputs, [render.o_valid, render.o_xy, render.o_mask, render.o_full, render.i_run,
+                                        render.o_cycles_saved],
+                               cycles=limit, valid=render.i_next_valid, ready=render.o_next_ready, until=idle)
+            got = np.sort(fragments(rows[:, :4], render.lanes_x, render.lanes_y, render.tile))
+            expected = np.sort(golden.join_xy(*golden.rasterise(*triangle)))
+            results.append((int(rows[:, 4].sum()), int(rows[-1, 5]), not np.array_equal(got, expected)))
+        return results
+
+    def check_tiling(lanes_x, lanes_y, tile, full_tiles=True):
+        rng = np.random.default_rng(6)
+        triangles = [(100, 100, 6000, 300, 400, 5000), (80, 80, 120, 90, 100, 130), (100, 300, 3000, 310, 120, 330),
+                     (2000, 2000, 2010, 7000, 2030, 2020)]
+        # triangles against the screen edges, where a single pixel walk turns
+        # through the columns just outside them.
+        triangles += [(0, 0, 1600, 800, 0, 1600), (4, 100, 900, 420, 30, 1300), (65520, 25, 65512, 0, 65513, 0),
+                      (65535, 0, 64000, 700, 65535, 1500), (0, 64000, 2000, 64100, 30, 65535)]
+        triangles += [tuple(int(v) for v in np.tile(rng.integers(900, 3100, size=2), 3) + rng.integers(-800, 800, size=6))
+                      for _ in range(8)]
+        triangles = [wind(t) for t in triangles]
+
+        untiled = walk_cycles(TriangleRender(lanes_x, lanes_y), triangles)
+        tiled   = walk_cycles(TriangleRender(lanes_x, lanes_y, tile=tile, full_tiles=full_tiles), triangles)
+        saved   = [after - before for before, after in zip([0] + [s for _, s, _ in tiled], [s for _, s, _ in tiled])]
+        wrong   = sum(u - t != s for (u, _, _), (t, _, _), s in zip(untiled, tiled, saved))
+        print("{}x{} lanes, tile {}{}: {} cycles untiled, {} tiled, {} wrong savings, {} mismatched triangles".format(
+              lanes_x, lanes_y, tile, "" if full_tiles else " scanning full tiles", sum(u for u, _, _ in untiled),
+              sum(t for t, _, _ in tiled), wrong, sum(bad for _, _, bad in untiled + tiled)))
+
+    check_tiling(2, 2, 8)
+    check_tiling(1, 1, 8)
+    check_tiling(2, 1, 4)
+    check_tiling(2, 2, 8, full_tiles=False)
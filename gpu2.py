@@ -1,180 +1,572 @@
 from amaranth import *
+from amaranth.lib.fifo import SyncFIFO
 
+from counters import PerformanceCounters
+from precision import Precision, fit
+from stages import delay, schedule, stage
 
+
+# EdgeFunction computes edge(A, B, C) as described in gpu.py, in four
+# combinational steps: the differences, the two products, their difference
+# shifted down by the coordinates' fractional bits, and the top-left
+# adjustment. `stages` pipeline registers are spread over those as
+# stages.schedule() places them, and the result appears `latency` (that is,
+# `stages`) cycles after the inputs.
+#
+# the widths of the inputs, the differences, the products and the result are
+# those of `precision`, a precision.Precision, Q12.4 coordinates and a 32-bit
+# result by default.
 class EdgeFunction(Elaboratable):
-    def __init__(self):
-        self.i_ax = Signal(16)
-        self.i_ay = Signal(16)
-        self.i_bx = Signal(16)
-        self.i_by = Signal(16)
-        self.i_cx = Signal(16)
-        self.i_cy = Signal(16)
+    def __init__(self, stages=4, precision=None):
+        if precision is None:
+            precision = Precision()
+        precision.check(1, "EdgeFunction")
+
+        self.precision = precision
+        self.counts    = schedule(4, stages)
+        self.latency   = stages
+
+        self.i_ax = Signal(precision.coord_bits)
+        self.i_ay = Signal(precision.coord_bits)
+        self.i_bx = Signal(precision.coord_bits)
+        self.i_by = Signal(precision.coord_bits)
+        self.i_cx = Signal(precision.coord_bits)
+        self.i_cy = Signal(precision.coord_bits)
 
-        self.o    = Signal(signed(32))
+        self.o    = Signal(signed(precision.edge_bits))
+        # the bits shifted out of o, for evaluating the edge function at points
+        # off the grid (see TriangleRender's multisampling).
+        self.o_frac = Signal(precision.frac_bits)
+        # the top-left adjustment taken off o.
+        self.o_adjustment = Signal()
 
     def elaborate(self, _):
         m = Module()
 
-        # Stage 1:
-        ca_x = Signal(signed(17))
-        ba_y = Signal(signed(17))
-        ca_y = Signal(signed(17))
-        ba_x = Signal(signed(17))
-        a_x = Signal(16)
-        a_y = Signal(16)
-        b_x = Signal(16)
-        b_y = Signal(16)
+        frac_bits = self.precision.frac_bits
+        edge_bits = self.precision.edge_bits
 
-        m.d.sync += [
-            ca_x.eq(self.i_cx - self.i_ax),
-            ba_y.eq(self.i_by - self.i_ay),
-            ca_y.eq(self.i_cy - self.i_ay),
-            ba_x.eq(self.i_bx - self.i_ax),
-            a_x.eq(self.i_ax),
-            a_y.eq(self.i_ay),
-            b_x.eq(self.i_bx),
-            b_y.eq(self.i_by),
-        ]
+        # Step 1:
+        ca_x, ba_y, ca_y, ba_x, a_x, a_y, b_x, b_y = stage(m, [
+            self.i_cx - self.i_ax,
+            self.i_by - self.i_ay,
+            self.i_cy - self.i_ay,
+            self.i_bx - self.i_ax,
+            self.i_ax,
+            self.i_ay,
+            self.i_bx,
+            self.i_by,
+        ], self.counts[0], names=["ca_x", "ba_y", "ca_y", "ba_x", "a_x", "a_y", "b_x", "b_y"])
 
-        # Stage 2:
-        ca_x_ba_y = Signal(signed(34))
-        ca_y_ba_x = Signal(signed(34))
-        ab_x_le = Signal()
-        ab_x_eq = Signal()
-        ba_y_le = Signal()
+        # Step 2:
+        ca_x_ba_y, ca_y_ba_x, ab_x_le, ab_x_eq, ba_y_le = stage(m, [
+            ca_x * ba_y,
+            ca_y * ba_x,
+            a_x < b_x,
+            a_x == b_x,
+            b_y < a_y,
+        ], self.counts[1], names=["ca_x_ba_y", "ca_y_ba_x", "ab_x_le", "ab_x_eq", "ba_y_le"])
 
-        m.d.sync += [
-            ca_x_ba_y.eq(ca_x * ba_y),
-            ca_y_ba_x.eq(ca_y * ba_x),
-            ab_x_le.eq(a_x < b_x),
-            ab_x_eq.eq(a_x == b_x),
-            ba_y_le.eq(b_y < a_y),
-        ]
+        # Step 3: the difference is kept to edge_bits, which Precision has
+        # checked it fits.
+        difference = ca_x_ba_y - ca_y_ba_x
+        result, frac, adjustment = stage(m, [
+            fit(difference >> frac_bits, edge_bits),
+            difference[:frac_bits],
+            ab_x_le | (ab_x_eq & ba_y_le),
+        ], self.counts[2], names=["result", "frac", "adjustment"])
 
-        # Stage 3:
-        result     = Signal(signed(32))
-        adjustment = Signal()
-
-        m.d.sync += [
-            result.eq((ca_x_ba_y - ca_y_ba_x) >> 4),
-            adjustment.eq(ab_x_le | (ab_x_eq & ba_y_le)),
+        # Step 4:
+        o, o_frac, o_adjustment = stage(m, [fit(result - adjustment, edge_bits), frac, adjustment], self.counts[3],
+                                        names=["o", "o_frac", "o_adjustment"])
+        m.d.comb += [
+            self.o.eq(o),
+            self.o_frac.eq(o_frac),
+            self.o_adjustment.eq(o_adjustment),
         ]
 
-        # Stage 4:
-        m.d.sync += self.o.eq(result - adjustment)
-
         return m
 
 
+# TriangleSetup computes the three edge functions at i_point, the triangle's
+# area, and the edge deltas that TriangleRender steps with. it comes in two
+# forms, picked at elaboration time:
+#
+# - parallel=False: a single EdgeFunction (two 17x17 multipliers), shared over
+#   a small FSM. the four edge functions go into it on consecutive cycles, and
+#   come out `stages` cycles later; with the default of four stages, a
+#   triangle takes ten cycles, and i_tri_xy_* and i_point are read over that
+#   whole time.
+#
+# - parallel=True: four EdgeFunctions (eight 17x17 multipliers) for AB, BC, CA
+#   and the area, plus a delay line for the edge deltas as long as theirs. a
+#   new triangle can be accepted every cycle, and its results appear `stages`
+#   cycles later.
+#
+# `stages` is the number of pipeline stages in each EdgeFunction; `latency` is
+# then the number of cycles from a triangle being taken to its result being
+# valid, and `capacity` the number of triangles in flight at once.
+#
+# both forms use the same handshakes: a triangle is transferred in when i_start
+# and o_ready are both high, and a result is transferred out when o_valid and
+# i_ready are both high. i_start must stay high, and the triangle inputs
+# stable, until o_ready. i_ready may be left at its reset value of 1 if the
+# consumer can always take a result.
+#
+# o_busy is set while a triangle is being set up, or its result is waiting to
+# be transferred out.
+#
+# o_edge_ab_frac..ca_frac are the fractional bits of the edge functions, which
+# the edge function outputs drop, for multisampled rendering.
+#
+# `precision`, a precision.Precision, sets the coordinate format and the widths
+# of the EdgeFunctions, the edge functions and the deltas, as it does for
+# TriangleRender; vertices and i_point must then lie on its screen.
+#
+# with `mode` set to "strip" or "fan", for the triangles of a PrimitiveAssembly
+# in that mode, the parallel form computes only the edges each triangle adds
+# to the mesh, BC and CA, and its area: three EdgeFunctions (six multipliers)
+# instead of four (eight). AB, the edge shared with the previous triangle, is
+# recovered from those, since the three edge functions at any point sum to the
+# area. the sum is exact before the results are shifted down and adjusted for
+# the top-left rule, and o_frac and o_adjustment give back what was taken off.
+# a triangle's edge functions are evaluated at its own first sample, so the
+# previous triangle's value for the shared edge cannot be carried over, but its
+# deltas can: with i_shares_bc (or i_shares_ca) set, AB is the previous
+# triangle's BC (or CA) the other way round, and its deltas are theirs negated
+# rather than taken from the vertices. `edge_functions` is the number of
+# EdgeFunctions in the chosen form.
 class TriangleSetup(Elaboratable):
-    def __init__(self):
+    def __init__(self, parallel=False, stages=4, precision=None, mode="list"):
+        if precision is None:
+            precision = Precision()
+        if mode not in ("list", "strip", "fan"):
+            raise ValueError("Setup mode must be list, strip or fan, not {!r}".format(mode))
+        if mode != "list" and not parallel:
+            raise ValueError("Strip and fan setup needs the parallel form")
+        precision.check(1, "TriangleSetup")
+
+        self.parallel    = parallel
+        self.stages      = stages
+        self.precision   = precision
+        self.mode        = mode
+        self.latency     = stages if parallel else stages + 6
+        self.capacity    = stages if parallel else 1
+        self.edge_functions = (4 if mode == "list" else 3) if parallel else 1
+
         self.i_tri_xy_a  = Signal(32)
         self.i_tri_xy_b  = Signal(32)
         self.i_tri_xy_c  = Signal(32)
         self.i_point     = Signal(32)
         self.i_start     = Signal()
+        self.o_ready     = Signal()
+
+        self.i_shares_bc = Signal()
+        self.i_shares_ca = Signal()
+
+        self.o_edge_ab   = Signal(precision.edge_bits)
+        self.o_edge_bc   = Signal(precision.edge_bits)
+        self.o_edge_ca   = Signal(precision.edge_bits)
+        self.o_tri_area  = Signal(precision.edge_bits)
 
-        self.o_edge_ab   = Signal(32)
-        self.o_edge_bc   = Signal(32)
-        self.o_edge_ca   = Signal(32)
-        self.o_tri_area  = Signal(32)
+        self.o_edge_ab_frac = Signal(precision.frac_bits)
+        self.o_edge_bc_frac = Signal(precision.frac_bits)
+        self.o_edge_ca_frac = Signal(precision.frac_bits)
 
-        self.o_edge_ab_dx = Signal(16)
-        self.o_edge_ab_dy = Signal(16)
-        self.o_edge_bc_dx = Signal(16)
-        self.o_edge_bc_dy = Signal(16)
-        self.o_edge_ca_dx = Signal(16)
-        self.o_edge_ca_dy = Signal(16)
+        self.o_edge_ab_dx = Signal(precision.delta_bits)
+        self.o_edge_ab_dy = Signal(precision.delta_bits)
+        self.o_edge_bc_dx = Signal(precision.delta_bits)
+        self.o_edge_bc_dy = Signal(precision.delta_bits)
+        self.o_edge_ca_dx = Signal(precision.delta_bits)
+        self.o_edge_ca_dy = Signal(precision.delta_bits)
 
         self.o_valid      = Signal()
+        self.i_ready      = Signal(reset=1)
+        self.o_busy       = Signal()
 
     def elaborate(self, _):
         m = Module()
 
-        m.submodules.edge_func = edge_func = EdgeFunction()
+        bits = self.precision.coord_bits
+        a_x, a_y = self.i_tri_xy_a[:bits], self.i_tri_xy_a[16:16 + bits]
+        b_x, b_y = self.i_tri_xy_b[:bits], self.i_tri_xy_b[16:16 + bits]
+        c_x, c_y = self.i_tri_xy_c[:bits], self.i_tri_xy_c[16:16 + bits]
+        p_x, p_y = self.i_point[:bits], self.i_point[16:16 + bits]
 
-        a_x, a_y = self.i_tri_xy_a[:16], self.i_tri_xy_a[16:]
-        b_x, b_y = self.i_tri_xy_b[:16], self.i_tri_xy_b[16:]
-        c_x, c_y = self.i_tri_xy_c[:16], self.i_tri_xy_c[16:]
-        p_x, p_y = self.i_point[:16], self.i_point[16:]
+        deltas = [
+            (self.o_edge_ab_dx, b_y - a_y),
+            (self.o_edge_ab_dy, a_x - b_x),
+            (self.o_edge_bc_dx, c_y - b_y),
+            (self.o_edge_bc_dy, b_x - c_x),
+            (self.o_edge_ca_dx, a_y - c_y),
+            (self.o_edge_ca_dy, c_x - a_x),
+        ]
+
+        # the operands of AB, BC, CA and the area, and where their results go.
+        operands = [
+            ((a_x, a_y), (b_x, b_y), (p_x, p_y)),
+            ((b_x, b_y), (c_x, c_y), (p_x, p_y)),
+            ((c_x, c_y), (a_x, a_y), (p_x, p_y)),
+            ((a_x, a_y), (b_x, b_y), (c_x, c_y)),
+        ]
+        results = [
+            (self.o_edge_ab, self.o_edge_ab_frac),
+            (self.o_edge_bc, self.o_edge_bc_frac),
+            (self.o_edge_ca, self.o_edge_ca_frac),
+            (self.o_tri_area, None),
+        ]
+
+        def connect(domain, edge_func, operand):
+            (ax, ay), (bx, by), (cx, cy) = operand
+            m.d[domain] += [
+                edge_func.i_ax.eq(ax),
+                edge_func.i_ay.eq(ay),
+                edge_func.i_bx.eq(bx),
+                edge_func.i_by.eq(by),
+                edge_func.i_cx.eq(cx),
+                edge_func.i_cy.eq(cy),
+            ]
+
+        if self.parallel:
+            # the whole pipeline advances together, whenever the result at the
+            # end of it is either absent or being taken.
+            advance = Signal()
+            m.d.comb += [
+                advance.eq(~self.o_valid | self.i_ready),
+                self.o_ready.eq(advance),
+            ]
+
+            edge_funcs = {}
+            for name, operand, (result, frac) in zip(["edge_ab", "edge_bc", "edge_ca", "edge_area"], operands, results):
+                if name == "edge_ab" and self.mode != "list":
+                    continue
+                edge_funcs[name] = edge_func = EdgeFunction(self.stages, self.precision)
+                m.submodules[name] = EnableInserter(advance)(edge_func)
+                connect("comb", edge_func, operand)
+                m.d.comb += result.eq(edge_func.o)
+                if frac is not None:
+                    m.d.comb += frac.eq(edge_func.o_frac)
+
+            if self.mode != "list":
+                frac_bits  = self.precision.frac_bits
+                edge_bits  = self.precision.edge_bits
+                delta_bits = self.precision.delta_bits
+
+                # an edge function as it was before being shifted and adjusted.
+                def unshifted(edge_func):
+                    return ((edge_func.o + edge_func.o_adjustment) << frac_bits) + edge_func.o_frac
+
+                # the area's adjustment is AB's, as it is edge(A, B, C).
+                area = edge_funcs["edge_area"]
+                edge_ab = unshifted(area) - unshifted(edge_funcs["edge_bc"]) - unshifted(edge_funcs["edge_ca"])
+                m.d.comb += [
+                    self.o_edge_ab.eq(fit(fit(edge_ab >> frac_bits, edge_bits) - area.o_adjustment, edge_bits)),
+                    self.o_edge_ab_frac.eq(edge_ab[:frac_bits]),
+                ]
+
+                # the deltas of the previous triangle's BC and CA, either of
+                # which the next one's AB may be.
+                shared = [Signal(signed(delta_bits), name="shared_" + output.name[2:]) for output, _ in deltas[2:]]
+                with m.If(self.i_start & self.o_ready):
+                    m.d.sync += [reg.eq(delta) for reg, (_, delta) in zip(shared, deltas[2:])]
+                bc_dx, bc_dy, ca_dx, ca_dy = shared
+
+                def reused(delta, bc, ca):
+                    return fit(Mux(self.i_shares_bc, -bc, Mux(self.i_shares_ca, -ca, delta)), delta_bits)
+
+                deltas[0] = (self.o_edge_ab_dx, reused(deltas[0][1], bc_dx, ca_dx))
+                deltas[1] = (self.o_edge_ab_dy, reused(deltas[1][1], bc_dy, ca_dy))
+
+            # the valid bit and the edge deltas follow the EdgeFunctions down a
+            # delay line of the same length.
+            valid = [self.i_start]
+            for _ in range(self.stages):
+                valid.append(delay(m, valid[-1], 1, enable=advance))
+            delayed = stage(m, [delta for _, delta in deltas], self.stages, enable=advance,
+                            names=["delta_" + output.name[2:] for output, _ in deltas])
+
+            m.d.comb += [
+                self.o_valid.eq(valid[-1]),
+                self.o_busy.eq(Cat(*valid[1:]).any()),
+            ]
+            m.d.comb += [output.eq(value) for (output, _), value in zip(deltas, delayed)]
+
+            return m
+
+        m.submodules.edge_func = edge_func = EdgeFunction(self.stages, self.precision)
 
         # TODO: can save four subtractions by stealing from the edge function
 
-        m.d.sync += self.o_valid.eq(0)
+        # the operands are pushed into the EdgeFunction's input registers on
+        # four consecutive cycles, and each result is popped `latency` cycles
+        # after that, going by the index that follows it down a delay line.
+        # with a short enough EdgeFunction, the first results come out before
+        # the last operands have gone in; the area, which is pushed last, always
+        # comes out last.
+        pushing = Signal()
+        push    = Signal(2)
+        popped  = delay(m, Cat(pushing, push), edge_func.latency + 1)
+        popping, pop = popped[0], popped[1:]
+
+        m.d.sync += self.o_valid.eq(self.o_valid & ~self.i_ready)
+
+        with m.If(pushing):
+            m.d.sync += push.eq(push + 1)
+            with m.Switch(push):
+                for index, operand in enumerate(operands):
+                    with m.Case(index):
+                        connect("sync", edge_func, operand)
+
+        with m.If(popping):
+            with m.Switch(pop):
+                for index, (result, frac) in enumerate(results[:3]):
+                    with m.Case(index):
+                        m.d.sync += [
+                            result.eq(edge_func.o),
+                            frac.eq(edge_func.o_frac),
+                        ]
 
-        with m.FSM():
+        with m.FSM() as fsm:
             with m.State("START"):
-                with m.If(self.i_start):
-                    m.next = "PUSH_AB"
-            with m.State("PUSH_AB"):
-                m.d.sync += [
-                    edge_func.i_ax.eq(a_x),
-                    edge_func.i_ay.eq(a_y),
-                    edge_func.i_bx.eq(b_x),
-                    edge_func.i_by.eq(b_y),
-                    edge_func.i_cx.eq(p_x),
-                    edge_func.i_cy.eq(p_y)
-                ]
-                m.next = "PUSH_BC"
-            with m.State("PUSH_BC"):
-                m.d.sync += [
-                    edge_func.i_ax.eq(b_x),
-                    edge_func.i_ay.eq(b_y),
-                    edge_func.i_bx.eq(c_x),
-                    edge_func.i_by.eq(c_y),
-                    edge_func.i_cx.eq(p_x),
-                    edge_func.i_cy.eq(p_y)
-                ]
-                m.next = "PUSH_CA"
-            with m.State("PUSH_CA"):
-                m.d.sync += [
-                    edge_func.i_ax.eq(c_x),
-                    edge_func.i_ay.eq(c_y),
-                    edge_func.i_bx.eq(a_x),
-                    edge_func.i_by.eq(a_y),
-                    edge_func.i_cx.eq(p_x),
-                    edge_func.i_cy.eq(p_y)
-                ]
-                m.next = "PUSH_AREA"
-            with m.State("PUSH_AREA"):
-                m.d.sync += [
-                    edge_func.i_ax.eq(a_x),
-                    edge_func.i_ay.eq(a_y),
-                    edge_func.i_bx.eq(b_x),
-                    edge_func.i_by.eq(b_y),
-                    edge_func.i_cx.eq(c_x),
-                    edge_func.i_cy.eq(c_y)
-                ]
-                m.next = "POP_AB"
-            with m.State("POP_AB"):
-                m.d.sync += self.o_edge_ab.eq(edge_func.o)
-                m.next = "POP_BC"
-            with m.State("POP_BC"):
-                m.d.sync += self.o_edge_bc.eq(edge_func.o)
-                m.next = "POP_CA"
-            with m.State("POP_CA"):
-                m.d.sync += self.o_edge_ca.eq(edge_func.o)
-                m.next = "POP_AREA"
-            with m.State("POP_AREA"):
-                m.d.sync += [
-                    self.o_tri_area.eq(edge_func.o),
+                # the previous result must be gone before the first pop
+                # replaces it.
+                with m.If(self.i_start & (~self.o_valid | self.i_ready)):
+                    m.next = "PUSH"
+            with m.State("PUSH"):
+                m.d.comb += pushing.eq(1)
+                with m.If(push == len(operands) - 1):
+                    m.next = "POP"
+            with m.State("POP"):
+                with m.If(popping & (pop == len(operands) - 1)):
+                    # this is the last cycle the triangle inputs are read in.
+                    m.d.comb += self.o_ready.eq(1)
+                    m.d.sync += self.o_tri_area.eq(edge_func.o)
+                    m.d.sync += [output.eq(delta) for output, delta in deltas]
+                    m.d.sync += self.o_valid.eq(1)
+                    m.next = "START"
+
+        m.d.comb += self.o_busy.eq(~fsm.ongoing("START") | self.o_valid)
+
+        return m
+
+
+# PlaneSetup turns per-vertex attributes into plane equations, once per
+# triangle, so that TriangleRender can step them along its walk with adders
+# instead of dividing by the triangle's area at every pixel.
+#
+# for perspective correct interpolation, the attributes should be 1/w, z/w and
+# the colour channels over w (six channels by default), which do vary linearly
+# in screen space; a fragment then only needs the one reciprocal of its
+# interpolated 1/w to recover z and colour. like the reference model, the
+# division by w is done per vertex before setup, and i_attr_a/b/c[k] hold the
+# results in Q8.8.
+#
+# the edge functions, deltas and area are those from TriangleSetup, evaluated
+# at the point P the walk will start from. since the barycentric weight of A is
+# edge(B, C, P) / area, and so on, each plane is:
+#
+# o_plane[k]:    (A_k * edge_bc + B_k * edge_ca + C_k * edge_ab) / area
+# o_plane_dx[k]: (A_k * edge_bc_dx + B_k * edge_ca_dx + C_k * edge_ab_dx) / area
+# o_plane_dy[k]: (A_k * edge_bc_dy + B_k * edge_ca_dy + C_k * edge_ab_dy) / area
+#
+# all in Q8.24. the division is done with a single reciprocal of the area,
+# normalised so that it keeps 32 significant bits however big the triangle is.
+# it takes one bit per cycle, and then one cycle per output, so a triangle
+# takes 3 * channels + 34 cycles including the one it is taken in. it uses the
+# same handshakes as TriangleSetup, except that the inputs are only read in the
+# cycle a triangle is taken, and o_ready stays low while it works on one: a
+# PlaneSetup shared by a stream of triangles takes one every 3 * channels + 34
+# cycles at most, and holds up the rest. o_busy is set while it is working, or
+# its result is waiting to be transferred out.
+#
+# `precision`, a precision.Precision, sets the widths of the edge functions,
+# the area and the deltas, as it does for TriangleSetup, whose outputs these
+# are. the area is normalised in 32 bits, so its edge functions can be no wider.
+class PlaneSetup(Elaboratable):
+    def __init__(self, channels=6, precision=None):
+        if precision is None:
+            precision = Precision()
+        if precision.edge_bits > 32:
+            raise ValueError("PlaneSetup takes edge functions of up to 32 bits, not {}"
+                             .format(precision.edge_bits))
+
+        self.channels   = channels
+        self.precision  = precision
+
+        self.i_edge_ab  = Signal(signed(precision.edge_bits))
+        self.i_edge_bc  = Signal(signed(precision.edge_bits))
+        self.i_edge_ca  = Signal(signed(precision.edge_bits))
+        self.i_tri_area = Signal(signed(precision.edge_bits))
+
+        self.i_edge_ab_dx = Signal(signed(precision.delta_bits))
+        self.i_edge_ab_dy = Signal(signed(precision.delta_bits))
+        self.i_edge_bc_dx = Signal(signed(precision.delta_bits))
+        self.i_edge_bc_dy = Signal(signed(precision.delta_bits))
+        self.i_edge_ca_dx = Signal(signed(precision.delta_bits))
+        self.i_edge_ca_dy = Signal(signed(precision.delta_bits))
 
-                    self.o_edge_ab_dx.eq(b_y - a_y),
-                    self.o_edge_ab_dy.eq(a_x - b_x),
-                    self.o_edge_bc_dx.eq(c_y - b_y),
-                    self.o_edge_bc_dy.eq(b_x - c_x),
-                    self.o_edge_ca_dx.eq(a_y - c_y),
-                    self.o_edge_ca_dy.eq(c_x - a_x),
+        self.i_attr_a   = [Signal(signed(16), name="i_attr_a{}".format(k)) for k in range(channels)]
+        self.i_attr_b   = [Signal(signed(16), name="i_attr_b{}".format(k)) for k in range(channels)]
+        self.i_attr_c   = [Signal(signed(16), name="i_attr_c{}".format(k)) for k in range(channels)]
+        self.i_start    = Signal()
+        self.o_ready    = Signal()
 
-                    self.o_valid.eq(1),
+        self.o_plane    = [Signal(signed(32), name="o_plane{}".format(k)) for k in range(channels)]
+        self.o_plane_dx = [Signal(signed(32), name="o_plane{}_dx".format(k)) for k in range(channels)]
+        self.o_plane_dy = [Signal(signed(32), name="o_plane{}_dy".format(k)) for k in range(channels)]
+        self.o_valid    = Signal()
+        self.i_ready    = Signal(reset=1)
+        self.o_busy     = Signal()
+
+    def elaborate(self, _):
+        m = Module()
+
+        # the triangle, held for the duration of the setup.
+        edges  = [Signal.like(edge, name="held_" + edge.name) for edge in
+                  [self.i_edge_bc, self.i_edge_ca, self.i_edge_ab]]
+        dxs    = [Signal.like(dx, name="held_" + dx.name) for dx in
+                  [self.i_edge_bc_dx, self.i_edge_ca_dx, self.i_edge_ab_dx]]
+        dys    = [Signal.like(dy, name="held_" + dy.name) for dy in
+                  [self.i_edge_bc_dy, self.i_edge_ca_dy, self.i_edge_ab_dy]]
+        attrs  = [[Signal.like(attr, name="held_" + attr.name) for attr in vertex]
+                  for vertex in [self.i_attr_a, self.i_attr_b, self.i_attr_c]]
+        inputs = [self.i_edge_bc, self.i_edge_ca, self.i_edge_ab,
+                  self.i_edge_bc_dx, self.i_edge_ca_dx, self.i_edge_ab_dx,
+                  self.i_edge_bc_dy, self.i_edge_ca_dy, self.i_edge_ab_dy,
+                  *self.i_attr_a, *self.i_attr_b, *self.i_attr_c]
+        held   = [*edges, *dxs, *dys, *attrs[0], *attrs[1], *attrs[2]]
+
+        # normalise |area| into [2**31, 2**32). the reciprocal is then
+        # 2**63 / (|area| << lz), and since the outputs are in Q8.24 against
+        # Q8.8 attributes, each one is (dot * reciprocal) >> (47 - lz).
+        negative  = Signal()
+        magnitude = Signal(32)
+        lz        = Signal(range(32))
+        m.d.comb += magnitude.eq(Mux(self.i_tri_area < 0, -self.i_tri_area, self.i_tri_area))
+        for i in range(32):
+            with m.If(magnitude[i]):
+                m.d.comb += lz.eq(31 - i)
+
+        area_n = Signal(32)
+        shift  = Signal(range(48))
+
+        # restoring division of 2**63 - 1 by the normalised area, which leaves a
+        # 32-bit reciprocal. the low half of the numerator is all ones.
+        remainder  = Signal(33)
+        reciprocal = Signal(32)
+        bit        = Signal(range(32))
+        trial      = Cat(C(1, 1), remainder[:32])
+
+        # then each output is a three term dot product and a multiply by the
+        # reciprocal, one after the other; (edges, dxs, dys) per channel.
+        outputs  = [output for k in range(self.channels)
+                    for output in (self.o_plane[k], self.o_plane_dx[k], self.o_plane_dy[k])]
+        operands = [(k, terms) for k in range(self.channels) for terms in (edges, dxs, dys)]
+
+        index     = Signal(range(len(outputs) + 1))
+        dot       = Signal(signed(16 + self.precision.edge_bits + 3))
+        dot_index = Signal(range(len(outputs)))
+        dot_valid = Signal()
+
+        def select(values):
+            return Array(values)[index]
+
+        dot_product = sum(select([attrs[v][k] for k, _ in operands]) * select([terms[v] for _, terms in operands])
+                          for v in range(3))
+
+        m.d.sync += [
+            self.o_valid.eq(self.o_valid & ~self.i_ready),
+            dot_valid.eq(0),
+        ]
+
+        with m.If(dot_valid):
+            m.d.sync += Array(outputs)[dot_index].eq((dot * reciprocal) >> shift)
+
+        with m.FSM() as fsm:
+            with m.State("START"):
+                # the previous result must be gone before it gets overwritten.
+                m.d.comb += self.o_ready.eq(~self.o_valid | self.i_ready)
+                with m.If(self.i_start & self.o_ready):
+                    m.d.sync += [h.eq(i) for h, i in zip(held, inputs)]
+                    m.d.sync += [
+                        negative.eq(self.i_tri_area < 0),
+                        area_n.eq(magnitude << lz),
+                        shift.eq(47 - lz),
+                        remainder.eq((1 << 31) - 1),
+                        bit.eq(31),
+                    ]
+                    m.next = "DIVIDE"
+            with m.State("DIVIDE"):
+                with m.If(trial >= area_n):
+                    m.d.sync += remainder.eq(trial - area_n)
+                with m.Else():
+                    m.d.sync += remainder.eq(trial)
+                m.d.sync += [
+                    reciprocal.eq(Cat(trial >= area_n, reciprocal[:-1])),
+                    bit.eq(bit - 1),
                 ]
-                m.next = "START"
+                with m.If(bit == 0):
+                    m.d.sync += index.eq(0)
+                    m.next = "PLANES"
+            with m.State("PLANES"):
+                with m.If(index != len(outputs)):
+                    m.d.sync += [
+                        dot.eq(Mux(negative, -dot_product, dot_product)),
+                        dot_index.eq(index),
+                        dot_valid.eq(1),
+                        index.eq(index + 1),
+                    ]
+                with m.Else():
+                    # the final product is being written in this cycle.
+                    m.d.sync += self.o_valid.eq(1)
+                    m.next = "START"
+
+        m.d.comb += self.o_busy.eq(~fsm.ongoing("START") | self.o_valid)
 
         return m
 
 
-class FragmentInTriangleTest(Elaboratable):
-    def __init__(self):
+# per-triangle attributes, in a memory indexed by a small triangle ID. rather
+# than carrying every attribute of their triangle down the pipeline, fragments
+# can carry just its ID, and stages that need the attributes read them back
+# from one of the store's read ports.
+#
+# a triangle's attributes are written by setting i_w_en with i_w_id and the
+# i_tri_* inputs. IDs are handed out by the writer; it must not reuse an ID
+# while fragments of the triangle that last had it are still in flight.
+#
+# each read port returns the attributes for i_id on its o_tri_* outputs one
+# cycle later.
+class TriangleAttributePort:
+    def __init__(self, id_bits, name):
+        self.i_id         = Signal(id_bits, name=name + "_i_id")
+
+        self.o_tri_xy_a   = Signal(32, name=name + "_o_tri_xy_a")
+        self.o_tri_xy_b   = Signal(32, name=name + "_o_tri_xy_b")
+        self.o_tri_xy_c   = Signal(32, name=name + "_o_tri_xy_c")
+        self.o_tri_wz_a   = Signal(32, name=name + "_o_tri_wz_a")
+        self.o_tri_wz_b   = Signal(32, name=name + "_o_tri_wz_b")
+        self.o_tri_wz_c   = Signal(32, name=name + "_o_tri_wz_c")
+        self.o_tri_rgba_a = Signal(32, name=name + "_o_tri_rgba_a")
+        self.o_tri_rgba_b = Signal(32, name=name + "_o_tri_rgba_b")
+        self.o_tri_rgba_c = Signal(32, name=name + "_o_tri_rgba_c")
+        self.o_tri_area   = Signal(signed(32), name=name + "_o_tri_area")
+
+    def fields(self):
+        return [
+            self.o_tri_xy_a, self.o_tri_xy_b, self.o_tri_xy_c,
+            self.o_tri_wz_a, self.o_tri_wz_b, self.o_tri_wz_c,
+            self.o_tri_rgba_a, self.o_tri_rgba_b, self.o_tri_rgba_c,
+            self.o_tri_area,
+        ]
+
+
+class TriangleAttributeStore(Elaboratable):
+    def __init__(self, id_bits=4, read_ports=1):
+        self.id_bits = id_bits
+
+        self.i_w_en       = Signal()
+        self.i_w_id       = Signal(id_bits)
         self.i_tri_xy_a   = Signal(32)
         self.i_tri_xy_b   = Signal(32)
         self.i_tri_xy_c   = Signal(32)
@@ -184,72 +576,436 @@ class FragmentInTriangleTest(Elaboratable):
         self.i_tri_rgba_a = Signal(32)
         self.i_tri_rgba_b = Signal(32)
         self.i_tri_rgba_c = Signal(32)
+        self.i_tri_area   = Signal(signed(32))
+
+        self.read_ports = [TriangleAttributePort(id_bits, "read{}".format(i)) for i in range(read_ports)]
+
+    def elaborate(self, _):
+        m = Module()
+
+        attributes = Cat(
+            self.i_tri_xy_a, self.i_tri_xy_b, self.i_tri_xy_c,
+            self.i_tri_wz_a, self.i_tri_wz_b, self.i_tri_wz_c,
+            self.i_tri_rgba_a, self.i_tri_rgba_b, self.i_tri_rgba_c,
+            self.i_tri_area,
+        )
+
+        memory = Memory(width=len(attributes), depth=1 << self.id_bits)
+
+        m.submodules.write = write = memory.write_port()
+        m.d.comb += [
+            write.en.eq(self.i_w_en),
+            write.addr.eq(self.i_w_id),
+            write.data.eq(attributes),
+        ]
+
+        for i, port in enumerate(self.read_ports):
+            m.submodules["read{}".format(i)] = read = memory.read_port(transparent=False)
+            m.d.comb += [
+                read.addr.eq(port.i_id),
+                Cat(*port.fields()).eq(read.data),
+            ]
+
+        return m
+
+
+# with id_bits set, fragments carry i_tri_id instead of their triangle's
+# attributes and area, which can be looked up in a TriangleAttributeStore.
+#
+# the edge functions and the area are `precision`'s edge_bits wide, 32 by
+# default.
+#
+# with counters set, `counters` is a PerformanceCounters over:
+#
+# - fragments_in:       fragments tested (cycles with i_valid).
+# - fragments_covered:  fragments passed on.
+# - fragments_rejected: fragments dropped as outside the triangle.
+class FragmentInTriangleTest(Elaboratable):
+    def __init__(self, id_bits=None, counters=False, precision=None):
+        if precision is None:
+            precision = Precision()
+
+        self.id_bits   = id_bits
+        self.precision = precision
+        edge_bits      = precision.edge_bits
+
+        if id_bits is None:
+            self.i_tri_xy_a   = Signal(32)
+            self.i_tri_xy_b   = Signal(32)
+            self.i_tri_xy_c   = Signal(32)
+            self.i_tri_wz_a   = Signal(32)
+            self.i_tri_wz_b   = Signal(32)
+            self.i_tri_wz_c   = Signal(32)
+            self.i_tri_rgba_a = Signal(32)
+            self.i_tri_rgba_b = Signal(32)
+            self.i_tri_rgba_c = Signal(32)
+        else:
+            self.i_tri_id     = Signal(id_bits)
         self.i_pnt_xy     = Signal(32)
         self.i_valid      = Signal()
 
-        self.i_edge_ab   = Signal(signed(32))
-        self.i_edge_bc   = Signal(signed(32))
-        self.i_edge_ca   = Signal(signed(32))
-        self.i_tri_area  = Signal(signed(32))
+        self.i_edge_ab   = Signal(signed(edge_bits))
+        self.i_edge_bc   = Signal(signed(edge_bits))
+        self.i_edge_ca   = Signal(signed(edge_bits))
+        if id_bits is None:
+            self.i_tri_area  = Signal(signed(edge_bits))
 
-        self.o_tri_xy_a   = Signal(32)
-        self.o_tri_xy_b   = Signal(32)
-        self.o_tri_xy_c   = Signal(32)
-        self.o_tri_wz_a   = Signal(32)
-        self.o_tri_wz_b   = Signal(32)
-        self.o_tri_wz_c   = Signal(32)
-        self.o_tri_rgba_a = Signal(32)
-        self.o_tri_rgba_b = Signal(32)
-        self.o_tri_rgba_c = Signal(32)
+        if id_bits is None:
+            self.o_tri_xy_a   = Signal(32)
+            self.o_tri_xy_b   = Signal(32)
+            self.o_tri_xy_c   = Signal(32)
+            self.o_tri_wz_a   = Signal(32)
+            self.o_tri_wz_b   = Signal(32)
+            self.o_tri_wz_c   = Signal(32)
+            self.o_tri_rgba_a = Signal(32)
+            self.o_tri_rgba_b = Signal(32)
+            self.o_tri_rgba_c = Signal(32)
+        else:
+            self.o_tri_id     = Signal(id_bits)
         self.o_pnt_xy     = Signal(32)
         self.o_valid      = Signal()
 
-        self.o_edge_ab   = Signal(signed(32))
-        self.o_edge_bc   = Signal(signed(32))
-        self.o_edge_ca   = Signal(signed(32))
-        self.o_tri_area  = Signal(signed(32))
+        self.o_edge_ab   = Signal(signed(edge_bits))
+        self.o_edge_bc   = Signal(signed(edge_bits))
+        self.o_edge_ca   = Signal(signed(edge_bits))
+        if id_bits is None:
+            self.o_tri_area  = Signal(signed(edge_bits))
+
+        self.latency = 1
+
+        self.inside = Signal()
+        self.counters = None
+        if counters:
+            self.counters = PerformanceCounters([
+                ("fragments_in",       self.i_valid),
+                ("fragments_covered",  self.i_valid & self.inside),
+                ("fragments_rejected", self.i_valid & ~self.inside),
+            ])
 
     def elaborate(self, _):
         m = Module()
 
+        if self.counters is not None:
+            m.submodules.counters = self.counters
+
+        m.d.comb += self.inside.eq((self.i_edge_ab < 0) & (self.i_edge_bc < 0) & (self.i_edge_ca < 0))
+
+        # everything follows the test down its `latency` stages.
+        sideband = [
+            (self.o_valid,   self.i_valid & self.inside),
+            (self.o_pnt_xy,  self.i_pnt_xy),
+            (self.o_edge_ab, self.i_edge_ab),
+            (self.o_edge_bc, self.i_edge_bc),
+            (self.o_edge_ca, self.i_edge_ca),
+        ]
+        if self.id_bits is None:
+            sideband += [
+                (self.o_tri_xy_a,   self.i_tri_xy_a),
+                (self.o_tri_xy_b,   self.i_tri_xy_b),
+                (self.o_tri_xy_c,   self.i_tri_xy_c),
+                (self.o_tri_wz_a,   self.i_tri_wz_a),
+                (self.o_tri_wz_b,   self.i_tri_wz_b),
+                (self.o_tri_wz_c,   self.i_tri_wz_c),
+                (self.o_tri_rgba_a, self.i_tri_rgba_a),
+                (self.o_tri_rgba_b, self.i_tri_rgba_b),
+                (self.o_tri_rgba_c, self.i_tri_rgba_c),
+                (self.o_tri_area,   self.i_tri_area),
+            ]
+        else:
+            sideband += [(self.o_tri_id, self.i_tri_id)]
+
+        for output, value in sideband:
+            m.d.comb += output.eq(delay(m, value, self.latency))
+
+        return m
+
+
+# FragmentCompactor sits between FragmentInTriangleTest and FragmentZTransform,
+# and packs the fragments that pass the coverage test into dense cycles, so
+# that the slots the test rejected never reach the reciprocal. without it,
+# every fragment tested takes a slot all the way down the reciprocal's
+# pipeline, covered or not; with it, the reciprocal only has to keep up with
+# the rate of covered fragments, which leaves room for a narrower or
+# time-shared one.
+#
+# fragments come in with FragmentInTriangleTest's outputs: i_valid is its
+# o_valid, already clear for uncovered points, and the other inputs are its
+# o_pnt_xy, o_edge_* and o_tri_* (or o_tri_id, with id_bits set). only valid
+# fragments are kept, in a FIFO of `depth` entries, and come out in order on
+# the matching o_* outputs, with o_valid; a fragment is passed on when o_valid
+# and i_ready are both high. i_ready may be left at its reset value of 1 if the
+# consumer can always take a fragment.
+#
+# the coverage test cannot be stalled, so backpressure goes to whatever feeds
+# it: o_ready is high while the FIFO has room for `skid` fragments beyond those
+# already in it, and a point should only be offered to the test while it is.
+# skid must be at least the test's latency, so that the fragments still in
+# the test when o_ready falls land in the FIFO rather than being lost.
+#
+# with counters set, `counters` is a PerformanceCounters over:
+#
+# - fragments_in:  fragments taken.
+# - fragments_out: fragments passed on.
+# - stalls:        cycles o_ready was low, holding the coverage test off.
+# - bubbles:       cycles the consumer was ready but had nothing to take.
+# - occupancy:     fragments held, added up every cycle; over the cycles run,
+#                  the average occupancy of the FIFO.
+class FragmentCompactor(Elaboratable):
+    def __init__(self, depth=4, skid=1, id_bits=None, counters=False, precision=None):
+        if precision is None:
+            precision = Precision()
+        if skid < 1 or depth <= skid:
+            raise ValueError("FIFO depth {} must be larger than a skid of at least one, not {}".format(depth, skid))
+
+        self.depth     = depth
+        self.skid      = skid
+        self.id_bits   = id_bits
+        self.precision = precision
+
+        # the fields of a fragment, as FragmentInTriangleTest's outputs have
+        # them; each has an i_ and an o_ signal here.
+        self.fields = [("pnt_xy", 32)]
+        self.fields += [(name, signed(precision.edge_bits)) for name in ("edge_ab", "edge_bc", "edge_ca")]
+        if id_bits is None:
+            self.fields += [("tri_" + name, 32) for name in ("xy_a", "xy_b", "xy_c", "wz_a", "wz_b", "wz_c",
+                                                              "rgba_a", "rgba_b", "rgba_c")]
+            self.fields += [("tri_area", signed(precision.edge_bits))]
+        else:
+            self.fields += [("tri_id", id_bits)]
+        for name, shape in self.fields:
+            setattr(self, "i_" + name, Signal(shape, name="i_" + name))
+            setattr(self, "o_" + name, Signal(shape, name="o_" + name))
+
+        self.i_valid = Signal()
+        self.o_ready = Signal()
+        self.o_valid = Signal()
+        self.i_ready = Signal(reset=1)
+
+        self.level = Signal(range(depth + 1))
+        self.counters = None
+        if counters:
+            self.counters = PerformanceCounters([
+                ("fragments_in",  self.i_valid),
+                ("fragments_out", self.o_valid & self.i_ready),
+                ("stalls",        ~self.o_ready),
+                ("bubbles",       ~self.o_valid & self.i_ready),
+                ("occupancy",     self.level),
+            ])
+
+    def elaborate(self, _):
+        m = Module()
+
+        if self.counters is not None:
+            m.submodules.counters = self.counters
+
+        inputs  = [getattr(self, "i_" + name) for name, _ in self.fields]
+        outputs = [getattr(self, "o_" + name) for name, _ in self.fields]
+
+        m.submodules.fifo = fifo = SyncFIFO(width=len(Cat(*inputs)), depth=self.depth)
+        m.d.comb += [
+            fifo.w_data.eq(Cat(*inputs)),
+            fifo.w_en.eq(self.i_valid),
+            self.o_ready.eq(fifo.level <= self.depth - 1 - self.skid),
+
+            Cat(*outputs).eq(fifo.r_data),
+            self.o_valid.eq(fifo.r_rdy),
+            fifo.r_en.eq(self.i_ready),
+
+            self.level.eq(fifo.level),
+        ]
+
+        return m
+
+
+# reciprocal engines for FragmentZTransform. each one takes a 32-bit unsigned
+# denominator on i_d and produces o_q = floor(2**31 / i_d), or 0xFFFFFFFF for a
+# denominator of zero, `latency` cycles later. they are fully pipelined, so a
+# new denominator can be presented every cycle.
+
+
+# non-restoring division, as originally used in FragmentZTransform.
+#
+# See: https://en.wikipedia.org/wiki/Division_algorithm#Non-restoring_division
+#
+# each of the 32 iterations produces one quotient bit. stage_bits of them are
+# done between each pair of pipeline registers: stage_bits=1 is the original
+# radix-2 pipeline, stage_bits=2 retires two bits (one radix-4 digit) a stage,
+# halving latency and registers at the cost of a longer path per stage.
+#
+# alternatively, `stages` spreads the iterations over that many stages, as
+# evenly as stages.schedule() can, whether or not it divides 32.
+class NonRestoringReciprocal(Elaboratable):
+    def __init__(self, stage_bits=1, stages=None):
+        if stages is None:
+            if stage_bits < 1 or 32 % stage_bits:
+                raise ValueError("stage_bits must divide 32, not {}".format(stage_bits))
+            stages = 32 // stage_bits
+        elif stages < 1 or stages > 32:
+            raise ValueError("stages must be from 1 to 32, not {}".format(stages))
+
+        self.stages  = stages
+        self.latency = stages + 2
+
+        self.i_d = Signal(32)
+        self.o_q = Signal(32)
+
+    def elaborate(self, _):
+        m = Module()
+
+        names = ["remainder", "denominator", "quotient"]
+
+        # the remainder needs to be signed for the sign test to mean anything,
+        # and 66 bits wide to hold 2 * remainder - (denominator << 32).
+        r, d, q = stage(m, [
+            C(1 << 31, signed(66)), # 1.0 as numerator
+            self.i_d,
+            C(0, 32),
+        ], names=names)
+
+        for count in schedule(32, self.stages):
+            non_negative = r >= 0
+            r_next = Signal(signed(66))
+            m.d.comb += r_next.eq(Mux(non_negative,
+                r.shift_left(1) - (d << 32),
+                r.shift_left(1) + (d << 32)))
+            r, d, q = stage(m, [r_next, d, Cat(non_negative, q[:-1])], count, names=names)
+
+        # convert the quotient digits from {-1, 1} to binary, and correct for a
+        # negative final remainder.
+        m.d.sync += self.o_q.eq(q - ~q - (r < 0))
+
+        return m
+
+
+# lookup table seed, followed by Newton-Raphson refinement.
+#
+# the denominator is normalised to m in [1, 2) by a leading zero count. a 256
+# entry table indexed by the next eight bits of m gives a seed y ~= 1/m good to
+# about nine bits, and each iteration of y' = y * (2 - m * y) doubles that.
+# with the values kept in Q1.31, two iterations leave y at most one unit short
+# once shifted back, so a final multiply-and-compare against the numerator
+# makes the result exact. a single iteration leaves it further out than that
+# can correct, so at least two are needed.
+class NewtonReciprocal(Elaboratable):
+    SEED_BITS = 8
+
+    def __init__(self, iterations=2):
+        if iterations < 2:
+            raise ValueError("NewtonReciprocal needs at least 2 iterations to be exact, not {}".format(iterations))
+
+        self.iterations = iterations
+        self.latency    = 2 * iterations + 5
+
+        self.i_d = Signal(32)
+        self.o_q = Signal(32)
+
+    def elaborate(self, _):
+        m = Module()
+
+        k = self.SEED_BITS
+
+        # 1: normalise.
+        zero = self.i_d == 0
+        lz   = Signal(range(32))
+        for i in range(32):
+            with m.If(self.i_d[i]):
+                m.d.comb += lz.eq(31 - i)
+
+        d1, m1, lz1, zero1 = Signal(32), Signal(32), Signal(range(32)), Signal()
         m.d.sync += [
-            self.o_valid.eq(self.i_valid & (self.i_edge_ab < 0) & (self.i_edge_bc < 0) & (self.i_edge_ca < 0)),
-
-            self.o_tri_xy_a.eq(self.i_tri_xy_a),
-            self.o_tri_xy_b.eq(self.i_tri_xy_b),
-            self.o_tri_xy_c.eq(self.i_tri_xy_c),
-            self.o_tri_wz_a.eq(self.i_tri_wz_a),
-            self.o_tri_wz_b.eq(self.i_tri_wz_b),
-            self.o_tri_wz_c.eq(self.i_tri_wz_c),
-            self.o_tri_rgba_a.eq(self.i_tri_rgba_a),
-            self.o_tri_rgba_b.eq(self.i_tri_rgba_b),
-            self.o_tri_rgba_c.eq(self.i_tri_rgba_c),
-            self.o_pnt_xy.eq(self.i_pnt_xy),
-            self.o_edge_ab.eq(self.i_edge_ab),
-            self.o_edge_bc.eq(self.i_edge_bc),
-            self.o_edge_ca.eq(self.i_edge_ca),
-            self.o_tri_area.eq(self.i_tri_area),
+            d1.eq(self.i_d),
+            m1.eq(self.i_d << lz),
+            lz1.eq(lz),
+            zero1.eq(zero),
         ]
 
+        # 2: seed, 1 / the middle of each of the table's intervals.
+        seeds = [((1 << (k + 1)) << 31) // (2 * ((1 << k) + i) + 1) for i in range(1 << k)]
+        seed  = Memory(width=32, depth=1 << k, init=seeds)
+        m.submodules.seed = seed_port = seed.read_port(transparent=False)
+
+        d, mant, shift, is_zero = Signal(32), Signal(32), Signal(range(32)), Signal()
+        m.d.comb += seed_port.addr.eq(m1[31 - k:31])
+        m.d.sync += [
+            d.eq(d1),
+            mant.eq(m1),
+            shift.eq(31 - lz1),
+            is_zero.eq(zero1),
+        ]
+        y = seed_port.data
+
+        # 3..: Newton-Raphson, two stages per iteration.
+        def carry(*signals):
+            return stage(m, signals)
+
+        for _ in range(self.iterations):
+            e = Signal(33)
+            y_held = Signal(32)
+            m.d.sync += [
+                e.eq((2 << 31) - ((mant * y) >> 31)),
+                y_held.eq(y),
+            ]
+            d, mant, shift, is_zero = carry(d, mant, shift, is_zero)
+
+            y = Signal(32)
+            m.d.sync += y.eq((y_held * e) >> 31)
+            d, mant, shift, is_zero = carry(d, mant, shift, is_zero)
+
+        # denormalise.
+        q_est = Signal(32)
+        m.d.sync += q_est.eq(y >> shift)
+        d, is_zero = carry(d, is_zero)
+
+        # correct the estimate, which is either exact or one short.
+        remainder = Signal(signed(34))
+        m.d.sync += remainder.eq((1 << 31) - q_est * d)
+        q_est, d, is_zero = carry(q_est, d, is_zero)
+
+        m.d.sync += self.o_q.eq(Mux(is_zero, 0xFFFFFFFF, q_est + (remainder >= d)))
+
         return m
 
 
+# FragmentZTransform takes 1/w to z for each fragment, and its results appear
+# `latency` cycles (the reciprocal's latency) after the fragment, with
+# everything else about the fragment delayed to match.
+#
+# with attributes set to a TriangleAttributePort, fragments carry i_tri_id
+# instead of their triangle's attributes and area. the port is read one cycle
+# before the reciprocal is ready, so o_tri_* line up with o_pnt_z as before.
+#
+# the edge functions and the area are `precision`'s edge_bits wide, 32 by
+# default, as they are for FragmentInTriangleTest and FragmentCompactor.
 class FragmentZTransform(Elaboratable):
-    def __init__(self):
-        self.i_tri_xy_a   = Signal(32)
-        self.i_tri_xy_b   = Signal(32)
-        self.i_tri_xy_c   = Signal(32)
-        self.i_tri_rgba_a = Signal(32)
-        self.i_tri_rgba_b = Signal(32)
-        self.i_tri_rgba_c = Signal(32)
+    def __init__(self, reciprocal=None, attributes=None, precision=None):
+        if reciprocal is None:
+            reciprocal = NonRestoringReciprocal()
+        if precision is None:
+            precision = Precision()
+        self.reciprocal = reciprocal
+        self.attributes = attributes
+        self.precision  = precision
+        self.latency    = reciprocal.latency
+        edge_bits       = precision.edge_bits
+
+        if attributes is None:
+            self.i_tri_xy_a   = Signal(32)
+            self.i_tri_xy_b   = Signal(32)
+            self.i_tri_xy_c   = Signal(32)
+            self.i_tri_rgba_a = Signal(32)
+            self.i_tri_rgba_b = Signal(32)
+            self.i_tri_rgba_c = Signal(32)
+        else:
+            self.i_tri_id     = Signal(len(attributes.i_id))
         self.i_pnt_xy     = Signal(32)
         self.i_pnt_wz     = Signal(32)
         self.i_valid      = Signal()
 
-        self.i_edge_ab   = Signal(signed(32))
-        self.i_edge_bc   = Signal(signed(32))
-        self.i_edge_ca   = Signal(signed(32))
-        self.i_tri_area  = Signal(signed(32))
+        self.i_edge_ab   = Signal(signed(edge_bits))
+        self.i_edge_bc   = Signal(signed(edge_bits))
+        self.i_edge_ca   = Signal(signed(edge_bits))
+        if attributes is None:
+            self.i_tri_area  = Signal(signed(edge_bits))
 
         self.o_tri_xy_a   = Signal(32)
         self.o_tri_xy_b   = Signal(32)
@@ -257,100 +1013,756 @@ class FragmentZTransform(Elaboratable):
         self.o_tri_rgba_a = Signal(32)
         self.o_tri_rgba_b = Signal(32)
         self.o_tri_rgba_c = Signal(32)
+        if attributes is not None:
+            self.o_tri_id     = Signal(len(attributes.i_id))
         self.o_pnt_xy     = Signal(32)
         self.o_pnt_z      = Signal(32)
         self.o_valid      = Signal()
 
-        self.o_edge_ab   = Signal(signed(32))
-        self.o_edge_bc   = Signal(signed(32))
-        self.o_edge_ca   = Signal(signed(32))
-        self.o_tri_area  = Signal(signed(32))        
+        self.o_edge_ab   = Signal(signed(edge_bits))
+        self.o_edge_bc   = Signal(signed(edge_bits))
+        self.o_edge_ca   = Signal(signed(edge_bits))
+        self.o_tri_area  = Signal(signed(edge_bits))
 
     def elaborate(self, _):
         m = Module()
 
         # Division is misery.
-        #
-        # See: https://en.wikipedia.org/wiki/Division_algorithm#Non-restoring_division
-        remainder = [Signal(64) for _ in range(33)]
-        denominator = [Signal(64) for _ in range(33)]
-        quotient = [Signal(32) for _ in range(33)]
+        m.submodules.reciprocal = reciprocal = self.reciprocal
+
+        m.d.comb += [
+            reciprocal.i_d.eq(self.i_pnt_wz),
+            self.o_pnt_z.eq(reciprocal.o_q),
+        ]
+
+        # everything else has to wait for the reciprocal.
+        sideband = [
+            (self.o_valid,      self.i_valid),
+            (self.o_pnt_xy,     self.i_pnt_xy),
+            (self.o_edge_ab,    self.i_edge_ab),
+            (self.o_edge_bc,    self.i_edge_bc),
+            (self.o_edge_ca,    self.i_edge_ca),
+        ]
+        if self.attributes is None:
+            sideband += [
+                (self.o_tri_xy_a,   self.i_tri_xy_a),
+                (self.o_tri_xy_b,   self.i_tri_xy_b),
+                (self.o_tri_xy_c,   self.i_tri_xy_c),
+                (self.o_tri_rgba_a, self.i_tri_rgba_a),
+                (self.o_tri_rgba_b, self.i_tri_rgba_b),
+                (self.o_tri_rgba_c, self.i_tri_rgba_c),
+                (self.o_tri_area,   self.i_tri_area),
+            ]
+        else:
+            # look the attributes up one cycle early to hide the read latency.
+            tri_id = delay(m, self.i_tri_id, reciprocal.latency - 1)
+
+            port = self.attributes
+            m.d.comb += [
+                port.i_id.eq(tri_id),
+                self.o_tri_id.eq(delay(m, tri_id, 1)),
+                self.o_tri_xy_a.eq(port.o_tri_xy_a),
+                self.o_tri_xy_b.eq(port.o_tri_xy_b),
+                self.o_tri_xy_c.eq(port.o_tri_xy_c),
+                self.o_tri_rgba_a.eq(port.o_tri_rgba_a),
+                self.o_tri_rgba_b.eq(port.o_tri_rgba_b),
+                self.o_tri_rgba_c.eq(port.o_tri_rgba_c),
+                self.o_tri_area.eq(port.o_tri_area),
+            ]
 
+        for output, value in sideband:
+            m.d.comb += output.eq(delay(m, value, reciprocal.latency))
+
+        return m
+
+
+# DepthTest is an early depth test for the fragments coming out of
+# FragmentZTransform, against a width x height depth buffer in a Memory. a
+# fragment passes if its i_pnt_z is greater than the depth stored for its pixel
+# (o_pnt_z is 2**31 / w, so greater is nearer), which is then replaced by it.
+# fragments outside the frame never pass. o_valid is set for passing fragments
+# `latency` cycles after they are presented, with o_pnt_xy and o_pnt_z (and
+# o_tri_id, with id_bits set) alongside.
+#
+# on top of the depth buffer sits a coarse one, with a record per tile x tile
+# square of pixels:
+#
+# - zmin, the farthest depth that can be stored for any pixel of the tile. a
+#   fragment at or behind zmin is rejected without reference to the depth
+#   buffer.
+# - zmax, the nearest. a fragment in front of zmax is accepted likewise.
+# - a mask of the pixels written since zmin was last raised, and the farthest
+#   depth written to them. once every pixel has been written, that depth
+#   becomes zmin, since the depth stored for a pixel only ever increases.
+#
+# fragments are only compared against the depth buffer when the coarse buffer
+# cannot decide; an external depth buffer would only need reading then.
+#
+# the coarse buffer can also be queried for regions larger than a pixel: set
+# i_query_xy to any point in a tile and i_query_z to the nearest depth that a
+# primitive can have over (part of) that tile, and o_query_occluded says, one
+# cycle later, if that primitive is certain to be hidden there. a rasteriser
+# can skip whole tiles or quads this way before their fragments are generated.
+# with query set to more than 1, a query is about the query x query square of
+# pixels from i_query_xy right and down instead, which need not line up with
+# the tiles: it is checked against the tiles its four corners are in, which
+# are all the tiles it overlaps as long as query is at most the tile size, and
+# is occluded if it is in all of them. the square must lie in the frame to be
+# occluded at all. TriangleRender's tiled walk asks about its tiles this way.
+#
+# setting i_clear resets both buffers to a depth of 0, which takes one cycle per
+# pixel; o_ready is low while the buffers are being cleared, and fragments are
+# only taken while it is high.
+#
+# with counters set, `counters` is a PerformanceCounters over:
+#
+# - fragments_in:    fragments taken.
+# - coarse_rejected: fragments rejected by the coarse buffer.
+# - coarse_accepted: fragments accepted by the coarse buffer.
+# - depth_tested:    fragments compared against the depth buffer.
+# - depth_passed:    fragments passed on.
+class DepthTest(Elaboratable):
+    def __init__(self, width=512, height=512, tile=8, id_bits=None, counters=False, query=1):
+        for name, value in [("Width", width), ("Height", height), ("Tile size", tile)]:
+            if value < 1 or value & (value - 1):
+                raise ValueError("{} must be a power of two, not {}".format(name, value))
+        if tile > min(width, height):
+            raise ValueError("Tile size {} is larger than the {}x{} frame".format(tile, width, height))
+        if query < 1 or query > tile:
+            raise ValueError("Query size must be from 1 to the tile size {}, not {}".format(tile, query))
+
+        self.width   = width
+        self.height  = height
+        self.tile    = tile
+        self.id_bits = id_bits
+        self.query   = query
+        self.latency = 2
+
+        self.i_pnt_xy = Signal(32)
+        self.i_pnt_z  = Signal(32)
+        if id_bits is not None:
+            self.i_tri_id = Signal(id_bits)
+        self.i_valid  = Signal()
+        self.o_ready  = Signal()
+
+        self.o_pnt_xy = Signal(32)
+        self.o_pnt_z  = Signal(32)
+        if id_bits is not None:
+            self.o_tri_id = Signal(id_bits)
+        self.o_valid  = Signal()
+
+        self.i_query_xy       = Signal(32)
+        self.i_query_z        = Signal(32)
+        self.o_query_occluded = Signal()
+
+        self.i_clear = Signal()
+
+        self.taken           = Signal()
+        self.coarse_rejected = Signal()
+        self.coarse_accepted = Signal()
+        self.depth_tested    = Signal()
+        self.passed          = Signal()
+
+        self.counters = None
+        if counters:
+            self.counters = PerformanceCounters([
+                ("fragments_in",    self.taken),
+                ("coarse_rejected", self.coarse_rejected),
+                ("coarse_accepted", self.coarse_accepted),
+                ("depth_tested",    self.depth_tested),
+                ("depth_passed",    self.passed),
+            ])
+
+    def elaborate(self, _):
+        m = Module()
+
+        if self.counters is not None:
+            m.submodules.counters = self.counters
+
+        x_bits = self.width.bit_length() - 1
+        y_bits = self.height.bit_length() - 1
+        t_bits = self.tile.bit_length() - 1
+
+        # pixel and tile addresses of a Q12.4 point, and whether it is in frame.
+        def address(xy):
+            x, y = xy[4:16], xy[20:32]
+            return (Cat(x[:x_bits], y[:y_bits]),
+                    Cat(x[t_bits:x_bits], y[t_bits:y_bits]),
+                    Cat(x[:t_bits], y[:t_bits]),
+                    (x[x_bits:] == 0) & (y[y_bits:] == 0))
+
+        pixels = self.width * self.height
+        tiles  = pixels >> (2 * t_bits)
+
+        # a tile record is (zmin, zmax, written, mask).
+        mask_bits = self.tile * self.tile
+        cleared   = C(0xFFFFFFFF << 64, 96 + mask_bits)
+
+        depth  = Memory(width=32, depth=pixels)
+        coarse = Memory(width=len(cleared), depth=tiles, init=[cleared.value] * tiles)
+
+        # both buffers are read as a fragment is taken, and written a cycle
+        # later. the read ports are transparent, so a fragment sees the writes
+        # of the one just ahead of it, even to the same pixel.
+        m.submodules.depth_read   = depth_read   = depth.read_port(transparent=True)
+        m.submodules.depth_write  = depth_write  = depth.write_port()
+        m.submodules.coarse_read  = coarse_read  = coarse.read_port(transparent=True)
+        m.submodules.coarse_write = coarse_write = coarse.write_port()
+
+        pixel, tile, bit, in_frame = address(self.i_pnt_xy)
+
+        clearing    = Signal()
+        clear_index = Signal(range(pixels))
+
+        m.d.comb += [
+            self.o_ready.eq(~clearing & ~self.i_clear),
+            self.taken.eq(self.i_valid & self.o_ready),
+            depth_read.addr.eq(pixel),
+            coarse_read.addr.eq(tile),
+        ]
+
+        # stage 1: the buffers have been read.
+        s1_valid = Signal()
+        s1_xy    = Signal(32)
+        s1_z     = Signal(32)
+        s1_pixel = Signal.like(pixel)
+        s1_tile  = Signal.like(tile)
+        s1_bit   = Signal.like(bit)
         m.d.sync += [
-            remainder[32].eq(1 << 31), # 1.0 as numerator
-            denominator[32].eq(self.i_pnt_wz << 32),
-            quotient[32].eq(0)
+            s1_valid.eq(self.taken & in_frame),
+            s1_xy.eq(self.i_pnt_xy),
+            s1_z.eq(self.i_pnt_z),
+            s1_pixel.eq(pixel),
+            s1_tile.eq(tile),
+            s1_bit.eq(bit),
         ]
+        if self.id_bits is not None:
+            s1_id = Signal(self.id_bits)
+            m.d.sync += s1_id.eq(self.i_tri_id)
 
-        for i in range(32, 0, -1):
-            non_negative = remainder[i] >= 0
-            with m.If(non_negative):
-                m.d.sync += [
-                    quotient[i-1].eq(quotient[i].shift_left(1) | non_negative),
-                    remainder[i-1].eq(remainder[i].shift_left(1) - denominator[i]),
-                ]
-            with m.Else():
+        zmin, zmax, written, mask = (coarse_read.data[0:32], coarse_read.data[32:64],
+                                     coarse_read.data[64:96], coarse_read.data[96:])
+
+        m.d.comb += [
+            self.coarse_rejected.eq(s1_valid & (s1_z <= zmin)),
+            self.coarse_accepted.eq(s1_valid & (s1_z > zmax)),
+            self.depth_tested.eq(s1_valid & ~self.coarse_rejected & ~self.coarse_accepted),
+            self.passed.eq(self.coarse_accepted | (self.depth_tested & (s1_z > depth_read.data))),
+        ]
+
+        new_mask    = mask | (C(1, mask_bits) << s1_bit)
+        new_written = Mux(s1_z < written, s1_z, written)
+        new_zmax    = Mux(s1_z > zmax, s1_z, zmax)
+        full        = new_mask == (1 << mask_bits) - 1
+
+        with m.If(clearing):
+            m.d.comb += [
+                depth_write.addr.eq(clear_index),
+                depth_write.data.eq(0),
+                depth_write.en.eq(1),
+                coarse_write.addr.eq(clear_index),
+                coarse_write.data.eq(cleared),
+                coarse_write.en.eq(clear_index < tiles),
+            ]
+            m.d.sync += clear_index.eq(clear_index + 1)
+            with m.If(clear_index == pixels - 1):
+                m.d.sync += clearing.eq(0)
+        with m.Else():
+            m.d.comb += [
+                depth_write.addr.eq(s1_pixel),
+                depth_write.data.eq(s1_z),
+                depth_write.en.eq(self.passed),
+                coarse_write.addr.eq(s1_tile),
+                coarse_write.data.eq(Mux(full,
+                    Cat(new_written, new_zmax, C(0xFFFFFFFF, 32), C(0, mask_bits)),
+                    Cat(zmin, new_zmax, new_written, new_mask))),
+                coarse_write.en.eq(self.passed),
+            ]
+            with m.If(self.i_clear):
                 m.d.sync += [
-                    quotient[i-1].eq(quotient[i].shift_left(1) | non_negative),
-                    remainder[i-1].eq(remainder[i].shift_left(1) + denominator[i]),
+                    clearing.eq(1),
+                    clear_index.eq(0),
                 ]
-            m.d.sync += denominator[i-1].eq(denominator[i])
 
-        m.d.sync += self.o_pnt_z.eq(quotient[0] - ~quotient[0])
+        m.d.sync += [
+            self.o_valid.eq(self.passed),
+            self.o_pnt_xy.eq(s1_xy),
+            self.o_pnt_z.eq(s1_z),
+        ]
+        if self.id_bits is not None:
+            m.d.sync += self.o_tri_id.eq(s1_id)
+
+        # zmin only ever increases, so a query that races a write is at worst
+        # conservative. a corner that carries out of 16 bits is out of frame.
+        query_z = Signal(32)
+        m.d.sync += query_z.eq(self.i_query_z)
+
+        corners  = [0] if self.query == 1 else [0, (self.query - 1) << 4]
+        occluded = []
+        for j, dy in enumerate(corners):
+            for i, dx in enumerate(corners):
+                corner_x = self.i_query_xy[:16] + dx
+                corner_y = self.i_query_xy[16:] + dy
+                _, query_tile, _, query_in_frame = address(Cat(corner_x[:16], corner_y[:16]))
+                query_valid = Signal(name="query_valid_{}_{}".format(i, j))
+                m.d.sync += query_valid.eq(query_in_frame & ~corner_x[16] & ~corner_y[16])
+
+                coarse_query = coarse.read_port(transparent=False)
+                m.submodules["coarse_query_{}_{}".format(i, j)] = coarse_query
+                m.d.comb += coarse_query.addr.eq(query_tile)
+                occluded.append(query_valid & (query_z <= coarse_query.data[0:32]))
+
+        m.d.comb += self.o_query_occluded.eq(Cat(*occluded).all())
 
         return m
 
 
+# number of flip-flops in a design, as a rough measure of its pipeline cost.
+def register_bits(elaboratable):
+    def count(fragment):
+        bits = sum(len(signal) for domain, signals in fragment.drivers.items() if domain is not None
+                   for signal in signals)
+        return bits + sum(count(subfragment) for subfragment, _ in fragment.subfragments)
+
+    return count(Fragment.get(elaboratable, None))
+
+
 if __name__ == "__main__":
+    import random
+
+    import numpy as np
+
     from amaranth.sim import *
 
-    fitt = FragmentInTriangleTest()
+    def check_reciprocal(engine):
+        random.seed(0)
+        denominators = [0, 1, 2, 3, 0xFFFFFFFF, 0x80000000, 0x7FFFFFFF]
+        denominators += [(1 << k) + o for k in range(1, 32) for o in (-1, 1)]
+        denominators += [random.randrange(1 << random.randrange(1, 33)) for _ in range(2000)]
+
+        def expected(d):
+            return 0xFFFFFFFF if d == 0 else (1 << 31) // d
+
+        def test():
+            mismatches = 0
+            for i in range(len(denominators) + engine.latency):
+                if i < len(denominators):
+                    yield engine.i_d.eq(denominators[i])
+                yield
+                if i >= engine.latency:
+                    if (yield engine.o_q) != expected(denominators[i - engine.latency]):
+                        mismatches += 1
+            print("{}: latency {}, {} register bits, {} mismatches in {} denominators".format(
+                  type(engine).__name__, engine.latency, register_bits(engine), mismatches, len(denominators)))
 
-    def test():
-        def edge(ax, ay, bx, by, cx, cy): # ax, ay, bx, by, cx, cy all Q12.4
-            x = (((cx - ax) * (by - ay)) - ((cy - ay) * (bx - ax))) >> 4 # Q24.4
-            x -= int((ax < bx or (ax == bx and by < ay)))
-            return x
+        sim = Simulator(engine)
+        sim.add_clock(1e-9)
+        sim.add_sync_process(test)
+        sim.run()
+
+    for engine in [NonRestoringReciprocal(), NonRestoringReciprocal(stage_bits=2), NonRestoringReciprocal(stages=12),
+                   NewtonReciprocal(), NewtonReciprocal(iterations=3)]:
+        check_reciprocal(engine)
 
-        a_x, a_y = 0x0949, 0x0449
-        b_x, b_y = 0x1EB6, 0x19B6
-        c_x, c_y = 0x0949, 0x19B6
+    def check_attribute_store(id_bits=4):
+        copy = FragmentZTransform()
+        store = TriangleAttributeStore(id_bits)
+        by_id = FragmentZTransform(attributes=store.read_ports[0])
 
-        canvas = [[0 for _ in range(512)] for _ in range(512)]
+        m = Module()
+        m.submodules.copy = copy
+        m.submodules.store = store
+        m.submodules.by_id = by_id
 
-        yield fitt.i_tri_xy_b.eq(Cat(C(b_x, 16), C(b_y, 16)))
-        yield fitt.i_tri_xy_a.eq(Cat(C(a_x, 16), C(a_y, 16)))
-        yield fitt.i_tri_xy_c.eq(Cat(C(c_x, 16), C(c_y, 16)))
+        outputs = ["o_valid", "o_pnt_xy", "o_pnt_z", "o_edge_ab", "o_edge_bc", "o_edge_ca", "o_tri_area",
+                   "o_tri_xy_a", "o_tri_xy_b", "o_tri_xy_c", "o_tri_rgba_a", "o_tri_rgba_b", "o_tri_rgba_c"]
+        attributes = ["tri_xy_a", "tri_xy_b", "tri_xy_c", "tri_rgba_a", "tri_rgba_b", "tri_rgba_c", "tri_area"]
 
-        for y in range(512):
-            for x in range(512):
-                yield fitt.i_point.eq(Cat(C(x << 4, 16), C(y << 4, 16)))
-                yield fitt.i_edge_ab.eq(edge(a_x, a_y, b_x, b_y, x << 4, y << 4))
-                yield fitt.i_edge_bc.eq(edge(b_x, b_y, c_x, c_y, x << 4, y << 4))
-                yield fitt.i_edge_ca.eq(edge(c_x, c_y, a_x, a_y, x << 4, y << 4))
-                yield fitt.i_tri_area.eq(edge(a_x, a_y, b_x, b_y, c_x, c_y))
-                yield fitt.i_valid.eq(1)
+        def test():
+            random.seed(1)
+            triangles = [{name: random.randrange(1 << 31) for name in attributes} for _ in range(1 << id_bits)]
+            for tri_id, triangle in enumerate(triangles):
+                yield store.i_w_en.eq(1)
+                yield store.i_w_id.eq(tri_id)
+                for name, value in triangle.items():
+                    yield getattr(store, "i_" + name).eq(value)
+                yield
+            yield store.i_w_en.eq(0)
 
+            mismatches = 0
+            for i in range(1000):
+                tri_id = random.randrange(1 << id_bits)
+                for name, value in triangles[tri_id].items():
+                    yield getattr(copy, "i_" + name).eq(value)
+                yield by_id.i_tri_id.eq(tri_id)
+                for name in ["i_valid", "i_pnt_xy", "i_pnt_wz", "i_edge_ab", "i_edge_bc", "i_edge_ca"]:
+                    value = random.randrange(1 << len(getattr(copy, name)))
+                    yield getattr(copy, name).eq(value)
+                    yield getattr(by_id, name).eq(value)
                 yield
+                if i >= copy.reciprocal.latency:
+                    for name in outputs:
+                        if (yield getattr(copy, name)) != (yield getattr(by_id, name)):
+                            mismatches += 1
+                            break
+            print("FragmentZTransform: {} register bits copying attributes, {} carrying a {}-bit ID, {} mismatches".format(
+                  register_bits(FragmentZTransform()),
+                  register_bits(FragmentZTransform(attributes=TriangleAttributePort(id_bits, "read"))),
+                  id_bits, mismatches))
 
-                valid = yield fitt.o_valid
-                if valid:
-                    canvas[y][x] = 1
-        
-        with open("triangle.ppm", "w") as f:
-            f.write("P1\n")
-            f.write("512 512\n")
-            for y in range(0, 512):
-                for x in range(0, 512):
-                    if canvas[y][x] == 1:
-                        f.write("{} ".format(1))
-                    else:
-                        f.write("{} ".format(0))
-                f.write("\n")
-
-    sim = Simulator(fitt)
-    sim.add_clock(1e-9)
-    sim.add_sync_process(test)
-    with sim.write_vcd("test.vcd", "test.gtkw"):
+        sim = Simulator(m)
+        sim.add_clock(1e-9)
+        sim.add_sync_process(test)
         sim.run()
 
+    check_attribute_store()
+
+    import sys
+
+    import golden
+    from capture import FrameCapture, diff
+    from harness import Harness
+    from precision import narrowest
+
+    # FragmentZTransform carrying an ID, with each reciprocal engine and edge
+    # width, against copying the attributes. in every cycle of the
+    # reciprocal's latency, a fragment holds its valid bit, point, edge
+    # functions and ID, so the edge width and the latency matter as much as
+    # the engine's own registers.
+    def check_ztransform_bits(id_bits=4):
+        copying = register_bits(FragmentZTransform())
+        for precision in [Precision(), narrowest(512, 512)]:
+            for engine in [NonRestoringReciprocal(), NewtonReciprocal()]:
+                bits = register_bits(FragmentZTransform(engine, TriangleAttributePort(id_bits, "read"), precision))
+                print("FragmentZTransform with {} and {}-bit edges, carrying a {}-bit ID: {} register bits, "
+                      "{} of them the reciprocal's, {:.1f}x fewer than copying attributes".format(
+                      type(engine).__name__, precision.edge_bits, id_bits, bits, register_bits(engine),
+                      copying / bits))
+
+    check_ztransform_bits()
+
+    # layers of overdraw over a small frame, each covering every pixel in a
+    # random order; the even layers are drawn front to back, so the coarse
+    # buffer rejects most of their fragments.
+    def check_depth_test(size=32, layers=6):
+        rng = np.random.default_rng(0)
+        y, x = np.mgrid[0:size, 0:size].reshape(2, -1)
+        order = [rng.permutation(size * size) for _ in range(layers)]
+        x = np.concatenate([x[o] for o in order]) * 16 + 8
+        y = np.concatenate([y[o] for o in order]) * 16 + 8
+        z = np.concatenate([rng.integers(1, 1 << 32, size * size) if layer % 2 else
+                            rng.integers((layers - layer) << 28, (layers - layer + 1) << 28, size * size)
+                            for layer in range(layers)])
+
+        depth = DepthTest(size, size, counters=True)
+        harness = Harness(depth)
+        rows = harness.run([
+            (depth.i_pnt_xy, np.r_[golden.join_xy(x, y), 0]),
+            (depth.i_pnt_z,  np.r_[z, 0]),
+            (depth.i_valid,  np.r_[np.ones(len(z)), 0]),
+        ], [depth.o_valid], cycles=len(z) + depth.latency + 1)
+        counts = harness.run(outputs=[depth.counters[name] for name in depth.counters.names], cycles=1)[0]
+
+        mismatches = (rows[depth.latency:depth.latency + len(z), 0] != golden.depth_test(x, y, z, size, size)).sum()
+        print("DepthTest: {} mismatches against the golden model; {}".format(mismatches, ", ".join(
+              "{} {}".format(name, count) for name, count in zip(depth.counters.names, counts))))
+
+    check_depth_test()
+
+    # TriangleSetup at the default precision and narrowed to a 512x512 screen,
+    # over random triangles on that screen, each set up at a random point on it.
+    def check_setup_precision(count=500):
+        rng = np.random.default_rng(4)
+        triangles = rng.integers(0, 512 << 4, size=(count, 6))
+        points = rng.integers(0, 512 << 4, size=(count, 2))
+        names = ["edge_ab", "edge_bc", "edge_ca", "tri_area", "edge_ab_dx", "edge_ab_dy",
+                 "edge_bc_dx", "edge_bc_dy", "edge_ca_dx", "edge_ca_dy"]
+        expected = golden.setup(*triangles.T, *points.T)
+
+        for precision in [Precision(), narrowest(512, 512)]:
+            setup = TriangleSetup(parallel=True, precision=precision)
+            harness = Harness(setup)
+            outputs = [getattr(setup, "o_" + name) for name in names]
+            rows = harness.run([
+                (setup.i_tri_xy_a, golden.join_xy(triangles[:, 0], triangles[:, 1])),
+                (setup.i_tri_xy_b, golden.join_xy(triangles[:, 2], triangles[:, 3])),
+                (setup.i_tri_xy_c, golden.join_xy(triangles[:, 4], triangles[:, 5])),
+                (setup.i_point,    golden.join_xy(points[:, 0], points[:, 1])),
+                (setup.i_start,    np.ones(count)),
+            ], outputs, cycles=count + setup.latency)[setup.latency:]
+
+            mismatches = sum((golden.wrap(rows[:, k], len(output)) != expected[name]).sum()
+                             for k, (name, output) in enumerate(zip(names, outputs)))
+            print("TriangleSetup at {}: {} register bits, {} mismatches in {} triangles".format(
+                  precision, register_bits(setup), mismatches, count))
+
+    check_setup_precision()
+
+    # strips and fans of random vertices, restarted now and then, as
+    # PrimitiveAssembly makes them, through TriangleSetup in that mode.
+    def check_shared_setup(mode, count=300):
+        rng = np.random.default_rng(7)
+        vertices = rng.integers(0, 4096 << 4, size=(count + 2, 2))
+        restarts = rng.random(count) < 0.1
+        triangles, shares_bc, shares_ca = [], [], []
+        first, odd, continued = 0, False, False
+        for n in range(count):
+            if restarts[n]:
+                first, odd, continued = n, False, False
+            a, b, c = vertices[n], vertices[n + 1], vertices[n + 2]
+            if mode == "fan":
+                a = vertices[first]
+            elif odd:
+                a, b = b, a
+            triangles.append(np.concatenate([a, b, c]))
+            shares_bc.append(int(mode == "strip" and odd))
+            shares_ca.append(int(continued and not (mode == "strip" and odd)))
+            odd, continued = not odd, True
+        triangles = np.array(triangles)
+        points = rng.integers(0, 4096 << 4, size=(count, 2))
+        names = ["edge_ab", "edge_bc", "edge_ca", "tri_area", "edge_ab_dx", "edge_ab_dy",
+                 "edge_bc_dx", "edge_bc_dy", "edge_ca_dx", "edge_ca_dy",
+                 "edge_ab_frac", "edge_bc_frac", "edge_ca_frac"]
+        expected = golden.setup(*triangles.T, *points.T)
+
+        setup = TriangleSetup(parallel=True, mode=mode)
+        harness = Harness(setup)
+        outputs = [getattr(setup, "o_" + name) for name in names]
+        rows = harness.run([
+            (setup.i_tri_xy_a,  golden.join_xy(triangles[:, 0], triangles[:, 1])),
+            (setup.i_tri_xy_b,  golden.join_xy(triangles[:, 2], triangles[:, 3])),
+            (setup.i_tri_xy_c,  golden.join_xy(triangles[:, 4], triangles[:, 5])),
+            (setup.i_point,     golden.join_xy(points[:, 0], points[:, 1])),
+            (setup.i_shares_bc, shares_bc),
+            (setup.i_shares_ca, shares_ca),
+            (setup.i_start,     np.ones(count)),
+        ], outputs, cycles=count + setup.latency)[setup.latency:]
+
+        mismatches = sum((golden.wrap(rows[:, k], len(output), signed=not name.endswith("frac")) !=
+                          expected[name]).sum() for k, (name, output) in enumerate(zip(names, outputs)))
+        listed = TriangleSetup(parallel=True)
+        print("TriangleSetup in {} mode: {} EdgeFunctions and {} register bits rather than {} and {}, "
+              "{} mismatches in {} triangles".format(mode, setup.edge_functions, register_bits(setup),
+              listed.edge_functions, register_bits(listed), mismatches, count))
+
+    check_shared_setup("strip")
+    check_shared_setup("fan")
+
+    # triangles for the plane checks, wound with their inside negative: a sliver
+    # nearly 2048 pixels wide and one nearly 3750 wide, both cheap to walk, one
+    # over 3000 pixels across both ways, whose deltas need all 17 bits, and some
+    # random ones in a 512x512 frame.
+    def plane_triangles(count=6):
+        rng = np.random.default_rng(2)
+        triangles = [(80, 120, 30000, 400, 200, 70), (80, 120, 200, 70, 60000, 400),
+                     (100, 100, 50000, 100, 100, 60000)]
+        triangles += [tuple(int(v) for v in rng.integers(0, 512 << 4, size=6)) for _ in range(count)]
+        wound = []
+        for ax, ay, bx, by, cx, cy in triangles:
+            if golden.edge(ax, ay, bx, by, cx, cy) > 0:
+                bx, by, cx, cy = cx, cy, bx, by
+            wound.append((ax, ay, bx, by, cx, cy))
+        return wound
+
+    # TriangleSetup's results for a triangle, at its first sample, and random
+    # Q8.8 attributes for its vertices.
+    def plane_inputs(triangle, channels, rng):
+        first = (min(triangle[0::2]) + 8, min(triangle[1::2]) + 8)
+        tri_setup = golden.setup(*triangle, *first)
+        attrs = [[int(v) for v in rng.integers(-(1 << 15), 1 << 15, size=channels)] for _ in range(3)]
+        return first, tri_setup, attrs
+
+    EDGE_INPUTS = ["edge_ab", "edge_bc", "edge_ca", "edge_ab_dx", "edge_ab_dy",
+                   "edge_bc_dx", "edge_bc_dy", "edge_ca_dx", "edge_ca_dy"]
+
+    def check_plane_setup(channels=3):
+        rng = np.random.default_rng(3)
+        planes = PlaneSetup(channels)
+        harness = Harness(planes)
+        outputs = [planes.o_valid] + [output for k in range(channels)
+                                      for output in (planes.o_plane[k], planes.o_plane_dx[k], planes.o_plane_dy[k])]
+
+        triangles = plane_triangles()
+        mismatches = 0
+        for triangle in triangles:
+            _, tri_setup, (a, b, c) = plane_inputs(triangle, channels, rng)
+            inputs = [(getattr(planes, "i_" + name), [tri_setup[name]]) for name in EDGE_INPUTS + ["tri_area"]]
+            for k in range(channels):
+                inputs += [(planes.i_attr_a[k], [a[k]]), (planes.i_attr_b[k], [b[k]]), (planes.i_attr_c[k], [c[k]])]
+            rows = harness.run(inputs, outputs, cycles=3 * channels + 64,
+                               valid=planes.i_start, ready=planes.o_ready, until=planes.o_valid)
+            got = [tuple(int(v) for v in rows[-1, 1 + 3 * k:4 + 3 * k]) for k in range(channels)]
+            mismatches += sum(g != w for g, w in zip(got, golden.plane_setup(tri_setup, a, b, c)))
+
+        print("PlaneSetup: {} mismatches in {} planes of {} triangles".format(
+              mismatches, channels * len(triangles), len(triangles)))
+
+    check_plane_setup()
+
+    # planes stepped along TriangleRender's walk, by a 2x2 lane block, against
+    # golden.plane_value at every covered pixel.
+    def check_plane_stepping(channels=2):
+        from gpu import TriangleRender
+
+        rng = np.random.default_rng(4)
+        render = TriangleRender(lanes_x=2, lanes_y=2, planes=channels)
+        idle = Signal()
+        m = Module()
+        m.submodules.render = render
+        m.d.comb += idle.eq(~render.o_busy)
+        harness = Harness(m)
+        lanes = [(i, j) for j in range(render.lanes_y) for i in range(render.lanes_x)]
+        outputs = [render.o_valid, render.o_xy, render.o_mask] + [plane for k in range(channels)
+                                                                 for plane in render.o_plane[k]]
+
+        # walking the big triangle would take millions of cycles, so only its
+        # setup is checked.
+        mismatches = fragments = 0
+        for triangle in plane_triangles():
+            first, tri_setup, (a, b, c) = plane_inputs(triangle, channels, rng)
+            if (max(triangle[0::2]) - min(triangle[0::2])) * (max(triangle[1::2]) - min(triangle[1::2])) > 1 << 26:
+                continue
+            planes = golden.plane_setup(tri_setup, a, b, c)
+            min_x, min_y = min(triangle[0::2]), min(triangle[1::2])
+            max_x, max_y = max(triangle[0::2]), max(triangle[1::2])
+            inputs = [(getattr(render, "i_next_" + name), [tri_setup[name]]) for name in EDGE_INPUTS] + [
+                (render.i_next_xy,      [golden.join_xy(*first)]),
+                (render.i_next_start_x, [min_x + 16]),
+                (render.i_next_start_y, [min_y]),
+                (render.i_next_stop_x,  [max(max_x - 16, 0)]),
+                (render.i_next_stop_y,  [max_y]),
+            ]
+            for k, (value, dx, dy) in enumerate(planes):
+                inputs += [(render.i_next_plane[k], [value]), (render.i_next_plane_dx[k], [dx]),
+                           (render.i_next_plane_dy[k], [dy])]
+            limit = ((max_x - min_x >> 4) + 4) * ((max_y - min_y >> 4) + 4) + 16
+            rows = harness.run(inputs, outputs, cycles=limit,
+                               valid=render.i_next_valid, ready=render.o_next_ready, until=idle)
+
+            for valid, xy, mask, *values in rows:
+                if not valid:
+                    continue
+                x, y = golden.split_xy(xy)
+                for lane, (i, j) in enumerate(lanes):
+                    if not (mask >> lane) & 1:
+                        continue
+                    fragments += 1
+                    for k, (value, dx, dy) in enumerate(planes):
+                        want = golden.plane_value(value, dx, dy, *first, x + (i << 4), y + (j << 4))
+                        mismatches += int(values[k * len(lanes) + lane] != want)
+
+        print("TriangleRender planes: {} mismatches in {} fragments".format(mismatches, fragments))
+
+    check_plane_stepping()
+
+    # FragmentInTriangleTest into FragmentCompactor into FragmentZTransform,
+    # over a 128x128 frame, with the reciprocal taking a fragment every
+    # `interval` cycles, as a time-shared one would. the fragment's point
+    # stands in for its 1/w, so o_pnt_z checks that it kept to its sideband.
+    def check_compaction(interval, size=128, depth=8):
+        fitt      = FragmentInTriangleTest()
+        compactor = FragmentCompactor(depth, skid=fitt.latency, counters=True)
+        z         = FragmentZTransform(NewtonReciprocal())
+
+        m = Module()
+        m.submodules.fitt      = fitt
+        m.submodules.compactor = compactor
+        m.submodules.z         = z
+
+        phase = Signal(range(interval))
+        taken = phase == 0
+        if interval > 1:
+            m.d.sync += phase.eq(Mux(phase == interval - 1, 0, phase + 1))
+
+        # points are offered to the test only while the compactor is ready.
+        offered = Signal()
+        drained = Signal()
+        m.d.comb += [getattr(compactor, "i_" + name).eq(getattr(fitt, "o_" + name)) for name, _ in compactor.fields]
+        m.d.comb += [getattr(z, "i_" + name).eq(getattr(compactor, "o_" + name)) for name, _ in compactor.fields
+                     if hasattr(z, "i_" + name)]
+        m.d.comb += [
+            fitt.i_valid.eq(offered & compactor.o_ready),
+            compactor.i_valid.eq(fitt.o_valid),
+            compactor.i_ready.eq(taken),
+            z.i_valid.eq(compactor.o_valid & taken),
+            z.i_pnt_wz.eq(compactor.o_pnt_xy),
+            drained.eq(~fitt.o_valid & (compactor.level == 0)),
+        ]
+
+        triangle = [v >> 2 for v in (0x0949, 0x0449, 0x1EB6, 0x19B6, 0x0949, 0x19B6)]
+        ax, ay, bx, by, cx, cy = triangle
+        px, py = (v.ravel() for v in golden.pixel_grid(size, size))
+        covered = golden.coverage(*triangle, px, py)
+
+        harness = Harness(m)
+        outputs = [z.o_valid, z.o_pnt_xy, z.o_pnt_z]
+        rows = harness.run([
+            (fitt.i_tri_xy_a, np.full(px.size, golden.join_xy(ax, ay))),
+            (fitt.i_tri_xy_b, np.full(px.size, golden.join_xy(bx, by))),
+            (fitt.i_tri_xy_c, np.full(px.size, golden.join_xy(cx, cy))),
+            (fitt.i_pnt_xy,   golden.join_xy(px, py)),
+            (fitt.i_edge_ab,  golden.edge(ax, ay, bx, by, px, py)),
+            (fitt.i_edge_bc,  golden.edge(bx, by, cx, cy, px, py)),
+            (fitt.i_edge_ca,  golden.edge(cx, cy, ax, ay, px, py)),
+        ], outputs, cycles=px.size * interval + 64, valid=offered, ready=compactor.o_ready, until=drained)
+        cycles = len(rows)
+        counts = dict(zip(compactor.counters.names, harness.run(
+            outputs=[compactor.counters[name] for name in compactor.counters.names], cycles=1)[0]))
+        rows = np.concatenate([rows, harness.run(outputs=outputs, cycles=z.latency)])
+
+        xy = rows[rows[:, 0] == 1, 1]
+        want = golden.join_xy(px[covered], py[covered])
+        mismatches = abs(len(xy) - len(want))
+        if len(xy) == len(want):
+            mismatches = ((xy != want) | (rows[rows[:, 0] == 1, 2] != golden.reciprocal(want))).sum()
+
+        print("FragmentCompactor, a reciprocal every {} cycles: {} cycles for {} points ({} without compaction), "
+              "{} reciprocals rather than {} ({:.0%} of its slots recovered), average occupancy {:.2f}, "
+              "{} stall cycles, {} mismatches".format(
+              interval, cycles, px.size, px.size * interval, counts["fragments_out"], px.size,
+              1 - counts["fragments_out"] / px.size, counts["occupancy"] / cycles, counts["stalls"], mismatches))
+
+    for interval in [1, 2, 3]:
+        check_compaction(interval)
+
+    fitt = FragmentInTriangleTest()
+
+    a_x, a_y = 0x0949, 0x0449
+    b_x, b_y = 0x1EB6, 0x19B6
+    c_x, c_y = 0x0949, 0x19B6
+
+    # the reference edge functions and coverage, for the whole frame at once.
+    px, py   = golden.pixel_grid()
+    pixels   = px.size
+    expected = golden.coverage(a_x, a_y, b_x, b_y, c_x, c_y, px, py)
+
+    inputs = [
+        (fitt.i_tri_xy_a, np.full(pixels, golden.join_xy(a_x, a_y))),
+        (fitt.i_tri_xy_b, np.full(pixels, golden.join_xy(b_x, b_y))),
+        (fitt.i_tri_xy_c, np.full(pixels, golden.join_xy(c_x, c_y))),
+        (fitt.i_tri_area, np.full(pixels, golden.edge(a_x, a_y, b_x, b_y, c_x, c_y))),
+        (fitt.i_pnt_xy,   golden.join_xy(px, py)),
+        (fitt.i_edge_ab,  golden.edge(a_x, a_y, b_x, b_y, px, py)),
+        (fitt.i_edge_bc,  golden.edge(b_x, b_y, c_x, c_y, px, py)),
+        (fitt.i_edge_ca,  golden.edge(c_x, c_y, a_x, a_y, px, py)),
+        (fitt.i_valid,    np.ones(pixels, dtype=np.int64)),
+    ]
+
+    # waveforms are only worth their cost when asked for, and then only for
+    # the first few rows.
+    if "--vcd" in sys.argv:
+        harness = Harness(fitt, vcd_file="test.vcd", gtkw_file="test.gtkw", window=(0, 4 * 512))
+    else:
+        harness = Harness(fitt)
+
+    # o_valid lags its pixel by a cycle.
+    covered = harness.run(inputs, [fitt.o_valid], cycles=pixels + 1)[1:, 0] != 0
+    harness.close()
+
+    capture = FrameCapture()
+    capture.write(golden.join_xy(px, py).ravel()[covered])
+
+    print("FragmentInTriangleTest: {} mismatches against the golden model; {}".format(
+          len(diff(capture.coverage != 0, expected)), harness.report()))
+
+    capture.save_pbm("triangle.pbm")
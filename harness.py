@@ -0,0 +1,168 @@
+import time
+
+import numpy as np
+from amaranth import *
+from amaranth.sim import *
+
+# Harness drives an elaboratable from arrays of per-cycle input values, and
+# collects its outputs into arrays, one row per cycle. the Simulator is built
+# once, so many runs (one per triangle, say) share it, along with the design's
+# state; each run carries on from the cycle the previous one stopped at.
+#
+# inputs are given as (signal, values) pairs, or as a SignalDict. in cycle i of
+# a run, every input signal is set to the ith of its values, and the outputs
+# are sampled once everything has settled, before the clock edge. a registered
+# output with a latency of L cycles therefore shows the result for input i in
+# row i + L.
+#
+# waveforms are only written if vcd_file is given, and then only for cycles in
+# the half-open range window=(start, stop), counted from the creation of the
+# harness; the default is every cycle, and a stop of None means no end.
+#
+# for speed, signals are read and written straight through the Python
+# simulator's signal state, rather than by yielding statements to it, which
+# compiles each statement anew. this ties Harness to amaranth 0.4's pysim.
+class Harness:
+    def __init__(self, dut, *, vcd_file=None, gtkw_file=None, window=None, traces=()):
+        self.dut    = dut
+        self.window = window
+
+        self.cycles  = 0
+        self.elapsed = 0.0
+
+        self._sim = Simulator(dut)
+        self._sim.add_clock(1e-9)
+        self._sim.add_sync_process(self._serve)
+        self._job = None
+
+        self._engine = self._sim._engine
+        self._state  = self._engine._state
+
+        # waveforms can only be started at the beginning, so the writer is
+        # created now, and detached from the simulator until the window opens.
+        self._vcd    = None
+        self._writer = None
+        if vcd_file is not None:
+            self._vcd = self._sim.write_vcd(vcd_file, gtkw_file, traces=traces)
+            self._vcd.__enter__()
+            self._writer = self._engine._vcd_writers[-1]
+            if window is not None and window[0] > 0:
+                self._engine._vcd_writers.remove(self._writer)
+
+    # a single process runs every job, so that a run starts in the very cycle
+    # the previous one stopped at, rather than waiting for a clock edge as a
+    # newly added process would. it idles in place between runs.
+    def _serve(self):
+        while True:
+            if self._job is None:
+                yield Delay()
+                continue
+            job, self._job = self._job, None
+            yield from job()
+
+    def _slot(self, signal):
+        return self._state.slots[self._state.get_signal(signal)]
+
+    # run for `cycles` cycles (by default, as many as there are inputs), and
+    # return the sampled outputs as an array of shape (cycles, len(outputs)).
+    #
+    # with valid and ready given, the inputs form a stream instead: valid is
+    # held high while there are inputs left, and the next set of inputs is
+    # only presented after a cycle in which ready was high.
+    #
+    # with until given, the run stops at the end of the first cycle after all
+    # inputs have been taken in which until is high, and only the rows up to
+    # and including that cycle are returned. cycles is then a limit, and a
+    # RuntimeError is raised if it is reached first.
+    def run(self, inputs=None, outputs=(), cycles=None, *, valid=None, ready=None, until=None):
+        if hasattr(inputs, "items"):
+            inputs = inputs.items()
+
+        columns = []
+        for signal, values in inputs or ():
+            mask = (1 << len(signal)) - 1
+            half = 1 << (len(signal) - 1) if signal.shape().signed else 0
+            columns.append((self._slot(signal), [((int(value) + half) & mask) - half
+                                                 for value in np.asarray(values).ravel()]))
+        length = min((len(values) for _, values in columns), default=0)
+
+        if cycles is None:
+            if until is not None or valid is not None:
+                raise ValueError("A cycle limit is needed when running until a condition or streaming inputs")
+            cycles = length
+
+        wide   = any(len(signal) > 63 for signal in outputs)
+        result = np.zeros((cycles, len(outputs)), dtype=object if wide else np.int64)
+        rows   = [self._slot(signal) for signal in outputs]
+        state  = {"rows": cycles, "stopped": False, "done": False}
+
+        valid = valid is not None and self._slot(valid)
+        ready = ready is not None and self._slot(ready)
+        until = until is not None and self._slot(until)
+
+        def process():
+            taken = 0
+            for cycle in range(cycles):
+                if taken < length:
+                    for slot, values in columns:
+                        slot.set(values[taken])
+                if valid:
+                    valid.set(int(taken < length))
+
+                yield Settle()
+                result[cycle] = [slot.curr for slot in rows]
+                stop = until and taken >= length and until.curr
+                if not ready or ready.curr:
+                    taken = min(taken + 1, length)
+
+                yield
+                self.cycles += 1
+                if stop:
+                    state["rows"] = cycle + 1
+                    state["stopped"] = True
+                    break
+            if valid:
+                valid.set(0)
+            state["done"] = True
+
+        self._job = process
+
+        start = time.perf_counter()
+        while not state["done"]:
+            self._trace()
+            self._sim.advance()
+        self.elapsed += time.perf_counter() - start
+
+        if until and not state["stopped"]:
+            raise RuntimeError("Run did not finish within {} cycles".format(cycles))
+
+        return result[:state["rows"]]
+
+    # simulated cycles per wall-clock second, over every run so far.
+    @property
+    def rate(self):
+        return self.cycles / self.elapsed if self.elapsed else 0.0
+
+    def report(self):
+        return "{} cycles in {:.2f} s, {:.0f} cycles/s".format(self.cycles, self.elapsed, self.rate)
+
+    # finish the waveforms, if any.
+    def close(self):
+        if self._vcd is None:
+            return
+        if self._writer not in self._engine._vcd_writers:
+            self._engine._vcd_writers.append(self._writer)
+        self._vcd.__exit__(None, None, None)
+        self._vcd = None
+
+    def _trace(self):
+        if self._vcd is None or self.window is None:
+            return
+        start, stop = self.window
+        if stop is not None and self.cycles >= stop:
+            self.close()
+        elif self.cycles >= start and self._writer not in self._engine._vcd_writers:
+            self._engine._vcd_writers.append(self._writer)
+            # catch the waveforms up with everything that changed meanwhile.
+            for slot in self._state.slots:
+                self._writer.update(self._engine.now, slot.signal, slot.curr)
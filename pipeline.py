@@ -0,0 +1,1494 @@
+from amaranth import *
+from amaranth.lib.fifo import SyncFIFOBuffered
+
+from counters import PerformanceCounters, popcount
+from gpu import SAMPLE_PATTERNS, TriangleRender
+from gpu2 import DepthTest, FragmentZTransform, PlaneSetup, TriangleSetup
+from precision import Precision, fit
+from stages import delay
+
+
+# PrimitiveAssembly turns a stream of vertices into a stream of triangles, for
+# the pipelines' i_tri_xy_* inputs, so that meshes sent as strips or fans need
+# one vertex per triangle rather than three. the mode is picked at elaboration:
+#
+# - "list":  every three vertices are a triangle.
+# - "strip": each vertex makes a triangle with the two before it. every other
+#            triangle has its first two vertices swapped, so that a strip of
+#            consistently wound triangles comes out consistently wound.
+# - "fan":   each vertex makes a triangle with the one before it and the first.
+#
+# vertices are offered on i_vertex, in the format of i_tri_xy_*, with i_valid,
+# and are taken when o_ready is high. a vertex taken with i_restart set starts
+# a new list, strip or fan. triangles come out on o_tri_xy_a/b/c, with the same
+# handshakes as TriangleSetup's output: o_valid, and i_ready, which may be left
+# at its reset value of 1.
+#
+# every strip or fan triangle but the first after a restart has its AB on an
+# edge of the triangle before it, the other way round: that triangle's BC for
+# odd triangles of a strip, and its CA otherwise. o_shares_bc and o_shares_ca
+# say which, for TriangleSetup's strip and fan modes, which then compute only
+# the two new edges and the area (see gpu2.py).
+class PrimitiveAssembly(Elaboratable):
+    def __init__(self, mode="strip"):
+        if mode not in ("list", "strip", "fan"):
+            raise ValueError("Primitive mode must be list, strip or fan, not {!r}".format(mode))
+
+        self.mode = mode
+
+        self.i_vertex  = Signal(32)
+        self.i_restart = Signal()
+        self.i_valid   = Signal()
+        self.o_ready   = Signal()
+
+        self.o_tri_xy_a  = Signal(32)
+        self.o_tri_xy_b  = Signal(32)
+        self.o_tri_xy_c  = Signal(32)
+        self.o_shares_bc = Signal()
+        self.o_shares_ca = Signal()
+        self.o_valid     = Signal()
+        self.i_ready     = Signal(reset=1)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # the vertices held for the next triangle: the first and second of a
+        # list, the two before the next vertex of a strip, or the centre and the
+        # previous vertex of a fan. `continued` is set once a strip or fan has
+        # made a triangle.
+        first     = Signal(32)
+        second    = Signal(32)
+        held      = Signal(range(3))
+        odd       = Signal()
+        continued = Signal()
+
+        taken = self.i_valid & self.o_ready
+        m.d.comb += self.o_ready.eq(~self.o_valid | self.i_ready)
+
+        with m.If(self.o_valid & self.i_ready):
+            m.d.sync += self.o_valid.eq(0)
+
+        with m.If(taken & (self.i_restart | (held == 0))):
+            m.d.sync += [
+                first.eq(self.i_vertex),
+                held.eq(1),
+                odd.eq(0),
+                continued.eq(0),
+            ]
+        with m.Elif(taken & (held == 1)):
+            m.d.sync += [
+                second.eq(self.i_vertex),
+                held.eq(2),
+            ]
+        with m.Elif(taken):
+            m.d.sync += [
+                self.o_tri_xy_a.eq(first),
+                self.o_tri_xy_b.eq(second),
+                self.o_tri_xy_c.eq(self.i_vertex),
+                self.o_valid.eq(1),
+            ]
+            if self.mode == "list":
+                m.d.sync += held.eq(0)
+            elif self.mode == "strip":
+                with m.If(odd):
+                    m.d.sync += [
+                        self.o_tri_xy_a.eq(second),
+                        self.o_tri_xy_b.eq(first),
+                    ]
+                m.d.sync += [
+                    first.eq(second),
+                    second.eq(self.i_vertex),
+                    odd.eq(~odd),
+                    self.o_shares_bc.eq(odd),
+                    self.o_shares_ca.eq(~odd & continued),
+                    continued.eq(1),
+                ]
+            else:
+                m.d.sync += [
+                    second.eq(self.i_vertex),
+                    self.o_shares_ca.eq(continued),
+                    continued.eq(1),
+                ]
+
+        return m
+
+
+# TriangleRender's i_start_x for a walk from the sample at first_x. a first
+# sample in the last column would put it past the end of the range, and
+# wrapped, the walk would run the length of every row to get back to it. there
+# is no column left of such a sample, so saturating it turns the walk at the
+# same samples.
+def walk_start_x(first_x):
+    return Mux(first_x > 0xFFFF - (1 << 3), 0xFFFF, first_x + (1 << 3))[:16]
+
+
+# the front end shared by the pipelines: the bounding box, TriangleSetup, and
+# the FIFOs between them. each entry of the returned triangle FIFO is the edge
+# functions and deltas of a set up triangle, followed by its bounding box as
+# TriangleRender's i_next_xy, i_next_start_x..stop_y.
+#
+# with pipeline.cull set, triangles that cannot produce a fragment are dropped
+# on the way, as early as the reason for dropping them is known:
+#
+# - culled_outside: the bounding box holds no sample (inside the scissor, with
+#   pipeline.scissor set). these are taken, and dropped before setup.
+# - culled_back_facing: the triangle is wound clockwise, with its inside
+#   positive, and so covers nothing.
+# - culled_zero_area: the triangle's vertices are collinear, or it is too thin
+#   for the area to show it, with the top-left adjustment of AB taken out.
+#
+# the latter two are dropped after setup, once the area is known.
+#
+# a bounding box that starts past the last sample on either axis, with a
+# minimum coordinate above 0xFFF7, holds no sample either, but its first sample
+# cannot be represented for the walk to start at. such triangles are always
+# dropped before setup, like culled_outside ones, whether or not cull is set.
+#
+# with pipeline.scissor set, the bounding box is also clamped to the samples
+# between pipeline.i_scissor_min and i_scissor_max, (y << 16) | x points in
+# Q12.4, inclusive. the first sample moves forward by whole samples, so that
+# the samples are the same ones as without the scissor, and setup evaluates the
+# edge functions there. the walk then never leaves the scissor by more than
+# the sample it turns onto at the end of a row, or the lanes of a block that
+# overhang it; the pipeline has to drop those.
+#
+# with `samples` above 1, the bounding box is extended right and down by the
+# reach of the sample pattern, as TriangleRender's multisampling needs, and the
+# entries end with the fractional bits of the edge functions.
+#
+# with nearest set, each triangle also brings pipeline.i_tri_z_near, which
+# follows its bounding box into the entries, as TriangleRender's i_next_z_near.
+#
+# with `planes`, a PlaneSetup, each triangle also brings its vertices'
+# attributes, pipeline.i_attr_a/b/c, which wait with its bounding box. each
+# set up triangle then goes on to the PlaneSetup, which holds up TriangleSetup
+# while it works, and the triangle waits there for its planes. the entries end
+# with the planes, as TriangleRender's i_next_plane, i_next_plane_dx and
+# i_next_plane_dy for each channel in turn.
+def triangle_queue(m, pipeline, samples=1, planes=None, nearest=False):
+    m.submodules.setup = setup = pipeline.setup
+
+    a_x, a_y = pipeline.i_tri_xy_a[:16], pipeline.i_tri_xy_a[16:]
+    b_x, b_y = pipeline.i_tri_xy_b[:16], pipeline.i_tri_xy_b[16:]
+    c_x, c_y = pipeline.i_tri_xy_c[:16], pipeline.i_tri_xy_c[16:]
+
+    def minimum(a, b, c):
+        ab = Mux(a < b, a, b)
+        return Mux(ab < c, ab, c)
+
+    def maximum(a, b, c):
+        ab = Mux(a > b, a, b)
+        return Mux(ab > c, ab, c)
+
+    min_x = minimum(a_x, b_x, c_x)
+    min_y = minimum(a_y, b_y, c_y)
+    max_x = maximum(a_x, b_x, c_x)
+    max_y = maximum(a_y, b_y, c_y)
+
+    first_x = min_x + (1 << 3)
+    first_y = min_y + (1 << 3)
+
+    if samples > 1:
+        reach = max(max(ox, oy) for ox, oy in SAMPLE_PATTERNS[samples])
+        max_x = Mux(max_x > 0xFFFF - reach, 0xFFFF, max_x + reach)[:16]
+        max_y = Mux(max_y > 0xFFFF - reach, 0xFFFF, max_y + reach)[:16]
+
+    if pipeline.scissor:
+        low_x,  low_y  = pipeline.i_scissor_min[:16], pipeline.i_scissor_min[16:]
+        high_x, high_y = pipeline.i_scissor_max[:16], pipeline.i_scissor_max[16:]
+
+        def clamp_first(first, low):
+            return Mux(first < low, first + ((low - first + 0xF)[:16] & ~0xF), first)
+
+        first_x = clamp_first(first_x, low_x)
+        first_y = clamp_first(first_y, low_y)
+        max_x   = Mux(max_x > high_x, high_x, max_x)
+        max_y   = Mux(max_y > high_y, high_y, max_y)
+
+    beyond  = (first_x > 0xFFFF) | (first_y > 0xFFFF)
+    first_x = first_x[:16]
+    first_y = first_y[:16]
+
+    start_xy = Cat(first_x, first_y)
+    start_x  = walk_start_x(first_x)
+    start_y  = (first_y - (1 << 3))[:16]
+    stop_x   = Mux(max_x > (1 << 4), max_x - (1 << 4), 0)[:16]
+
+    # the bounding boxes wait here for the triangles in TriangleSetup.
+    bbox = [start_xy, start_x, start_y, stop_x, max_y]
+    if nearest:
+        bbox.append(pipeline.i_tri_z_near)
+    box = len(Cat(*bbox))
+    if planes is not None:
+        bbox += [*pipeline.i_attr_a, *pipeline.i_attr_b, *pipeline.i_attr_c]
+    empty = beyond
+    if pipeline.cull:
+        empty = beyond | (first_x > max_x) | (first_y > max_y)
+        # the top-left adjustment TriangleSetup takes off the area.
+        adjustment = (a_x < b_x) | ((a_x == b_x) & (b_y < a_y))
+        bbox.append(adjustment)
+    m.submodules.bbox_fifo = bbox_fifo = SyncFIFOBuffered(width=len(Cat(*bbox)), depth=max(4, setup.capacity))
+
+    m.d.comb += [
+        setup.i_tri_xy_a.eq(pipeline.i_tri_xy_a),
+        setup.i_tri_xy_b.eq(pipeline.i_tri_xy_b),
+        setup.i_tri_xy_c.eq(pipeline.i_tri_xy_c),
+        setup.i_point.eq(start_xy),
+        setup.i_start.eq(pipeline.i_valid & bbox_fifo.w_rdy & ~empty),
+        pipeline.o_ready.eq((setup.o_ready & bbox_fifo.w_rdy) | empty),
+
+        bbox_fifo.w_data.eq(Cat(*bbox)),
+        bbox_fifo.w_en.eq(pipeline.i_valid & pipeline.o_ready & ~empty),
+    ]
+
+    if setup.mode != "list":
+        # a triangle dropped before setup leaves no edge for the next to share.
+        dropped = Signal()
+        with m.If(pipeline.i_valid & pipeline.o_ready):
+            m.d.sync += dropped.eq(empty)
+        m.d.comb += [
+            setup.i_shares_bc.eq(pipeline.i_shares_bc & ~dropped),
+            setup.i_shares_ca.eq(pipeline.i_shares_ca & ~dropped),
+        ]
+
+    # one entry per set up triangle, with its bounding box.
+    triangle = [
+        setup.o_edge_ab, setup.o_edge_bc, setup.o_edge_ca,
+        setup.o_edge_ab_dx, setup.o_edge_ab_dy,
+        setup.o_edge_bc_dx, setup.o_edge_bc_dy,
+        setup.o_edge_ca_dx, setup.o_edge_ca_dy,
+        bbox_fifo.r_data[:box],
+    ]
+    if samples > 1:
+        triangle += [setup.o_edge_ab_frac, setup.o_edge_bc_frac, setup.o_edge_ca_frac]
+    entry = Cat(*triangle)
+    if planes is not None:
+        # the triangle waits for its planes here.
+        waiting = Signal(len(entry))
+        entry   = Cat(waiting, *(plane for k in range(planes.channels)
+                                 for plane in (planes.o_plane[k], planes.o_plane_dx[k], planes.o_plane_dy[k])))
+    m.submodules.tri_fifo = tri_fifo = SyncFIFOBuffered(width=len(entry), depth=pipeline.depth)
+
+    culled = C(0)
+    if pipeline.cull:
+        area = setup.o_tri_area.as_signed() + bbox_fifo.r_data[-1]
+        culled = (area >= 0)
+        taken = setup.o_valid & setup.i_ready
+        m.d.comb += [
+            pipeline.culled_outside.eq(pipeline.i_valid & pipeline.o_ready & empty),
+            pipeline.culled_back_facing.eq(taken & (area > 0)),
+            pipeline.culled_zero_area.eq(taken & (area == 0)),
+        ]
+
+    if planes is None:
+        m.d.comb += [
+            setup.i_ready.eq((tri_fifo.w_rdy | culled) & bbox_fifo.r_rdy),
+            bbox_fifo.r_en.eq(setup.o_valid & setup.i_ready),
+
+            tri_fifo.w_data.eq(entry),
+            tri_fifo.w_en.eq(setup.o_valid & setup.i_ready & ~culled),
+        ]
+        return bbox_fifo, tri_fifo
+
+    m.submodules.planes = planes
+    attrs = bbox_fifo.r_data[box:box + len(Cat(*pipeline.i_attr_a, *pipeline.i_attr_b, *pipeline.i_attr_c))]
+    m.d.comb += [
+        planes.i_edge_ab.eq(setup.o_edge_ab),
+        planes.i_edge_bc.eq(setup.o_edge_bc),
+        planes.i_edge_ca.eq(setup.o_edge_ca),
+        planes.i_tri_area.eq(setup.o_tri_area),
+        planes.i_edge_ab_dx.eq(setup.o_edge_ab_dx),
+        planes.i_edge_ab_dy.eq(setup.o_edge_ab_dy),
+        planes.i_edge_bc_dx.eq(setup.o_edge_bc_dx),
+        planes.i_edge_bc_dy.eq(setup.o_edge_bc_dy),
+        planes.i_edge_ca_dx.eq(setup.o_edge_ca_dx),
+        planes.i_edge_ca_dy.eq(setup.o_edge_ca_dy),
+        Cat(*planes.i_attr_a, *planes.i_attr_b, *planes.i_attr_c).eq(attrs),
+        planes.i_start.eq(setup.o_valid & bbox_fifo.r_rdy & ~culled),
+
+        setup.i_ready.eq((planes.o_ready | culled) & bbox_fifo.r_rdy),
+        bbox_fifo.r_en.eq(setup.o_valid & setup.i_ready),
+
+        tri_fifo.w_data.eq(entry),
+        tri_fifo.w_en.eq(planes.o_valid),
+        planes.i_ready.eq(tri_fifo.w_rdy),
+    ]
+    with m.If(planes.i_start & planes.o_ready):
+        m.d.sync += waiting.eq(Cat(*triangle))
+
+    return bbox_fifo, tri_fifo
+
+
+# the scissor inputs and cull events that triangle_queue needs, for the
+# pipelines to set up in their constructors.
+def cull_signals(pipeline, cull, scissor):
+    pipeline.cull    = cull or scissor
+    pipeline.scissor = scissor
+    if scissor:
+        pipeline.i_scissor_min = Signal(32)
+        pipeline.i_scissor_max = Signal(32, reset=0xFFFFFFFF)
+
+    events = []
+    if pipeline.cull:
+        pipeline.culled_outside     = Signal()
+        pipeline.culled_back_facing = Signal()
+        pipeline.culled_zero_area   = Signal()
+        events = [
+            ("culled_outside",     pipeline.culled_outside),
+            ("culled_back_facing", pipeline.culled_back_facing),
+            ("culled_zero_area",   pipeline.culled_zero_area),
+        ]
+    return events
+
+
+# RasterPipeline connects TriangleSetup to TriangleRender:
+#
+#  i_tri_xy_* --> bounding box --> TriangleSetup --> triangle FIFO --> TriangleRender --> o_xy
+#                       |                         ^
+#                       +----> bounding box FIFO -+
+#
+# triangles are offered on i_tri_xy_a/b/c with i_valid, and are taken when
+# o_ready is high (the vertex format is that of TriangleRender's i_xy_*). the
+# bounding box is worked out as the triangle goes into setup, and follows it
+# through a small FIFO of its own, since setup does not carry it.
+#
+# the triangle FIFO holds up to `depth` set up triangles, and TriangleRender
+# double-buffers one more, so setup of the following triangles carries on while
+# the current one is being rasterised, and consecutive triangles are walked
+# without idle cycles between them.
+#
+# the edge functions are evaluated at the first sample position of the walk,
+# (min(A.x, B.x, C.x) + 0.5, min(A.y, B.y, C.y) + 0.5), so that o_valid and
+# o_mask always describe the sample at o_xy. o_xy, o_mask and o_full are as
+# for TriangleRender, and o_valid is only set while a triangle is being walked.
+# o_idle is set when there is no triangle anywhere past the input.
+#
+# with counters set, `counters` is a PerformanceCounters over:
+#
+# - triangles:          triangles taken in.
+# - busy_cycles:        cycles with a triangle anywhere past the input.
+# - idle_cycles:        cycles with o_idle set.
+# - input_stalls:       cycles a triangle was offered but not taken.
+# - setup_busy:         cycles TriangleSetup was busy.
+# - setup_stalls:       cycles a set up triangle waited on a full FIFO.
+# - render_busy:        cycles TriangleRender was walking.
+# - render_empty:       cycles it walked without covering anything.
+# - render_starved:     cycles it sat idle with triangles still in setup or the
+#                       FIFOs.
+# - fragments_covered:  covered samples produced.
+# - fragments_rejected: samples walked but not covered. a tile rejected in a
+#                       single cycle counts as one block of lanes, not as
+#                       every sample in it.
+#
+# with cull or scissor set, triangles are culled and scissored as described for
+# triangle_queue, and `counters` also counts the culled triangles by reason
+# (and is built for those alone, if counters is not set). the walk's samples
+# outside the scissor are dropped from o_mask and o_valid. a tile in a tiled
+# walk cannot be split that way, so scissor cannot be used with tile.
+#
+# with span set, TriangleRender walks each row's span rather than the whole
+# bounding box, as described in gpu.py.
+#
+# with samples set to 2 or 4, TriangleRender tests that many samples per pixel
+# in one walk, as described in gpu.py, and o_coverage is its per-sample
+# coverage alongside o_mask, which is then set for pixels with any sample
+# covered. the scissor applies to the pixels, not to their samples.
+#
+# setup_stages is the number of pipeline stages in TriangleSetup's
+# EdgeFunctions, as described in gpu2.py.
+#
+# with planes set, each triangle comes with that many attributes per vertex,
+# on i_attr_a/b/c, in Q8.8 as PlaneSetup takes them (1/w, z/w and the colours
+# over w, say). a PlaneSetup after TriangleSetup computes their plane
+# equations, which go down the triangle FIFO with the edge functions, and
+# TriangleRender steps them along its walk onto o_plane, per lane. the
+# PlaneSetup is shared by every triangle, and takes 3 * planes + 34 cycles over
+# each, so the pipeline then takes a triangle every 3 * planes + 34 cycles at
+# most: it holds up TriangleSetup, and so the input, while it works. culled
+# triangles never reach it.
+#
+# full_tiles and occlusion are passed on to TriangleRender's tiled walk. with
+# occlusion set, each triangle comes with i_tri_z_near, the nearest depth any
+# of its fragments can have, and the walk's depth queries are on
+# render.o_query_xy, o_query_z and i_occluded; DepthPipeline wires them up.
+#
+# with mode set to "strip" or "fan", TriangleSetup runs in that mode, for the
+# triangles of a PrimitiveAssembly in it, whose o_shares_bc and o_shares_ca go
+# to i_shares_bc and i_shares_ca alongside i_tri_xy_*. it needs parallel set.
+#
+# `precision`, a precision.Precision, narrows TriangleSetup, the triangle FIFO
+# and TriangleRender to its screen, whose triangles must then lie on it. the
+# bounding box logic here works in sixteenths of a pixel, so it needs the
+# default 4 fractional bits.
+class RasterPipeline(Elaboratable):
+    def __init__(self, depth=4, parallel=False, lanes_x=1, lanes_y=1, tile=None, counters=False,
+                 cull=False, scissor=False, span=False, samples=1, setup_stages=4, precision=None, mode="list",
+                 planes=0, full_tiles=True, occlusion=False):
+        if precision is None:
+            precision = Precision()
+        if depth < 1:
+            raise ValueError("Triangle FIFO depth must be at least 1, not {}".format(depth))
+        if scissor and tile is not None:
+            raise ValueError("Scissoring is not supported with tiled traversal")
+        if precision.frac_bits != 4:
+            raise ValueError("RasterPipeline needs coordinates with 4 fractional bits, not {}"
+                             .format(precision.frac_bits))
+
+        self.depth   = depth
+        self.occlusion = occlusion
+        self.setup   = TriangleSetup(parallel, setup_stages, precision, mode)
+        self.planes  = PlaneSetup(planes, precision) if planes else None
+        self.samples = samples
+        self.render  = TriangleRender(lanes_x, lanes_y, tile, planes=planes, span=span, samples=samples,
+                                      precision=precision, full_tiles=full_tiles, occlusion=occlusion)
+
+        self.i_tri_xy_a  = Signal(32)
+        self.i_tri_xy_b  = Signal(32)
+        self.i_tri_xy_c  = Signal(32)
+        self.i_shares_bc = Signal()
+        self.i_shares_ca = Signal()
+        self.i_attr_a    = [Signal(signed(16), name="i_attr_a{}".format(k)) for k in range(planes)]
+        self.i_attr_b    = [Signal(signed(16), name="i_attr_b{}".format(k)) for k in range(planes)]
+        self.i_attr_c    = [Signal(signed(16), name="i_attr_c{}".format(k)) for k in range(planes)]
+        self.i_tri_z_near = Signal(32)
+        self.i_valid     = Signal()
+        self.o_ready     = Signal()
+
+        self.o_xy    = Signal(32)
+        self.o_mask  = Signal(lanes_x * lanes_y)
+        self.o_valid = Signal()
+        self.o_full  = Signal()
+        self.o_idle  = Signal()
+        self.o_coverage = Signal(lanes_x * lanes_y * samples)
+        self.o_plane = [[Signal(signed(32), name="o_plane{}_{}".format(k, lane)) for lane in range(lanes_x * lanes_y)]
+                        for k in range(planes)]
+
+        events = []
+        if counters:
+            setup, render = self.setup, self.render
+            partial  = self.o_valid & ~self.o_full
+            hits     = Mux(partial, popcount(self.o_mask), 0)
+            rejected = Mux(render.i_run & ~self.o_full, lanes_x * lanes_y - hits, 0)
+            covered  = hits
+            if tile is not None:
+                covered = covered + Mux(self.o_full, tile * tile, 0)
+            events += [
+                ("triangles",          self.i_valid & self.o_ready),
+                ("busy_cycles",        ~self.o_idle),
+                ("idle_cycles",        self.o_idle),
+                ("input_stalls",       self.i_valid & ~self.o_ready),
+                ("setup_busy",         setup.o_busy),
+                ("setup_stalls",       setup.o_valid & ~setup.i_ready),
+                ("render_busy",        render.i_run),
+                ("render_empty",       render.i_run & ~self.o_valid),
+                ("render_starved",     ~render.i_run & ~self.o_idle),
+                ("fragments_covered",  covered),
+                ("fragments_rejected", rejected),
+            ]
+        events += cull_signals(self, cull, scissor)
+
+        self.counters = PerformanceCounters(events) if events else None
+
+    def elaborate(self, platform):
+        m = Module()
+
+        bbox_fifo, tri_fifo = triangle_queue(m, self, self.samples, self.planes, self.occlusion)
+
+        m.submodules.render = render = self.render
+        if self.counters is not None:
+            m.submodules.counters = self.counters
+
+        next_inputs = [
+            render.i_next_edge_ab, render.i_next_edge_bc, render.i_next_edge_ca,
+            render.i_next_edge_ab_dx, render.i_next_edge_ab_dy,
+            render.i_next_edge_bc_dx, render.i_next_edge_bc_dy,
+            render.i_next_edge_ca_dx, render.i_next_edge_ca_dy,
+            render.i_next_xy,
+            render.i_next_start_x, render.i_next_start_y,
+            render.i_next_stop_x, render.i_next_stop_y,
+        ]
+        if self.occlusion:
+            next_inputs.append(render.i_next_z_near)
+        if self.samples > 1:
+            next_inputs += [render.i_next_edge_ab_frac, render.i_next_edge_bc_frac, render.i_next_edge_ca_frac]
+        for k in range(render.planes):
+            next_inputs += [render.i_next_plane[k], render.i_next_plane_dx[k], render.i_next_plane_dy[k]]
+
+        mask     = render.o_mask
+        coverage = render.o_coverage
+        valid    = render.o_valid
+        if self.scissor:
+            # keep to the samples from the first, (start_x - 0.5, start_y +
+            # 0.5), to the last, (stop_x + 1.0, stop_y), at most.
+            x, y = render.o_xy[:16], render.o_xy[16:]
+            lanes = []
+            for j in range(render.lanes_y):
+                for i in range(render.lanes_x):
+                    lane_x = x + (i << 4)
+                    lanes.append((lane_x + (1 << 3) >= render.i_start_x) &
+                                 (lane_x <= render.i_stop_x + (1 << 4)) &
+                                 (y + (j << 4) <= render.i_stop_y))
+            mask     = mask & Cat(*lanes)
+            coverage = coverage & Cat(*(lane.replicate(self.samples) for lane in lanes))
+            valid    = mask.any()
+
+        idle = (bbox_fifo.level == 0) & (tri_fifo.level == 0) & ~render.o_busy
+        if self.planes is not None:
+            idle &= ~self.planes.o_busy
+
+        m.d.comb += [
+            Cat(*next_inputs).eq(tri_fifo.r_data),
+            render.i_next_valid.eq(tri_fifo.r_rdy),
+            tri_fifo.r_en.eq(render.o_next_ready),
+
+            self.o_xy.eq(render.o_xy),
+            self.o_mask.eq(mask),
+            self.o_coverage.eq(coverage),
+            self.o_valid.eq(valid & render.i_run),
+            self.o_full.eq(render.o_full & render.i_run),
+            self.o_idle.eq(idle),
+        ]
+        m.d.comb += [Cat(*output).eq(Cat(*lanes)) for output, lanes in zip(self.o_plane, render.o_plane)]
+
+        return m
+
+
+# DepthPipeline follows a RasterPipeline with FragmentZTransform and DepthTest,
+# from gpu2.py, over a width x height frame, so that fragments behind what has
+# already been drawn are dropped, and whole tiles of them are never walked:
+#
+#  i_tri_* --> RasterPipeline --> FragmentZTransform --> DepthTest --> o_xy, o_z, o_valid
+#                  |     ^                                 |    ^
+#                  |     +------- tile occluded? ----------+    |
+#                  +------------- tile, nearest depth ----------+
+#
+# triangles are offered as for RasterPipeline, with i_valid and o_ready, each
+# with the w of its vertices on i_w_a/b/c in Q8.8 (so below 128), which must
+# be positive. w is interpolated across the triangle as a plane, and the top
+# 16 bits of it, Q8.8 again, are FragmentZTransform's i_pnt_wz at each pixel,
+# whose o_pnt_z, 2**31 / w, is the depth DepthTest keeps the greatest of.
+#
+# the walk is tiled, a pixel at a time, with tiles inside the triangle scanned
+# like the rest, so that the fragments keep to one per cycle; FragmentZTransform
+# and DepthTest are fully pipelined, and take them as they come. before the
+# walk gets to a tile, it asks DepthTest's coarse buffer (with a tile of the
+# same size) whether the triangle is hidden over the whole tile, and passes
+# over it in one cycle if so. for that, each triangle also comes with
+# i_z_near, the nearest depth any of its fragments can have: since the
+# interpolated w at a covered pixel rounds down by up to a unit at most,
+# 2**31 // (min(w) - 1) will do. a higher i_z_near, up to 0xFFFFFFFF, only
+# skips fewer tiles, but a lower one than that drops fragments that should
+# have passed.
+#
+# fragments that pass come out on o_xy and o_z with o_valid. i_clear clears
+# the depth buffers as for DepthTest, and should only be raised while o_idle
+# is set; triangles are not taken until the clear is done. o_idle is set when
+# there is no triangle or fragment anywhere past the input.
+#
+# with counters set, `counters` is a PerformanceCounters over:
+#
+# - tiles_occluded:  tiles passed over as hidden.
+# - fragments_in:    fragments depth tested.
+# - coarse_rejected: fragments rejected by the coarse buffer.
+# - coarse_accepted: fragments accepted by the coarse buffer.
+# - depth_tested:    fragments compared against the depth buffer.
+# - depth_passed:    fragments passed on.
+#
+# depth and parallel are as for RasterPipeline, and reciprocal is the engine
+# for FragmentZTransform.
+class DepthPipeline(Elaboratable):
+    def __init__(self, width=512, height=512, tile=8, depth=4, parallel=True, reciprocal=None, counters=False):
+        self.raster = RasterPipeline(depth, parallel, tile=tile, planes=1, full_tiles=False, occlusion=True)
+        self.z      = FragmentZTransform(reciprocal)
+        self.test   = DepthTest(width, height, tile, query=tile)
+
+        self.i_tri_xy_a = Signal(32)
+        self.i_tri_xy_b = Signal(32)
+        self.i_tri_xy_c = Signal(32)
+        self.i_w_a      = Signal(16)
+        self.i_w_b      = Signal(16)
+        self.i_w_c      = Signal(16)
+        self.i_z_near   = Signal(32)
+        self.i_valid    = Signal()
+        self.o_ready    = Signal()
+
+        self.o_xy    = Signal(32)
+        self.o_z     = Signal(32)
+        self.o_valid = Signal()
+        self.o_idle  = Signal()
+        self.i_clear = Signal()
+
+        self.counters = None
+        if counters:
+            test = self.test
+            self.counters = PerformanceCounters([
+                ("tiles_occluded",  self.raster.render.o_occluded),
+                ("fragments_in",    test.taken),
+                ("coarse_rejected", test.coarse_rejected),
+                ("coarse_accepted", test.coarse_accepted),
+                ("depth_tested",    test.depth_tested),
+                ("depth_passed",    test.passed),
+            ])
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.raster = raster = self.raster
+        m.submodules.z      = z      = self.z
+        m.submodules.test   = test   = self.test
+        if self.counters is not None:
+            m.submodules.counters = self.counters
+
+        render = raster.render
+
+        # fragments between the walk and the end of DepthTest.
+        in_flight = Signal(range(z.latency + test.latency + 2))
+        m.d.sync += in_flight.eq(in_flight + z.i_valid - delay(m, z.o_valid, test.latency))
+
+        m.d.comb += [
+            raster.i_tri_xy_a.eq(self.i_tri_xy_a),
+            raster.i_tri_xy_b.eq(self.i_tri_xy_b),
+            raster.i_tri_xy_c.eq(self.i_tri_xy_c),
+            raster.i_attr_a[0].eq(self.i_w_a),
+            raster.i_attr_b[0].eq(self.i_w_b),
+            raster.i_attr_c[0].eq(self.i_w_c),
+            raster.i_tri_z_near.eq(self.i_z_near),
+            raster.i_valid.eq(self.i_valid & test.o_ready),
+            self.o_ready.eq(raster.o_ready & test.o_ready),
+
+            z.i_pnt_xy.eq(raster.o_xy),
+            z.i_pnt_wz.eq(raster.o_plane[0][0][16:]),
+            z.i_valid.eq(raster.o_valid),
+
+            test.i_pnt_xy.eq(z.o_pnt_xy),
+            test.i_pnt_z.eq(z.o_pnt_z),
+            test.i_valid.eq(z.o_valid),
+            test.i_clear.eq(self.i_clear),
+
+            test.i_query_xy.eq(render.o_query_xy),
+            test.i_query_z.eq(render.o_query_z),
+            render.i_occluded.eq(test.o_query_occluded),
+
+            self.o_xy.eq(test.o_pnt_xy),
+            self.o_z.eq(test.o_pnt_z),
+            self.o_valid.eq(test.o_valid),
+            self.o_idle.eq(raster.o_idle & (in_flight == 0) & test.o_ready),
+        ]
+
+        return m
+
+
+# the pieces of a triangle FIFO entry, as signals: the edge functions, their
+# deltas, and the bounding box.
+def triangle_fields(m, tri_fifo, precision):
+    edges  = [Signal(signed(precision.edge_bits), name="edge_" + n) for n in ("ab", "bc", "ca")]
+    deltas = [Signal(signed(precision.delta_bits), name="edge_{}_{}".format(n, d))
+              for n in ("ab", "bc", "ca") for d in ("dx", "dy")]
+    bbox   = [Signal(32, name="first_xy")] + [Signal(16, name=n) for n in ("start_x", "start_y", "stop_x", "stop_y")]
+    fields = edges + deltas + bbox
+    m.d.comb += Cat(*fields).eq(tri_fifo.r_data)
+    return fields
+
+
+# the last samples a walk of the bounding box in `fields` visits in x and y; a
+# walk always visits the first sample of each row, and the first row.
+def last_samples(fields):
+    first_xy, _, _, stop_x, stop_y = fields[9:]
+    first_x, first_y = first_xy[:16], first_xy[16:]
+    # stop_x is max_x - 1.0, clamped at 0; either way, the walk's last sample
+    # is the last one at or before stop_x + 1.0.
+    end_x = (stop_x + (1 << 4))[:16]
+    end_y = stop_y
+    last_x = Mux(end_x > first_x, first_x + ((end_x - first_x)[:16] & ~0xF), first_x)[:16]
+    last_y = Mux(end_y > first_y, first_y + ((end_y - first_y)[:16] & ~0xF), first_y)[:16]
+    return last_x, last_y
+
+
+# the first and last samples, along one axis, of a walk from first to last
+# that fall in `tile`, the top bits of a coordinate from bit t_bits up. the
+# samples all share the first sample's position within a pixel.
+def clip_to_tile(tile, first, last, t_bits):
+    origin = Cat(first[:4], C(0, t_bits - 4), tile)
+    low  = Mux(tile == first[t_bits:], first, origin)
+    high = Mux(tile == last[t_bits:], last, origin | (((1 << (t_bits - 4)) - 1) << 4))
+    return low[:16], high[:16]
+
+
+# the edge functions of the triangle in `fields` at sample (x, y).
+def edges_at(fields, x, y):
+    edges, deltas = fields[:3], fields[3:9]
+    first_xy = fields[9]
+    steps_x = (x - first_xy[:16])[4:16]
+    steps_y = (y - first_xy[16:])[4:16]
+    return [fit(edge + dx * steps_x + dy * steps_y, len(edge))
+            for edge, dx, dy in zip(edges, deltas[0::2], deltas[1::2])]
+
+
+# a job for TriangleRender's i_next_* inputs, in the order of a triangle FIFO
+# entry, walking the triangle in `fields` over the samples from (x0, y0) to
+# (x1, y1) only.
+def tile_job(fields, x0, y0, x1, y1):
+    return edges_at(fields, x0, y0) + fields[3:9] + [
+        Cat(x0, y0),
+        walk_start_x(x0), (y0 - (1 << 3))[:16],
+        (x1 - (1 << 3))[:16], y1,
+    ]
+
+
+# MultiCorePipeline spreads rasterisation over `cores` TriangleRender cores,
+# each of which owns an interleaved set of the tile x tile pixel squares of the
+# screen: tile (i, j) belongs to core (i + j) % cores, so that neighbouring
+# tiles, along a row, a column or a diagonal, go to different cores.
+#
+#                                                  +-> job FIFO --> TriangleRender 0 -+
+#  i_tri_xy_* --> TriangleSetup --> triangle FIFO --> distributor                      +--> o_xy[n], o_valid[n]
+#                                                  +-> job FIFO --> TriangleRender 1 -+
+#
+# the front end is that of RasterPipeline. the distributor then splits each
+# set up triangle into one job per tile its bounding box overlaps, at most one
+# per cycle, in raster order. a job is the triangle clipped to the tile: its
+# edge functions moved to the first sample in the tile, and its bounding box
+# cut down to the samples in the tile, which the owning core then walks. a
+# sample belongs to the tile its pixel is in, so every sample is walked by
+# exactly one core, and the cores together produce exactly the fragments
+# RasterPipeline would, if in a different order.
+#
+# the merge stage registers each core's output as lane n of o_xy and o_valid,
+# with no other reordering; there can be up to `cores` fragments per cycle.
+# it also drops the samples outside a job that a walk visits as it turns.
+# o_idle is set when there is no triangle anywhere past the input.
+#
+# the cores walk one sample at a time; a lane block or tile walk would step
+# over the edges of a job into tiles owned by other cores.
+#
+# cull and scissor are as for RasterPipeline, with `counters` counting only
+# the culled triangles.
+class MultiCorePipeline(Elaboratable):
+    def __init__(self, cores=2, tile=16, depth=4, job_depth=4, parallel=True, cull=False, scissor=False):
+        if cores < 1 or cores & (cores - 1):
+            raise ValueError("Core count must be a power of two, not {}".format(cores))
+        if tile < 1 or tile & (tile - 1):
+            raise ValueError("Tile size must be a power of two, not {}".format(tile))
+        if depth < 1 or job_depth < 1:
+            raise ValueError("FIFO depths must be at least 1, not {} and {}".format(depth, job_depth))
+
+        self.cores     = cores
+        self.tile      = tile
+        self.depth     = depth
+        self.job_depth = job_depth
+        self.setup     = TriangleSetup(parallel)
+        self.renders   = [TriangleRender() for _ in range(cores)]
+
+        self.i_tri_xy_a = Signal(32)
+        self.i_tri_xy_b = Signal(32)
+        self.i_tri_xy_c = Signal(32)
+        self.i_valid    = Signal()
+        self.o_ready    = Signal()
+
+        self.o_xy    = [Signal(32, name="o_xy{}".format(n)) for n in range(cores)]
+        self.o_valid = Signal(cores)
+        self.o_idle  = Signal()
+
+        events = cull_signals(self, cull, scissor)
+        self.counters = PerformanceCounters(events) if events else None
+
+    def elaborate(self, platform):
+        m = Module()
+
+        bbox_fifo, tri_fifo = triangle_queue(m, self)
+        if self.counters is not None:
+            m.submodules.counters = self.counters
+
+        # the triangle being distributed.
+        entry    = triangle_fields(m, tri_fifo, self.setup.precision)
+        triangle = [Signal.like(field, name="tri_" + field.name) for field in entry]
+        t_first_x, t_first_y = triangle[9][:16], triangle[9][16:]
+
+        last_x = Signal(16)
+        last_y = Signal(16)
+
+        # bits of a Q12.4 coordinate within a tile.
+        t_bits = self.tile.bit_length() - 1 + 4
+
+        # the tile the next job is for.
+        tile_x = Signal(16 - t_bits)
+        tile_y = Signal(16 - t_bits)
+        first_tile_x = t_first_x[t_bits:]
+        last_tile_x  = last_x[t_bits:]
+        last_tile_y  = last_y[t_bits:]
+
+        busy = Signal()
+
+        def latch():
+            first_xy = entry[9]
+            m.d.sync += [t.eq(f) for t, f in zip(triangle, entry)]
+            m.d.sync += Cat(last_x, last_y).eq(Cat(*last_samples(entry)))
+            m.d.sync += [
+                tile_x.eq(first_xy[t_bits:16]),
+                tile_y.eq(first_xy[16 + t_bits:]),
+                busy.eq(1),
+            ]
+
+        # the job for the current tile.
+        job_x0, job_x1 = clip_to_tile(tile_x, t_first_x, last_x, t_bits)
+        job_y0, job_y1 = clip_to_tile(tile_y, t_first_y, last_y, t_bits)
+        job = tile_job(triangle, job_x0, job_y0, job_x1, job_y1)
+
+        owner = (tile_x + tile_y)[:max(self.cores.bit_length() - 1, 1)] if self.cores > 1 else C(0)
+
+        job_fifos = []
+        for n, render in enumerate(self.renders):
+            m.submodules["render{}".format(n)] = render
+            m.submodules["job_fifo{}".format(n)] = job_fifo = SyncFIFOBuffered(width=len(Cat(*job)),
+                                                                              depth=self.job_depth)
+            job_fifos.append(job_fifo)
+
+            next_inputs = [
+                render.i_next_edge_ab, render.i_next_edge_bc, render.i_next_edge_ca,
+                render.i_next_edge_ab_dx, render.i_next_edge_ab_dy,
+                render.i_next_edge_bc_dx, render.i_next_edge_bc_dy,
+                render.i_next_edge_ca_dx, render.i_next_edge_ca_dy,
+                render.i_next_xy,
+                render.i_next_start_x, render.i_next_start_y,
+                render.i_next_stop_x, render.i_next_stop_y,
+            ]
+
+            m.d.comb += [
+                job_fifo.w_data.eq(Cat(*job)),
+                job_fifo.w_en.eq(busy & (owner == n)),
+                Cat(*next_inputs).eq(job_fifo.r_data),
+                render.i_next_valid.eq(job_fifo.r_rdy),
+                job_fifo.r_en.eq(render.o_next_ready),
+            ]
+
+            # a single sample walk turns onto the next row diagonally, so visits
+            # a sample just outside the job at every turn; in a tile owned by
+            # another core, that sample may be covered, so it is dropped here.
+            x = render.o_xy[:16]
+            in_job = (x + (1 << 3) >= render.i_start_x) & (x <= render.i_stop_x + (1 << 3))
+            m.d.sync += [
+                self.o_xy[n].eq(render.o_xy),
+                self.o_valid[n].eq(render.o_valid & render.i_run & in_job),
+            ]
+
+        # a job is sent when its core's FIFO has room; the next triangle is
+        # taken along with the last job of the current one.
+        sent = busy & Array(job_fifo.w_rdy for job_fifo in job_fifos)[owner]
+        done = (tile_x == last_tile_x) & (tile_y == last_tile_y)
+
+        with m.If(sent):
+            with m.If(tile_x == last_tile_x):
+                m.d.sync += [
+                    tile_x.eq(first_tile_x),
+                    tile_y.eq(tile_y + 1),
+                ]
+            with m.Else():
+                m.d.sync += tile_x.eq(tile_x + 1)
+
+        with m.If(~busy | (sent & done)):
+            m.d.sync += busy.eq(0)
+            m.d.comb += tri_fifo.r_en.eq(1)
+            with m.If(tri_fifo.r_rdy):
+                latch()
+
+        idle = [(bbox_fifo.level == 0), (tri_fifo.level == 0), ~busy]
+        idle += [(job_fifo.level == 0) for job_fifo in job_fifos]
+        idle += [~render.o_busy for render in self.renders]
+        m.d.comb += self.o_idle.eq(Cat(*idle).all() & ~self.o_valid.any())
+
+        return m
+
+
+# BinningPipeline is a sort-middle rasteriser: rather than walking triangles
+# as they arrive, it first sorts them into bins, one per tile x tile pixel
+# square of a width x height screen, and then walks the screen a tile at a
+# time, so that whatever per-pixel state the fragments go on to need (depth,
+# colour) only has to be held on-chip for one tile at once:
+#
+#  i_tri_xy_* --> TriangleSetup --> triangle FIFO --> binner --> triangle memory, bins
+#                                                                       |
+#                                             o_xy, o_valid <-- TriangleRender <-- tile walker
+#
+# the front end is that of RasterPipeline. the binner stores each set up
+# triangle in the triangle memory, under the next of `triangles` IDs, and then
+# appends that ID to the bin of each tile the triangle's bounding box overlaps,
+# at most one tile per cycle. a tile whose samples in the bounding box are
+# all outside one of the edges is skipped. the bins are linked lists in a
+# single memory of `entries` IDs, with the head and tail of each tile's list in
+# a memory of their own, so an append takes one cycle whatever the tile. every
+# memory is read synchronously, as block RAM is, so appends are pipelined over
+# two cycles, each tile's bin is read as the pass moves onto it, and each
+# triangle in a bin is read while the one before it is being sent.
+#
+# the bins are rendered in a pass over every tile that holds anything, in
+# raster order: each ID in a tile's bin, in the order they were binned, is sent
+# to TriangleRender as a job clipped to the tile, as for MultiCorePipeline.
+# within a tile, triangles are therefore walked in the order they arrived,
+# and every sample is walked exactly once, though all of a tile's fragments
+# come before any of the next tile's.
+#
+# a pass starts when i_flush is high with the front end drained, marking the
+# end of a frame, or when the triangle memory or the bin memory fills up, in
+# which case binning resumes after the pass, where it stopped. triangles keep
+# being taken into the front end during a pass. o_idle is set when there is no
+# triangle anywhere past the input, binned or not; o_binning is low during a
+# pass.
+#
+# triangles off the right or bottom of the screen are dropped by the binner;
+# width and height must be powers of two, from the tile size up to 4096. the
+# default is the whole Q12.4 coordinate range.
+class BinningPipeline(Elaboratable):
+    def __init__(self, width=4096, height=4096, tile=64, triangles=64, entries=1024, depth=4, parallel=True,
+                 span=False, cull=False, scissor=False):
+        if tile < 1 or tile & (tile - 1):
+            raise ValueError("Tile size must be a power of two, not {}".format(tile))
+        for name, value in [("Width", width), ("Height", height)]:
+            if value < tile or value & (value - 1) or value > 4096:
+                raise ValueError("{} must be a power of two from the tile size {} up to 4096, not {}"
+                                 .format(name, tile, value))
+        for name, value in [("Triangle memory", triangles), ("Bin memory", entries), ("Triangle FIFO", depth)]:
+            if value < 1:
+                raise ValueError("{} depth must be at least 1, not {}".format(name, value))
+
+        self.width     = width
+        self.height    = height
+        self.tile      = tile
+        self.triangles = triangles
+        self.entries   = entries
+        self.depth     = depth
+        self.setup     = TriangleSetup(parallel)
+        self.render    = TriangleRender(span=span)
+
+        self.i_tri_xy_a = Signal(32)
+        self.i_tri_xy_b = Signal(32)
+        self.i_tri_xy_c = Signal(32)
+        self.i_valid    = Signal()
+        self.o_ready    = Signal()
+        self.i_flush    = Signal()
+
+        self.o_xy      = Signal(32)
+        self.o_valid   = Signal()
+        self.o_idle    = Signal()
+        self.o_binning = Signal()
+
+        events = cull_signals(self, cull, scissor)
+        self.counters = PerformanceCounters(events) if events else None
+
+    def elaborate(self, platform):
+        m = Module()
+
+        bbox_fifo, tri_fifo = triangle_queue(m, self)
+        if self.counters is not None:
+            m.submodules.counters = self.counters
+        m.submodules.render = render = self.render
+
+        t_bits  = self.tile.bit_length() - 1 + 4
+        tiles_x = self.width // self.tile
+        tiles_y = self.height // self.tile
+        x_bits  = tiles_x.bit_length() - 1
+        y_bits  = tiles_y.bit_length() - 1
+
+        id_bits    = max(self.triangles - 1, 1).bit_length()
+        entry_bits = max(self.entries - 1, 1).bit_length()
+
+        # the triangle being binned, and its last samples.
+        entry    = triangle_fields(m, tri_fifo, self.setup.precision)
+        triangle = [Signal.like(field, name="tri_" + field.name) for field in entry]
+        triangle += [Signal(16, name="tri_last_x"), Signal(16, name="tri_last_y")]
+        t_first_x, t_first_y = triangle[9][:16], triangle[9][16:]
+
+        tris  = Memory(width=len(Cat(*triangle)), depth=self.triangles)
+        ids   = Memory(width=id_bits, depth=self.entries)
+        nexts = Memory(width=entry_bits, depth=self.entries)
+        # a bin is (head, tail, held), and is emptied as a pass walks it.
+        bins = Memory(width=2 * entry_bits + 1, depth=tiles_x * tiles_y)
+
+        # the memories are read synchronously, so that they can be block RAMs:
+        # each read's data comes the cycle after its address.
+        m.submodules.tris_write  = tris_write  = tris.write_port()
+        m.submodules.tris_read   = tris_read   = tris.read_port(transparent=False)
+        m.submodules.ids_write   = ids_write   = ids.write_port()
+        m.submodules.ids_read    = ids_read    = ids.read_port(transparent=False)
+        m.submodules.nexts_write = nexts_write = nexts.write_port()
+        m.submodules.nexts_read  = nexts_read  = nexts.read_port(transparent=False)
+        m.submodules.bins_write  = bins_write  = bins.write_port()
+        m.submodules.bins_read   = bins_read   = bins.read_port(transparent=False)
+
+        tri_count   = Signal(range(self.triangles + 1))
+        entry_count = Signal(range(self.entries + 1))
+
+        # the range of tiles holding anything.
+        min_x = Signal(x_bits, reset=tiles_x - 1)
+        max_x = Signal(x_bits)
+        min_y = Signal(y_bits, reset=tiles_y - 1)
+        max_y = Signal(y_bits)
+
+        # binning: the tile the next append is for, from the first tile of the
+        # bounding box to the last, clamped to the screen.
+        tile_x = Signal(16 - t_bits)
+        tile_y = Signal(16 - t_bits)
+        last_x, last_y = triangle[-2:]
+
+        def clamp(tile, tiles):
+            return Mux(tile > tiles - 1, tiles - 1, tile)
+
+        first_tile_x = t_first_x[t_bits:]
+        last_tile_x  = clamp(last_x[t_bits:], tiles_x)
+        last_tile_y  = clamp(last_y[t_bits:], tiles_y)
+        off_screen   = (first_tile_x >= tiles_x) | (tile_y >= tiles_y)
+
+        busy = Signal()
+
+        job_x0, job_x1 = clip_to_tile(tile_x, t_first_x, last_x, t_bits)
+        job_y0, job_y1 = clip_to_tile(tile_y, t_first_y, last_y, t_bits)
+        corners = [edges_at(triangle, x, y) for x in (job_x0, job_x1) for y in (job_y0, job_y1)]
+        outside = Cat(*(Cat(*(corner[k] >= 0 for corner in corners)).all() for k in range(3))).any()
+
+        head, tail, held = bins_read.data[:entry_bits], bins_read.data[entry_bits:-1], bins_read.data[-1]
+        bin_tile = Signal(x_bits + y_bits)
+
+        # an append takes two cycles, one after the other: the first decides
+        # on it, takes its entry and ID, and reads the tile's bin, and the
+        # second links the entry in with what was read. a triangle's appends are
+        # all to different tiles, and a cycle is spent between triangles
+        # fetching the next one, so an append never reads a bin that the one
+        # before it is still writing.
+        appending     = Signal()
+        append_valid  = Signal()
+        append_tile   = Signal.like(bin_tile)
+        append_entry  = Signal.like(entry_count)
+        append_id     = Signal.like(tri_count)
+        m.d.comb += [
+            bins_read.addr.eq(bin_tile),
+            tris_write.addr.eq(append_id),
+            tris_write.data.eq(Cat(*triangle)),
+            ids_write.addr.eq(append_entry),
+            ids_write.data.eq(append_id),
+            nexts_write.addr.eq(tail),
+            nexts_write.data.eq(append_entry),
+            bins_write.addr.eq(append_tile),
+            bins_write.data.eq(Cat(Mux(held, head, append_entry)[:entry_bits], append_entry[:entry_bits], 1)),
+        ]
+
+        m.d.sync += [
+            append_valid.eq(appending),
+            append_tile.eq(bin_tile),
+            append_entry.eq(entry_count),
+            append_id.eq(tri_count),
+        ]
+
+        with m.If(appending):
+            m.d.sync += [
+                entry_count.eq(entry_count + 1),
+                min_x.eq(Mux(tile_x < min_x, tile_x, min_x)),
+                max_x.eq(Mux(tile_x > max_x, tile_x, max_x)),
+                min_y.eq(Mux(tile_y < min_y, tile_y, min_y)),
+                max_y.eq(Mux(tile_y > max_y, tile_y, max_y)),
+            ]
+
+        with m.If(append_valid):
+            m.d.comb += [
+                tris_write.en.eq(1),
+                ids_write.en.eq(1),
+                nexts_write.en.eq(held),
+                bins_write.en.eq(1),
+            ]
+
+        def latch():
+            first_xy = entry[9]
+            m.d.sync += [t.eq(f) for t, f in zip(triangle, entry)]
+            m.d.sync += Cat(last_x, last_y).eq(Cat(*last_samples(entry)))
+            m.d.sync += [
+                tile_x.eq(first_xy[t_bits:16]),
+                tile_y.eq(first_xy[16 + t_bits:]),
+                busy.eq(1),
+            ]
+
+        # rendering: the tile being walked, whose bin is read at the tile it is
+        # about to move to, and the bin entry being fetched,
+        # up to `end`, the bin's tail. `pointer` is the entry whose ID and link
+        # are on the read ports, so they are read at the pointer it is about
+        # to take. the triangle of the entry before it is then read into
+        # `job`, while that is free, and sent to TriangleRender from there,
+        # which hides both reads behind the send.
+        walk_x   = Signal(x_bits)
+        walk_y   = Signal(y_bits)
+        next_x   = Signal(x_bits)
+        next_y   = Signal(y_bits)
+        pointer  = Signal(entry_bits)
+        next_ptr = Signal(entry_bits)
+        end      = Signal(entry_bits)
+        fetching = Signal()
+        job      = Signal()
+        job_last = Signal()
+
+        m.d.comb += [
+            next_x.eq(walk_x),
+            next_y.eq(walk_y),
+            next_ptr.eq(pointer),
+            ids_read.addr.eq(next_ptr),
+            nexts_read.addr.eq(next_ptr),
+            tris_read.addr.eq(ids_read.data),
+            tris_read.en.eq(0),
+        ]
+        m.d.sync += [
+            walk_x.eq(next_x),
+            walk_y.eq(next_y),
+            pointer.eq(next_ptr),
+        ]
+
+        stored = [Signal.like(field, name="job_" + field.name) for field in triangle]
+        m.d.comb += Cat(*stored).eq(tris_read.data)
+        walk_tile_x = Cat(walk_x, C(0, 16 - t_bits - x_bits))
+        walk_tile_y = Cat(walk_y, C(0, 16 - t_bits - y_bits))
+        s_first_x, s_first_y = stored[9][:16], stored[9][16:]
+        s_x0, s_x1 = clip_to_tile(walk_tile_x, s_first_x, stored[-2], t_bits)
+        s_y0, s_y1 = clip_to_tile(walk_tile_y, s_first_y, stored[-1], t_bits)
+
+        next_inputs = [
+            render.i_next_edge_ab, render.i_next_edge_bc, render.i_next_edge_ca,
+            render.i_next_edge_ab_dx, render.i_next_edge_ab_dy,
+            render.i_next_edge_bc_dx, render.i_next_edge_bc_dy,
+            render.i_next_edge_ca_dx, render.i_next_edge_ca_dy,
+            render.i_next_xy,
+            render.i_next_start_x, render.i_next_start_y,
+            render.i_next_stop_x, render.i_next_stop_y,
+        ]
+        m.d.comb += Cat(*next_inputs).eq(Cat(*tile_job(stored, s_x0, s_y0, s_x1, s_y1)))
+
+        drained = (bbox_fifo.level == 0) & (tri_fifo.level == 0) & ~busy
+
+        def next_tile():
+            with m.If(walk_x != max_x):
+                m.d.comb += next_x.eq(walk_x + 1)
+                m.next = "TILE"
+            with m.Elif(walk_y != max_y):
+                m.d.comb += [
+                    next_x.eq(min_x),
+                    next_y.eq(walk_y + 1),
+                ]
+                m.next = "TILE"
+            with m.Else():
+                m.d.sync += [
+                    tri_count.eq(0),
+                    entry_count.eq(0),
+                    min_x.eq(tiles_x - 1),
+                    max_x.eq(0),
+                    min_y.eq(tiles_y - 1),
+                    max_y.eq(0),
+                ]
+                m.next = "BIN"
+
+        with m.FSM():
+            with m.State("BIN"):
+                m.d.comb += [
+                    self.o_binning.eq(1),
+                    bin_tile.eq(Cat(tile_x[:x_bits], tile_y[:y_bits])),
+                ]
+                start = Signal()
+
+                with m.If(busy):
+                    with m.If(entry_count == self.entries):
+                        m.d.comb += start.eq(1)
+                    with m.Else():
+                        m.d.comb += appending.eq(~off_screen & ~outside)
+                        with m.If(off_screen | ((tile_x == last_tile_x) & (tile_y == last_tile_y))):
+                            m.d.sync += [
+                                busy.eq(0),
+                                tri_count.eq(tri_count + 1),
+                            ]
+                        with m.Elif(tile_x == last_tile_x):
+                            m.d.sync += [
+                                tile_x.eq(first_tile_x),
+                                tile_y.eq(tile_y + 1),
+                            ]
+                        with m.Else():
+                            m.d.sync += tile_x.eq(tile_x + 1)
+                with m.Elif(tri_count == self.triangles):
+                    m.d.comb += start.eq(1)
+                with m.Elif(tri_fifo.r_rdy):
+                    m.d.comb += tri_fifo.r_en.eq(1)
+                    latch()
+                with m.Elif(self.i_flush & drained & (tri_count != 0)):
+                    m.d.comb += start.eq(1)
+
+                # the first tile's bin is read in a cycle of its own, as the
+                # last append may still be writing it.
+                with m.If(start):
+                    m.d.comb += [
+                        next_x.eq(min_x),
+                        next_y.eq(min_y),
+                    ]
+                    m.next = "FETCH"
+
+            with m.State("FETCH"):
+                m.d.comb += bin_tile.eq(Cat(next_x, next_y))
+                m.next = "TILE"
+
+            with m.State("TILE"):
+                m.d.comb += [
+                    bin_tile.eq(Cat(next_x, next_y)),
+                    bins_write.addr.eq(Cat(walk_x, walk_y)),
+                    bins_write.data.eq(0),
+                    bins_write.en.eq(held),
+                ]
+                with m.If((entry_count != 0) & held):
+                    m.d.comb += next_ptr.eq(head)
+                    m.d.sync += [
+                        end.eq(tail),
+                        fetching.eq(1),
+                    ]
+                    m.next = "LIST"
+                with m.Elif(entry_count != 0):
+                    next_tile()
+                with m.Else():
+                    # nothing was binned; the triangles were all off screen, or
+                    # had no sample in any tile.
+                    m.d.sync += tri_count.eq(0)
+                    m.next = "BIN"
+
+            with m.State("LIST"):
+                m.d.comb += bin_tile.eq(Cat(next_x, next_y))
+                sent = job & render.o_next_ready
+                m.d.comb += render.i_next_valid.eq(job)
+                with m.If(sent):
+                    m.d.sync += job.eq(0)
+                    with m.If(job_last):
+                        next_tile()
+                with m.If(fetching & (~job | sent)):
+                    m.d.comb += tris_read.en.eq(1)
+                    m.d.sync += [
+                        job.eq(1),
+                        job_last.eq(pointer == end),
+                        fetching.eq(pointer != end),
+                    ]
+                    m.d.comb += next_ptr.eq(nexts_read.data)
+
+        # a single sample walk turns onto the next row diagonally, so visits a
+        # sample just outside the job at every turn, which belongs to another
+        # tile; it is dropped here.
+        x = render.o_xy[:16]
+        in_job = (x + (1 << 3) >= render.i_start_x) & (x <= render.i_stop_x + (1 << 3))
+        m.d.comb += [
+            self.o_xy.eq(render.o_xy),
+            self.o_valid.eq(render.o_valid & render.i_run & in_job),
+            self.o_idle.eq(self.o_binning & drained & (tri_count == 0) & ~render.o_busy),
+        ]
+
+        return m
+
+
+if __name__ == "__main__":
+    import numpy as np
+
+    import golden
+    from harness import Harness
+
+    # the triangles PrimitiveAssembly should make of vertices, as described
+    # above.
+    def assemble(mode, vertices, restarts):
+        triangles, held, odd = [], [], False
+        for vertex, restart in zip(vertices, restarts):
+            if restart or not held:
+                held, odd = [vertex], False
+            elif len(held) == 1:
+                held.append(vertex)
+            else:
+                a, b = held[::-1] if mode == "strip" and odd else held
+                triangles.append((a, b, vertex))
+                if mode == "list":
+                    held = []
+                elif mode == "strip":
+                    held, odd = [held[1], vertex], not odd
+                else:
+                    held = [held[0], vertex]
+        return triangles
+
+    # (x, y) vertices and restart flags for each mode, in a 512x512 frame: two
+    # jittered zig-zag strips, two fans around a centre, or a list, wound with
+    # their inside negative (but for the list's last two triangles, which are
+    # wound either way). each mode also has a run too short to make a triangle
+    # between the others, cut off by a restart.
+    def primitives(mode, rng):
+        def jitter(points):
+            return [tuple(int(v) for v in p + rng.integers(-(4 << 4), 4 << 4, size=2)) for p in points]
+
+        def strip(x0, y0, count):
+            return jitter([(x0 + k * (24 << 4), y0 + (0 if k % 2 else 40 << 4)) for k in range(count)])
+
+        def fan(x0, y0, count):
+            angles = np.linspace(0, 1.5 * np.pi, count - 1)
+            return [(x0, y0)] + jitter(np.stack([x0 + np.cos(angles) * (48 << 4),
+                                                 y0 + np.sin(angles) * (48 << 4)], axis=1))
+
+        if mode == "strip":
+            runs = [strip(32 << 4, 32 << 4, 9), strip(40 << 4, 200 << 4, 2), strip(64 << 4, 120 << 4, 7)]
+        elif mode == "fan":
+            runs = [fan(96 << 4, 96 << 4, 8), fan(300 << 4, 300 << 4, 2), fan(360 << 4, 120 << 4, 6)]
+        else:
+            runs = [strip(32 << 4, 32 << 4, 9), strip(40 << 4, 200 << 4, 1), strip(300 << 4, 300 << 4, 6)]
+            runs[0] = [v for a, b, c in assemble("strip", runs[0], [0] * 9) for v in (a, b, c)]
+        vertices = [v for run in runs for v in run]
+        restarts = [int(k == 0) for run in runs for k in range(len(run))]
+        return vertices, restarts
+
+    # vertices through PrimitiveAssembly into RasterPipeline, with the
+    # triangles it makes and the pipeline's fragments against assemble() and
+    # golden.rasterise.
+    def check_assembly(mode):
+        rng = np.random.default_rng(5)
+        assembly = PrimitiveAssembly(mode)
+        raster = RasterPipeline(parallel=True, mode=mode)
+        idle = Signal()
+        m = Module()
+        m.submodules.assembly = assembly
+        m.submodules.raster = raster
+        m.d.comb += [
+            raster.i_tri_xy_a.eq(assembly.o_tri_xy_a),
+            raster.i_tri_xy_b.eq(assembly.o_tri_xy_b),
+            raster.i_tri_xy_c.eq(assembly.o_tri_xy_c),
+            raster.i_shares_bc.eq(assembly.o_shares_bc),
+            raster.i_shares_ca.eq(assembly.o_shares_ca),
+            raster.i_valid.eq(assembly.o_valid),
+            assembly.i_ready.eq(raster.o_ready),
+            idle.eq(raster.o_idle & ~assembly.o_valid),
+        ]
+        harness = Harness(m)
+        outputs = [assembly.o_valid, assembly.i_ready, assembly.o_tri_xy_a, assembly.o_tri_xy_b,
+                   assembly.o_tri_xy_c, raster.o_valid, raster.o_xy]
+
+        vertices, restarts = primitives(mode, rng)
+        rows = harness.run([
+            (assembly.i_vertex,  [golden.join_xy(x, y) for x, y in vertices]),
+            (assembly.i_restart, restarts),
+        ], outputs, cycles=1 << 16, valid=assembly.i_valid, ready=assembly.o_ready, until=idle)
+
+        triangles = assemble(mode, vertices, restarts)
+        expected  = [tuple(int(v) for v in golden.join_xy(*zip(*t))) for t in triangles]
+        got       = [tuple(int(v) for v in row[2:5]) for row in rows if row[0] and row[1]]
+        fragments = np.sort(rows[rows[:, 5] == 1, 6])
+        wanted    = np.sort(np.concatenate([golden.join_xy(*golden.rasterise(*(v for p in t for v in p)))
+                                            for t in triangles]))
+        mismatches = (sum(g != w for g, w in zip(got, expected)) + abs(len(got) - len(expected)) +
+                      len(np.setxor1d(fragments, wanted)) + abs(len(fragments) - len(wanted)))
+        print("PrimitiveAssembly {}: {} vertices, {} triangles, {} fragments, {} mismatches, "
+              "set up with {} EdgeFunctions".format(
+              mode, len(vertices), len(got), len(fragments), mismatches, raster.setup.edge_functions))
+
+    for mode in ("strip", "fan", "list"):
+        check_assembly(mode)
+
+    # triangles with random attributes through a RasterPipeline with planes,
+    # culling the back-facing ones among them: the fragments against
+    # golden.rasterise, and their planes, lane by lane, against
+    # golden.plane_setup stepped to them.
+    def check_planes(channels=2, count=24):
+        from bench import corpus
+        rng = np.random.default_rng(3)
+        raster = RasterPipeline(parallel=True, lanes_x=2, lanes_y=2, cull=True, planes=channels)
+        harness = Harness(raster)
+        lanes = [(i, j) for j in range(2) for i in range(2)]
+        outputs = [raster.o_valid, raster.o_xy, raster.o_mask, raster.o_idle] + [
+                   plane for k in range(channels) for plane in raster.o_plane[k]]
+
+        triangles = corpus("tiny", count // 2, seed=3) + corpus("large", count // 2, seed=3)
+        for n in range(0, count, 5):
+            ax, ay, bx, by, cx, cy = triangles[n]
+            triangles[n] = (ax, ay, cx, cy, bx, by)
+        attrs = rng.integers(-(1 << 15), 1 << 15, size=(count, 3, channels))
+        inputs = [(raster.i_tri_xy_a, [golden.join_xy(t[0], t[1]) for t in triangles]),
+                  (raster.i_tri_xy_b, [golden.join_xy(t[2], t[3]) for t in triangles]),
+                  (raster.i_tri_xy_c, [golden.join_xy(t[4], t[5]) for t in triangles])]
+        for v, vertex in enumerate([raster.i_attr_a, raster.i_attr_b, raster.i_attr_c]):
+            inputs += [(vertex[k], attrs[:, v, k]) for k in range(channels)]
+        rows = harness.run(inputs, outputs, cycles=1 << 16, valid=raster.i_valid, ready=raster.o_ready,
+                           until=raster.o_idle)
+
+        # a pixel covered by more than one triangle gets a fragment from each,
+        # which must have the planes of one of them.
+        wanted = {}
+        for t, vertices in zip(triangles, attrs):
+            first = (min(t[0::2]) + 8, min(t[1::2]) + 8)
+            planes = golden.plane_setup(golden.setup(*t, *first), *([int(v) for v in a] for a in vertices))
+            for x, y in zip(*golden.rasterise(*t)):
+                wanted.setdefault((int(x), int(y)), []).append(
+                    [int(golden.plane_value(*plane, *first, x, y)) for plane in planes])
+
+        mismatches = fragments = 0
+        for valid, xy, mask, _, *values in rows:
+            if not valid:
+                continue
+            x, y = golden.split_xy(xy)
+            for lane, (i, j) in enumerate(lanes):
+                if not (mask >> lane) & 1:
+                    continue
+                fragments += 1
+                got = [int(values[k * len(lanes) + lane]) for k in range(channels)]
+                mismatches += got not in wanted.get((int(x + (i << 4)), int(y + (j << 4))), [])
+        expected = sum(len(v) for v in wanted.values())
+        mismatches += abs(fragments - expected)
+        print("RasterPipeline with {} planes: {} triangles in {} cycles, {} fragments, {} mismatches".format(
+              channels, count, len(rows), fragments, mismatches))
+
+    check_planes()
+
+    # layers of two triangles over a 64x64 frame, drawn front to back at one
+    # w each, with small triangles at random ws between them, through
+    # DepthPipeline, once with each triangle's nearest depth, and once with
+    # none, so that no tile is passed over. the fragments that pass must be
+    # those golden.depth_test passes either way.
+    def check_depth_pipeline(size=64, layers=3, count=6):
+        from bench import wind
+        from gpu2 import NewtonReciprocal
+
+        rng = np.random.default_rng(5)
+        edge = size << 4
+        triangles, ws = [], []
+        for layer in range(layers):
+            triangles += [wind((0, 0, edge, 0, 0, edge)), wind((edge, 0, edge, edge, 0, edge))]
+            ws += [[(1 + 2 * layer) << 8] * 3] * 2
+            for _ in range(count):
+                centre = rng.integers(0, edge, size=2)
+                triangles.append(wind(np.clip(np.tile(centre, 3) + rng.integers(-(12 << 4), 12 << 4, size=6),
+                                              0, edge - 1)))
+                ws.append([int(w) for w in rng.integers(1 << 7, 8 << 8, size=3)])
+
+        x, y, z, nearest = [], [], [], []
+        for t, w in zip(triangles, ws):
+            first = (min(t[0::2]) + 8, min(t[1::2]) + 8)
+            (plane,) = golden.plane_setup(golden.setup(*t, *first), *([v] for v in w))
+            tx, ty = golden.rasterise(*t)
+            x.append(tx)
+            y.append(ty)
+            z.append(golden.reciprocal((golden.plane_value(*plane, *first, tx, ty) >> 16) & 0xFFFF))
+            nearest.append((1 << 31) // (min(w) - 1))
+        beyond = sum(int((tz > near).sum()) for tz, near in zip(z, nearest))
+        x, y, z = np.concatenate(x), np.concatenate(y), np.concatenate(z)
+        passed = golden.depth_test(x, y, z, size, size)
+        expected = sorted(zip(golden.join_xy(x[passed], y[passed]).tolist(), z[passed].tolist()))
+
+        for near in [nearest, [0xFFFFFFFF] * len(triangles)]:
+            pipeline = DepthPipeline(size, size, reciprocal=NewtonReciprocal(), counters=True)
+            harness = Harness(pipeline)
+            rows = harness.run([
+                (pipeline.i_tri_xy_a, [golden.join_xy(t[0], t[1]) for t in triangles]),
+                (pipeline.i_tri_xy_b, [golden.join_xy(t[2], t[3]) for t in triangles]),
+                (pipeline.i_tri_xy_c, [golden.join_xy(t[4], t[5]) for t in triangles]),
+                (pipeline.i_w_a,      [w[0] for w in ws]),
+                (pipeline.i_w_b,      [w[1] for w in ws]),
+                (pipeline.i_w_c,      [w[2] for w in ws]),
+                (pipeline.i_z_near,   near),
+            ], [pipeline.o_valid, pipeline.o_xy, pipeline.o_z, pipeline.o_idle], cycles=1 << 16,
+               valid=pipeline.i_valid, ready=pipeline.o_ready, until=pipeline.o_idle)
+            counts = dict(zip(pipeline.counters.names, harness.run(
+                outputs=[pipeline.counters[name] for name in pipeline.counters.names], cycles=1)[0]))
+
+            got = sorted((int(xy), int(fz)) for valid, xy, fz, _ in rows if valid)
+            mismatches = len(set(got) ^ set(expected)) + abs(len(got) - len(expected))
+            print("DepthPipeline {}: {} triangles in {} cycles, {} tiles occluded, {} fragments tested, "
+                  "{} passed, {} mismatches".format(
+                  "with nearest depths" if near is nearest else "without", len(triangles), len(rows),
+                  counts["tiles_occluded"], counts["fragments_in"], counts["depth_passed"], mismatches))
+        print("DepthPipeline: {} fragments beyond their triangle's nearest depth".format(beyond))
+
+    check_depth_pipeline()
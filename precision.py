@@ -0,0 +1,94 @@
+from amaranth import *
+
+# Precision describes the fixed-point formats of the rasteriser's datapath, for
+# a given screen, so that EdgeFunction, TriangleSetup, TriangleRender and
+# FragmentInTriangleTest can be built no wider than that screen needs: a
+# smaller target gets narrower multipliers and adders, and so a higher Fmax,
+# or more lanes in the same space.
+#
+# coordinates are unsigned Q(int_bits).(frac_bits), held in the low
+# int_bits + frac_bits (coord_bits) bits of each half of the packed
+# (y << 16) | x ports, which keep that layout whatever the precision. the
+# screen is width x height pixels, so every coordinate is from 0 up to max_x or
+# max_y, and every vertex must lie on it. from those:
+#
+# - the edge deltas, B.y - A.y and so on, are delta_bits = coord_bits + 1
+#   bits, signed, which always fits them.
+# - EdgeFunction's products are twice that, product_bits.
+# - the edge functions, the area, and the accumulators TriangleRender steps
+#   them in are edge_bits, signed.
+#
+# an edge function of a triangle on the screen, at a point up to `margin`
+# pixels off it, is bounded by
+#
+#   ((max_x + margin) * max_y + (max_y + margin) * max_x) >> frac_bits
+#
+# (with margin in the same units as max_x), plus one for the top-left
+# adjustment, and edge_bits_for(margin) is the width that holds that.
+# TriangleSetup only evaluates edge functions on the screen, but
+# TriangleRender's walk steps its accumulators a little way past the bounding
+# box, further with wider lane blocks and tiles, so each checks its own margin
+# with check(), which raises a ValueError for a configuration that could
+# overflow.
+#
+# the default, a 4096x4096 screen in Q12.4 with 32-bit edge functions, is the
+# full range of the ports.
+class Precision:
+    def __init__(self, width=4096, height=4096, int_bits=12, frac_bits=4, edge_bits=32):
+        if int_bits < 1 or frac_bits < 0 or int_bits + frac_bits > 16:
+            raise ValueError("Coordinates must fit the 16 bits a port has per axis, not Q{}.{}"
+                             .format(int_bits, frac_bits))
+        for name, value in [("Width", width), ("Height", height)]:
+            if not 1 <= value <= 1 << int_bits:
+                raise ValueError("{} must be from 1 to {} pixels with {} integer bits, not {}"
+                                 .format(name, 1 << int_bits, int_bits, value))
+
+        self.width     = width
+        self.height    = height
+        self.int_bits  = int_bits
+        self.frac_bits = frac_bits
+
+        self.coord_bits   = int_bits + frac_bits
+        self.delta_bits   = self.coord_bits + 1
+        self.product_bits = 2 * self.delta_bits
+        self.edge_bits    = edge_bits
+
+        # one pixel, and the largest coordinates on the screen.
+        self.one   = 1 << frac_bits
+        self.max_x = (width << frac_bits) - 1
+        self.max_y = (height << frac_bits) - 1
+
+        self.check(1, "TriangleSetup")
+
+    def __repr__(self):
+        return "Precision({}x{}, Q{}.{}, {}-bit edges)".format(
+            self.width, self.height, self.int_bits, self.frac_bits, self.edge_bits)
+
+    # the narrowest edge functions that hold every value at points up to
+    # `margin` pixels off the screen.
+    def edge_bits_for(self, margin):
+        reach = margin << self.frac_bits
+        bound = ((self.max_x + reach) * self.max_y + (self.max_y + reach) * self.max_x) >> self.frac_bits
+        return (bound + 1).bit_length() + 1
+
+    def check(self, margin, user):
+        needed = self.edge_bits_for(margin)
+        if self.edge_bits < needed:
+            raise ValueError("{} needs at least {}-bit edge functions on a {}x{} screen in Q{}.{}, not {}"
+                             .format(user, needed, self.width, self.height, self.int_bits, self.frac_bits,
+                                     self.edge_bits))
+
+
+# the narrowest Precision for a width x height screen, with `frac_bits` bits
+# below the pixel, whose edge functions still hold at `margin` pixels off it.
+def narrowest(width, height, frac_bits=4, margin=1):
+    int_bits  = max(1, (max(width, height) - 1).bit_length())
+    precision = Precision(width, height, int_bits, frac_bits, edge_bits=64)
+    return Precision(width, height, int_bits, frac_bits, precision.edge_bits_for(margin))
+
+
+# a signed value cut down to `bits` bits, where it is any wider, for keeping an
+# edge function to the width a Precision has checked it fits.
+def fit(value, bits):
+    value = Value.cast(value)
+    return value[:bits].as_signed() if len(value) > bits else value
@@ -0,0 +1,53 @@
+from amaranth import *
+
+# helpers for building pipelines whose depth is a parameter rather than baked
+# into the code.
+#
+# a pipelined block is written as a sequence of combinational steps, with a
+# call to stage() between each pair, which registers the values passing
+# between them or not as schedule() says. the block then reports its latency,
+# the number of stages it was built with, and anything that has to line up
+# with its results follows that latency through delay(), instead of through
+# registers placed by hand.
+
+
+# which of the boundaries between `steps` combinational steps get a register,
+# for a pipeline of `stages` stages: a list of `steps` counts, the ith being
+# the number of registers after step i. the registers are spread as evenly as
+# they go, always with one after the last step; stages beyond one per step all
+# go there, where retiming can move them forward again.
+def schedule(steps, stages):
+    if stages < 1:
+        raise ValueError("A pipeline needs at least one stage, not {}".format(stages))
+    counts = [0] * steps
+    for k in range(min(stages, steps)):
+        counts[-(-(k + 1) * steps // min(stages, steps)) - 1] = 1
+    counts[-1] += max(0, stages - steps)
+    return counts
+
+
+# `values` registered `count` times (by default, once), in new signals, or
+# unchanged for a count of 0. the registers take their names from `names`, or
+# from the values, if those are signals. with enable given, they only load
+# while it is high, so the stage stalls with the rest of the pipeline.
+def stage(m, values, count=1, enable=None, domain="sync", names=None):
+    if names is None:
+        names = [getattr(value, "name", "stage") for value in values]
+    for _ in range(count):
+        registered = []
+        for value, name in zip(values, names):
+            value = Value.cast(value)
+            registered.append(Signal(value.shape(), name=name))
+        if enable is None:
+            m.d[domain] += [r.eq(v) for r, v in zip(registered, values)]
+        else:
+            with m.If(enable):
+                m.d[domain] += [r.eq(v) for r, v in zip(registered, values)]
+        values = registered
+    return list(values)
+
+
+# a single value delayed by `cycles` cycles, for sideband signals that travel
+# alongside a pipelined block.
+def delay(m, value, cycles, enable=None, domain="sync"):
+    return stage(m, [value], cycles, enable, domain)[0]